@@ -1,6 +1,9 @@
-from flask import Flask, render_template, request, send_from_directory, jsonify, send_file
-import os, subprocess, uuid, traceback
+from flask import Flask, render_template, request, send_from_directory, jsonify, send_file, Response, stream_with_context
+import os, sys, json, uuid, traceback
+import atexit, concurrent.futures, functools, glob, gzip, threading, time
+import numpy as np
 import pandas as pd
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
@@ -8,15 +11,175 @@ BASE = os.path.dirname(os.path.abspath(__file__))
 JOBS = os.path.join(BASE, "jobs")
 SCRIPTS = os.path.join(BASE, "scripts")
 
+sys.path.insert(0, SCRIPTS)
+import pipeline, jobs, store, lot_index, catalog, genealogy, metrics, uploads, manifest, janitor, job_cache
+
 # Configuration
 ALLOWED_EXTENSIONS = {'xlsx', 'csv'}
-MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max request size, larger files come in chunks
+MAX_UPLOAD_SIZE = 2 * 1024 ** 3  # 2GB max file size of a chunked upload
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # chunk size suggested to clients
+STAGE_TIMEOUT = 300  # 5 minute timeout per pipeline stage
+PIPELINE_WORKERS = 2  # pipelines that may run at the same time, in all server processes together
+MAX_PENDING_JOBS = 16  # queued + running jobs of all server processes before uploads are refused
+MAX_BATCH_LOTS = 5000  # LOTs per batch trace request
+BATCH_TRACE_ROWS = 50000  # rows read from final_data per streamed chunk
+JANITOR_INTERVAL = 3600  # seconds between janitor sweeps, 0 turns the janitor off
+JOB_MAX_AGE = 30 * 24 * 3600  # jobs unused for 30 days are deleted
+JOBS_MAX_BYTES = 50 * 1024 ** 3  # 50GB quota for jobs/ and the upload blobs
+JOB_CACHE_BYTES = 1024 ** 3  # 1GB of job tables and LOT indexes kept loaded per server process
+WARM_JOBS = 4  # most recently used jobs loaded by /warmup and new server workers
 
 os.makedirs(JOBS, exist_ok=True)
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+job_cache.CACHE.max_bytes = JOB_CACHE_BYTES
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+_pipeline_executor = None
+_pending_lock = threading.Lock()
+METRICS = metrics.Registry()  # totals of this process, saved to METRICS_DIR for /metrics
+METRICS_DIR = ".metrics"  # in JOBS, one file of totals per server process
+METRICS_FLUSH_INTERVAL = 10  # seconds between writes of the search metrics, 0 writes them at every search
+_search_records = {}  # job dir -> search records not yet in its metrics file
+_search_records_lock = threading.Lock()
+_metrics_thread = None
+_metrics_lock = threading.Lock()
+
+def get_pipeline_executor():
+    """
+    Bounded pool of worker processes that keep pandas and the stage modules
+    imported between jobs. Created lazily so the debug reloader parent never
+    spawns one.
+    """
+    global _pipeline_executor
+    if _pipeline_executor is None:
+        _pipeline_executor = concurrent.futures.ProcessPoolExecutor(max_workers=PIPELINE_WORKERS, initializer=pipeline.preload)
+    return _pipeline_executor
+
+def replace_pipeline_executor(broken):
+    """
+    Drops a pool that lost a worker (e.g. to the OOM killer); such a pool
+    refuses every later job. The jobs it had already failed with it, and
+    it has stopped its other workers itself.
+    """
+    global _pipeline_executor
+    if _pipeline_executor is broken:
+        print("Pipeline worker died, starting a new worker pool")
+        _pipeline_executor = None
+
+def submit_job(job_id, job_dir, base_dir=None):
+    """
+    Queues a pipeline run. Returns False when the queue of the server is
+    full. If it cannot be queued at all, the job is marked failed and the
+    error raised. Every server process has a pool of PIPELINE_WORKERS, the
+    jobs wait there for one of the PIPELINE_WORKERS run slots of the server
+    (see jobs.run_slot()).
+    """
+    with jobs.pending_lock(JOBS):
+        if jobs.count_pending(JOBS) >= MAX_PENDING_JOBS:
+            return False
+        jobs.add_pending(job_dir)
+    with _pending_lock:
+        try:
+            try:
+                executor = get_pipeline_executor()
+                future = executor.submit(jobs.run_job, job_dir, base_dir, STAGE_TIMEOUT, PIPELINE_WORKERS)
+            except concurrent.futures.process.BrokenProcessPool:
+                replace_pipeline_executor(executor)
+                executor = get_pipeline_executor()
+                future = executor.submit(jobs.run_job, job_dir, base_dir, STAGE_TIMEOUT, PIPELINE_WORKERS)
+        except Exception as e:
+            jobs.remove_pending(job_dir)
+            jobs.mark_failed(job_dir, f"Pipeline could not be started: {e}")
+            raise
+
+    def on_done(fut):
+        jobs.remove_pending(job_dir)
+        # run_job records its own failures; this only catches a dead worker
+        if fut.exception() is not None:
+            jobs.mark_failed(job_dir, f"Pipeline worker crashed: {fut.exception()}")
+            if isinstance(fut.exception(), concurrent.futures.process.BrokenProcessPool):
+                with _pending_lock:
+                    replace_pipeline_executor(executor)
+        for record in metrics.load(job_dir):
+            METRICS.observe(record)
+        save_metrics()
+        # The first search on the new job then finds it loaded
+        if (jobs.read_status(job_dir) or {}).get("state") == jobs.DONE:
+            threading.Thread(target=warm_jobs, args=([job_dir],), daemon=True).start()
+
+    future.add_done_callback(on_done)
+    return True
+
+_janitor_thread = None
+_janitor_lock = threading.Lock()
+
+def run_janitor():
+    while True:
+        try:
+            # With several server processes only the one holding the lock sweeps
+            if not janitor.acquire(JOBS):
+                time.sleep(JANITOR_INTERVAL)
+                continue
+            report = janitor.sweep(JOBS, JOB_MAX_AGE, JOBS_MAX_BYTES)
+            if report["expired_jobs"] or report["evicted_jobs"] or report["artifacts"] or report["blobs"]:
+                print(f"Janitor: {report}")
+        except Exception:
+            print(f"Janitor error: {traceback.format_exc()}")
+        time.sleep(JANITOR_INTERVAL)
+
+def start_janitor():
+    """Starts the janitor thread once per process, on the first request like the pipeline pool."""
+    global _janitor_thread
+    with _janitor_lock:
+        if _janitor_thread is None and JANITOR_INTERVAL:
+            _janitor_thread = threading.Thread(target=run_janitor, name="janitor", daemon=True)
+            _janitor_thread.start()
+
+def warm_job(job_dir):
+    """Loads a finished job's LOT index and final_data into the job cache."""
+    lot_index.load_index(job_dir)
+    job_cache.table(job_dir, pipeline.FINAL)
+
+def recent_jobs(limit):
+    """Job directories with a final_data, most recently used first."""
+    found = [os.path.join(JOBS, name) for name in os.listdir(JOBS)]
+    found = [job_dir for job_dir in found if store.exists(job_dir, pipeline.FINAL)]
+    return sorted(found, key=os.path.getmtime, reverse=True)[:limit]
+
+def warm_jobs(job_dirs):
+    """Warms jobs, logging failures; returns the ids of those warmed."""
+    warmed = []
+    for job_dir in job_dirs:
+        try:
+            warm_job(job_dir)
+            warmed.append(os.path.basename(job_dir))
+        except Exception:
+            print(f"Warm-up of {job_dir} failed: {traceback.format_exc()}")
+    return warmed
+
+def warm_recent(limit=WARM_JOBS):
+    """Warms the most recently used jobs. Called by new server workers."""
+    return warm_jobs(recent_jobs(limit))
+
+# Views that name their job in the form instead of the URL
+FORM_JOB_VIEWS = {"search", "batch_search"}
+
+@app.before_request
+def track_job_use():
+    """Marks the job a request reads as used, so the janitor evicts the least recently used jobs."""
+    start_janitor()
+    start_metrics_flusher()
+    job_id = (request.view_args or {}).get("job_id")
+    if job_id is None and request.endpoint in FORM_JOB_VIEWS:
+        job_id = request.form.get("job_id")
+    if job_id:
+        job_dir = os.path.join(JOBS, secure_filename(job_id))
+        if os.path.isdir(job_dir):
+            janitor.touch(job_dir)
+
 # ---------------- HOME ----------------
 @app.route("/")
 def index():
@@ -27,110 +190,313 @@ def index():
 def upload():
     try:
         files = request.files.getlist("files")
+        base_job_id = request.form.get("base_job_id", "").strip() or None
         
-        if not files or all(f.filename == '' for f in files):
+        if all(f.filename == '' for f in files) and not request.form.getlist("upload_ids"):
             return jsonify({"error": "No files selected"}), 400
+
+        # Incremental runs build on a finished earlier job
+        base_dir = None
+        if base_job_id:
+            base_dir = os.path.join(JOBS, secure_filename(base_job_id))
+            base_status = jobs.read_status(base_dir)
+            if base_status is None or base_status["state"] != jobs.DONE:
+                return jsonify({"error": f"Base job {base_job_id} not found or not finished"}), 400
+            janitor.touch(base_dir)
         
+        # Files come in the request itself or as finished chunked uploads (/uploads)
+        sessions = [uploads.Session.open(u) for u in request.form.getlist("upload_ids")]
+        if None in sessions or any(not session.done for session in sessions):
+            return jsonify({"error": "Unknown or unfinished upload"}), 400
+
         # Validate file types
         for f in files:
-            if not allowed_file(f.filename):
+            if f.filename and not allowed_file(f.filename):
                 return jsonify({"error": f"Invalid file type: {f.filename}. Only .xlsx and .csv files are allowed."}), 400
         
         job_id = str(uuid.uuid4())
         job_dir = os.path.join(JOBS, job_id)
         os.makedirs(job_dir, exist_ok=True)
 
-        # Save files with secure names
+        # Each content is stored once (see uploads.py) and linked into the job
         saved_files = []
+        stored = {}
         for f in files:
             if f.filename:
                 filename = secure_filename(f.filename)
-                filepath = os.path.join(job_dir, filename)
-                f.save(filepath)
-                saved_files.append(filename)
+                digest, size = uploads.put_stream(f.stream, MAX_UPLOAD_SIZE)
+                stored[filename] = {"sha256": digest, "size": size}
+        for session in sessions:
+            stored[secure_filename(session.meta["filename"])] = {"sha256": session.meta["sha256"], "size": session.meta["size"]}
+        for filename, blob in stored.items():
+            uploads.link(blob["sha256"], job_dir, filename)
+            saved_files.append(filename)
+        uploads.record(job_dir, stored)
 
         if not saved_files:
             return jsonify({"error": "No valid files were uploaded"}), 400
 
-        # Pipeline execution with better error handling
-        pipeline = [
-            "clean_raw_data.py",
-            "merge_raw_w_etch.py", 
-            "cde_merger.py",
-            "tbl_merge.py"
-        ]
-
-        for i, script in enumerate(pipeline):
-            try:
-                result = subprocess.run(
-                    ["python", os.path.join(SCRIPTS, script)],
-                    cwd=job_dir,
-                    capture_output=True,
-                    text=True,
-                    timeout=300  # 5 minute timeout per script
-                )
-                
-                if result.returncode != 0:
-                    error_msg = f"Script {script} failed: {result.stderr}"
-                    print(f"Pipeline error: {error_msg}")
-                    print(f"Script stdout: {result.stdout}")
-                    return jsonify({
-                        "error": f"Pipeline failed at step {i+1}/{len(pipeline)}: {script}",
-                        "details": result.stderr[:500]  # Limit error message length
-                    }), 500
-                else:
-                    print(f"Script {script} completed successfully")
-                    if result.stdout:
-                        print(f"Script {script} output: {result.stdout}")
-                    if result.stderr:
-                        print(f"Script {script} warnings: {result.stderr}")
-                    
-            except subprocess.TimeoutExpired:
-                return jsonify({"error": f"Script {script} timed out after 5 minutes"}), 500
-            except Exception as e:
-                return jsonify({"error": f"Failed to execute {script}: {str(e)}"}), 500
-
-        # Verify final output exists
-        final_file = os.path.join(job_dir, "final_data.csv")
-        if not os.path.exists(final_file):
-            return jsonify({"error": "Pipeline completed but final_data.csv was not generated"}), 500
+        # Queue the pipeline and return at once, progress is polled via /jobs/<id>/status
+        jobs.mark_queued(job_dir, job_id, saved_files, base_job_id)
+        if not submit_job(job_id, job_dir, base_dir):
+            jobs.mark_failed(job_dir, "Server busy, too many pipelines queued. Please retry later.")
+            return jsonify({"error": "Server busy, too many pipelines queued. Please retry later."}), 503
 
         return jsonify({
             "job_id": job_id,
-            "download": f"/download/{job_id}/final_data.csv",
+            "status": f"/jobs/{job_id}/status",
             "files_processed": saved_files
-        })
+        }), 202
         
+    except uploads.UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Upload error: {traceback.format_exc()}")
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": f"Request larger than {MAX_CONTENT_LENGTH // 2**20} MB, "
+                             "send large files in chunks through /uploads"}), 413
+
+# ---------------- CHUNKED UPLOADS ----------------
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    filename = secure_filename(request.form.get("filename", ""))
+    try:
+        size = int(request.form.get("size", ""))
+    except ValueError:
+        return jsonify({"error": "size must be the file size in bytes"}), 400
+    if not filename or not allowed_file(filename):
+        return jsonify({"error": f"Invalid file type: {filename}. Only .xlsx and .csv files are allowed."}), 400
+    if not 0 < size <= MAX_UPLOAD_SIZE:
+        return jsonify({"error": f"File size must be between 1 byte and {MAX_UPLOAD_SIZE // 2**20} MB"}), 400
+    session = uploads.Session.create(filename, size)
+    return jsonify(dict(session.state(), chunk_size=UPLOAD_CHUNK_SIZE)), 201
+
+@app.route("/uploads/<upload_id>")
+def upload_state(upload_id):
+    session = uploads.Session.open(upload_id)
+    if session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(session.state())
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    """Appends the request body at the offset given in the Upload-Offset header."""
+    session = uploads.Session.open(upload_id)
+    if session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header missing"}), 400
+    try:
+        return jsonify(session.append(offset, request.stream))
+    except uploads.UploadError as e:
+        return jsonify(dict(session.state(), error=str(e))), 409
+
+# ---------------- JOB STATUS ----------------
+@app.route("/jobs/<job_id>/status")
+def job_status(job_id):
+    job_dir = os.path.join(JOBS, secure_filename(job_id))
+    status = jobs.read_status(job_dir)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    # The worker enforces STAGE_TIMEOUT itself; this catches a worker that died
+    # in a stage, and reports it the same way the old per-script timeout was
+    stuck = jobs.stuck_stage(status, STAGE_TIMEOUT) if status["state"] == jobs.RUNNING else None
+    if stuck:
+        status = jobs.mark_failed(job_dir, f"Script {stuck} timed out after {STAGE_TIMEOUT // 60} minutes")
+
+    status["progress"] = jobs.describe(status)
+    if status["state"] == jobs.DONE:
+        status["download"] = f"/download/{job_id}/final_data.csv"
+    return jsonify(status)
+
+# ---------------- METRICS ----------------
+def timed_search(view):
+    """
+    Records wall/CPU time, memory and result rows of every call of a
+    search view in METRICS, and buffers the record for the job's metrics
+    file (see flush_metrics()). Searches run side by side in one process,
+    so their memory figures are process-wide (see metrics.Recorder); a
+    streamed response is timed until it starts.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        recorder = metrics.Recorder("search", request.url_rule.rule, cpu_clock=time.thread_time)
+        with recorder:
+            response = app.make_response(view(*args, **kwargs))
+        recorder.record["status"] = response.status_code
+        METRICS.observe(recorder.record)
+        job_id = secure_filename((request.view_args or {}).get("job_id") or request.form.get("job_id", ""))
+        if job_id:
+            with _search_records_lock:
+                _search_records.setdefault(os.path.join(JOBS, job_id), []).append(recorder.record)
+        if not METRICS_FLUSH_INTERVAL:
+            flush_metrics()
+        return response
+    return wrapper
+
+@app.route("/jobs/<job_id>/metrics")
+def job_metrics(job_id):
+    job_dir = os.path.join(JOBS, secure_filename(job_id))
+    status = jobs.read_status(job_dir)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    flush_metrics(job_dir)
+    summary = metrics.summarize(metrics.load(job_dir))
+    summary["state"] = status["state"]
+    if status.get("finished_at") and status.get("started_at"):
+        summary["job_wall_seconds"] = round(status["finished_at"] - status["started_at"], 3)
+    return jsonify(summary)
+
+def save_metrics():
+    """Saves the totals of this process where /metrics in every server process adds them up."""
+    cache = job_cache.CACHE.stats()
+    METRICS.set(f"{metrics.PREFIX}_job_cache_bytes", "Bytes of job tables, LOT indexes and graphs loaded.", cache["bytes"])
+    METRICS.set(f"{metrics.PREFIX}_job_cache_hits", "Job cache lookups that found the job loaded.", cache["hits"])
+    METRICS.set(f"{metrics.PREFIX}_job_cache_misses", "Job cache lookups that had to load.", cache["misses"])
+    METRICS.save(os.path.join(JOBS, METRICS_DIR, f"{os.getpid()}.json"))
+
+def clear_metrics():
+    """Drops the saved totals of earlier server runs; called once when the server starts."""
+    for path in glob.glob(os.path.join(JOBS, METRICS_DIR, "*.json")):
+        os.remove(path)
+
+def flush_metrics(job_dir=None):
+    """
+    Appends the buffered search records to the metrics files of their jobs,
+    only those of job_dir if given, and saves the totals of this process.
+    """
+    with _search_records_lock:
+        if job_dir is None:
+            pending = dict(_search_records)
+            _search_records.clear()
+        else:
+            pending = {job_dir: _search_records.pop(job_dir, [])}
+    for path, records in pending.items():
+        if records and os.path.isdir(path):
+            metrics.extend(path, records)
+    save_metrics()
+
+def run_metrics_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except Exception:
+            print(f"Metrics flush error: {traceback.format_exc()}")
+
+def start_metrics_flusher():
+    """Starts the thread that flushes the search metrics once per process, on the first request."""
+    global _metrics_thread
+    with _metrics_lock:
+        if _metrics_thread is None and METRICS_FLUSH_INTERVAL:
+            _metrics_thread = threading.Thread(target=run_metrics_flusher, name="metrics", daemon=True)
+            _metrics_thread.start()
+            atexit.register(flush_metrics)
+
+@app.route("/metrics")
+def prometheus_metrics():
+    # Totals of all server processes; the job cache figures are sums over their caches
+    save_metrics()
+    totals = metrics.Registry.merged(glob.glob(os.path.join(JOBS, METRICS_DIR, "*.json")))
+    totals.set(f"{metrics.PREFIX}_pending_jobs", "Pipelines queued or running.", jobs.count_pending(JOBS))
+    return Response(totals.render(), mimetype="text/plain; version=0.0.4")
+
 # ---------------- DOWNLOAD ----------------
+def accepted_encodings():
+    """Content codings of store.ENCODINGS the client accepts."""
+    return [e for e in store.ENCODINGS if request.accept_encodings[e] > 0]
+
 @app.route("/download/<job_id>/<filename>")
 def download(job_id, filename):
     try:
         # Security: Only allow downloading from job directories
-        job_dir = os.path.join(JOBS, job_id)
-        if not os.path.exists(job_dir):
+        job_dir = os.path.join(JOBS, secure_filename(job_id))
+        if not secure_filename(job_id) or not os.path.isdir(job_dir):
             return jsonify({"error": "Job not found"}), 404
-            
-        file_path = os.path.join(job_dir, filename)
-        if not os.path.exists(file_path):
-            return jsonify({"error": "File not found"}), 404
-            
-        # Security: Ensure file is within job directory
-        if not os.path.commonpath([job_dir, file_path]) == job_dir:
+
+        # Security: Ensure file is within job directory, before anything is written there
+        file_path = os.path.join(job_dir, secure_filename(filename))
+        if filename != secure_filename(filename) or os.path.commonpath([job_dir, file_path]) != job_dir:
             return jsonify({"error": "Access denied"}), 403
-            
-        return send_from_directory(job_dir, filename, as_attachment=True)
+
+        if not os.path.exists(file_path):
+            # CSV/XLSX copies of stage outputs are only produced when asked for
+            name, _, ext = filename.rpartition(".")
+            if ext not in store.EXPORT_FORMATS or not store.exists(job_dir, name):
+                return jsonify({"error": "File not found"}), 404
+            file_path = store.export_frame(job_dir, name, ext)
+
+        # The pipeline leaves zstd/gzip copies of final_data.csv; clients that
+        # accept one get it as is. send_file answers Range and If-None-Match
+        # requests on whichever file is sent, each with its own ETag.
+        compressed = store.precompressed(file_path, accepted_encodings())
+        if compressed is None:
+            response = send_from_directory(job_dir, filename, as_attachment=True)
+        else:
+            encoding, compressed_path = compressed
+            response = send_file(compressed_path, as_attachment=True, download_name=filename,
+                                 mimetype="text/csv" if filename.endswith(".csv") else None)
+            response.headers["Content-Encoding"] = encoding
+        if store.precompressed(file_path, store.ENCODINGS) is not None:
+            response.vary.add("Accept-Encoding")
+        return response
     except Exception as e:
         return jsonify({"error": f"Download failed: {str(e)}"}), 500
 
 # ---------------- LOT SEARCH ----------------
+# Optional sync latency filters (seconds) of the search endpoints
+SYNC_FILTERS = {
+    "sync_dv_cl_min": ("sync_dv_cl", ">="),
+    "sync_dv_cl_max": ("sync_dv_cl", "<="),
+    "sync_et_dv_min": ("sync_et_dv", ">="),
+    "sync_et_dv_max": ("sync_et_dv", "<="),
+}
+
+def sync_filter_args(form):
+    """[(column, op, seconds)] for the sync filters given in form; ValueError on bad numbers."""
+    filters = []
+    for param, (column, op) in SYNC_FILTERS.items():
+        value = form.get(param, "").strip()
+        if value:
+            try:
+                filters.append((column, op, float(value)))
+            except ValueError:
+                raise ValueError(f"{param} must be a number of seconds")
+    return filters
+
+def apply_sync_filter(df, filters):
+    """Keeps the rows whose sync deltas pass every filter; rows without the delta never do."""
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        values = df[column].astype("float64").to_numpy(na_value=np.nan)
+        mask &= (values >= value) if op == ">=" else (values <= value)
+    return df[mask]
+
+def csv_attachment(df, filename):
+    """df as a CSV download, built in memory and never written to the job directory."""
+    data = df.to_csv(index=False).encode("utf-8")
+    response = Response(mimetype="text/csv")
+    if "gzip" in accepted_encodings():
+        data = gzip.compress(data, compresslevel=store.GZIP_LEVEL, mtime=0)
+        response.headers["Content-Encoding"] = "gzip"
+    response.set_data(data)
+    response.vary.add("Accept-Encoding")
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
 @app.route("/search", methods=["POST"])
+@timed_search
 def search():
     try:
-        job_id = request.form.get("job_id")
+        job_id = secure_filename(request.form.get("job_id", ""))
         lot_a = request.form.get("lot_a", "").strip()
         lot_b = request.form.get("lot_b", "").strip()
 
@@ -140,112 +506,57 @@ def search():
         if not lot_a and not lot_b:
             return jsonify({"error": "Please provide at least one LOT (A or B) to search"}), 400
 
-        final_csv_path = os.path.join(JOBS, job_id, "final_data.csv")
+        try:
+            filters = sync_filter_args(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        job_dir = os.path.join(JOBS, job_id)
 
-        if not os.path.exists(final_csv_path):
+        if not store.exists(job_dir, pipeline.FINAL):
             return jsonify({"error": "Data not found. Please run the pipeline first."}), 404
 
-        # Load and process data
-        df = pd.read_csv(final_csv_path)
-        print(f"Loaded CSV with {len(df)} rows and columns: {list(df.columns)}")
+        if filters and not {column for column, _, _ in filters} <= set(store.columns(job_dir, pipeline.FINAL)):
+            return jsonify({"error": "This job has no sync delta columns, please re-run the pipeline"}), 400
 
-        # Normalize column names
-        df.columns = df.columns.str.strip()
-
-        # Check if required columns exist
-        if "LOT A" not in df.columns and "LOT B" not in df.columns:
-            print(f"Available columns: {list(df.columns)}")
+        # Lookups go through the job's LOT index, only matching rows are read
+        index = lot_index.load_index(job_dir)
+        if not index.columns:
             return jsonify({"error": "LOT columns not found in data"}), 400
 
-        # Debug: Show original LOT values before normalization
-        if "LOT A" in df.columns:
-            print(f"Original LOT A values (first 10): {df['LOT A'].head(10).tolist()}")
-            print(f"LOT A data types: {df['LOT A'].dtype}")
-            print(f"Unique LOT A values (first 20): {sorted(df['LOT A'].dropna().unique())[:20]}")
-
-        if "LOT B" in df.columns:
-            print(f"Original LOT B values (first 10): {df['LOT B'].head(10).tolist()}")
-            print(f"LOT B data types: {df['LOT B'].dtype}")
-
-        # Normalize LOT columns if they exist
-        if "LOT A" in df.columns:
-            # Handle different data types more carefully
-            df["LOT A"] = df["LOT A"].fillna("")  # Replace NaN with empty string
-            df["LOT A"] = (
-                df["LOT A"].astype(str)
-                .str.strip()
-                .str.replace(r"\.0+$", "", regex=True)  # Remove trailing .0 or .00
-                .str.replace("nan", "", regex=False)    # Remove 'nan' strings
-            )
-            print(f"Normalized LOT A values (first 10): {df['LOT A'].head(10).tolist()}")
-
-        if "LOT B" in df.columns:
-            df["LOT B"] = df["LOT B"].fillna("")  # Replace NaN with empty string
-            df["LOT B"] = (
-                df["LOT B"].astype(str)
-                .str.strip()
-                .str.replace(r"\.0+$", "", regex=True)  # Remove trailing .0 or .00
-                .str.replace("nan", "", regex=False)    # Remove 'nan' strings
-            )
-            print(f"Normalized LOT B values (first 10): {df['LOT B'].head(10).tolist()}")
-
-        # Debug: Show what we're searching for
         print(f"Searching for - LOT A: '{lot_a}', LOT B: '{lot_b}'")
 
-        # Apply filters
-        original_count = len(df)
-        filtered_df = df.copy()  # Work with a copy to preserve original for debugging
-        
-        if lot_a and "LOT A" in df.columns:
-            # Try exact match first
-            matches = filtered_df[filtered_df["LOT A"] == lot_a]
-            print(f"Exact match for LOT A '{lot_a}': {len(matches)} records")
-            
-            # If no exact match, try case-insensitive
-            if len(matches) == 0:
-                matches = filtered_df[filtered_df["LOT A"].str.lower() == lot_a.lower()]
-                print(f"Case-insensitive match for LOT A '{lot_a}': {len(matches)} records")
-            
-            # If still no match, try partial match
-            if len(matches) == 0:
-                matches = filtered_df[filtered_df["LOT A"].str.contains(lot_a, case=False, na=False)]
-                print(f"Partial match for LOT A '{lot_a}': {len(matches)} records")
-            
-            filtered_df = matches
-
-        if lot_b and "LOT B" in df.columns:
-            # Try exact match first
-            matches = filtered_df[filtered_df["LOT B"] == lot_b]
-            print(f"Exact match for LOT B '{lot_b}': {len(matches)} records")
-            
-            # If no exact match, try case-insensitive
-            if len(matches) == 0:
-                matches = filtered_df[filtered_df["LOT B"].str.lower() == lot_b.lower()]
-                print(f"Case-insensitive match for LOT B '{lot_b}': {len(matches)} records")
-            
-            # If still no match, try partial match
-            if len(matches) == 0:
-                matches = filtered_df[filtered_df["LOT B"].str.contains(lot_b, case=False, na=False)]
-                print(f"Partial match for LOT B '{lot_b}': {len(matches)} records")
-            
-            filtered_df = matches
+        rows = None  # None = no filter applied
+        for column, lot in (("LOT A", lot_a), ("LOT B", lot_b)):
+            if lot and column in index.columns:
+                rows, kind = index.match(column, lot, within=rows)
+                print(f"{kind} match for {column} '{lot}': {len(rows)} records")
+
+        # Rows come from the memory-mapped final_data of the job cache
+        if rows is None:
+            filtered_df = job_cache.read_frame(job_dir, pipeline.FINAL)
+        else:
+            filtered_df = job_cache.read_rows(job_dir, pipeline.FINAL, rows)
+        metrics.count("rows_in", len(filtered_df))
+        filtered_df.columns = filtered_df.columns.str.strip()
+        for column in index.columns:
+            filtered_df[column] = lot_index.normalize_lots(filtered_df[column])
+
+        if filters:
+            filtered_df = apply_sync_filter(filtered_df, filters)
+            print(f"Sync filter {filters}: {len(filtered_df)} records")
 
         print(f"Final filtered results: {len(filtered_df)} records")
+        metrics.count("rows_out", len(filtered_df))
 
         if filtered_df.empty:
             search_terms = []
             if lot_a: search_terms.append(f"LOT A: {lot_a}")
             if lot_b: search_terms.append(f"LOT B: {lot_b}")
+            for column, op, value in filters: search_terms.append(f"{column} {op} {value:g}s")
             
             # Show available values for debugging
-            available_lots = []
-            if "LOT A" in df.columns:
-                unique_a = sorted([str(x) for x in df["LOT A"].dropna().unique() if str(x) and str(x) != "nan"])[:10]
-                available_lots.append(f"Available LOT A values: {unique_a}")
-            if "LOT B" in df.columns:
-                unique_b = sorted([str(x) for x in df["LOT B"].dropna().unique() if str(x) and str(x) != "nan"])[:10]
-                available_lots.append(f"Available LOT B values: {unique_b}")
-            
+            available_lots = [f"Available {column} values: {index.keys(column)[:10]}" for column in index.columns]
             print(f"No matches found. {' | '.join(available_lots)}")
             
             return jsonify({
@@ -253,58 +564,309 @@ def search():
                 "debug": available_lots
             }), 404
 
-        # Save search result
-        output_path = os.path.join(JOBS, job_id, "lot_trace_result.csv")
-        filtered_df.to_csv(output_path, index=False)
-        print(f"Saved {len(filtered_df)} records to lot_trace_result.csv")
-
-        return send_file(
-            output_path,
-            as_attachment=True,
-            download_name="lot_trace_result.csv",
-            mimetype="text/csv"
-        )
+        # The result goes out from memory, gzipped for clients that take it
+        print(f"Sending {len(filtered_df)} records as lot_trace_result.csv")
+        return csv_attachment(filtered_df, "lot_trace_result.csv")
         
     except Exception as e:
         print(f"Search error: {traceback.format_exc()}")
         return jsonify({"error": f"Search failed: {str(e)}"}), 500
 
+# ---------------- BATCH LOT TRACE ----------------
+def iter_batch_trace(job_dir, hits, missing, fmt, filters=()):
+    """
+    Yields the trace of every hit as NDJSON lines or CSV text, reading
+    final_data in chunks of about BATCH_TRACE_ROWS rows. Rows failing the
+    sync filters are left out.
+    """
+    if fmt == "ndjson":
+        found = len({lot for lot, _, _ in hits})
+        summary = {"requested": found + len(missing), "found": found, "not_found": missing}
+        yield json.dumps({"summary": summary}) + "\n"
+
+    header = True
+    columns = None
+    start = 0
+    while start < len(hits):
+        # Group lots so one read covers about BATCH_TRACE_ROWS rows
+        end, size = start, 0
+        while end < len(hits) and (end == start or size + len(hits[end][2]) <= BATCH_TRACE_ROWS):
+            size += len(hits[end][2])
+            end += 1
+        group = hits[start:end]
+        start = end
+
+        rows = np.unique(np.concatenate([r for _, _, r in group]))
+        df = job_cache.read_rows(job_dir, pipeline.FINAL, rows)
+        df.columns = df.columns.str.strip()
+        for column in lot_index.LOT_COLUMNS:
+            if column in df.columns:
+                df[column] = lot_index.normalize_lots(df[column])
+
+        parts = []
+        for lot, column, lot_rows in group:
+            part = df.iloc[np.searchsorted(rows, lot_rows)]
+            part.insert(0, "matched", column)
+            part.insert(0, "lot", lot)
+            parts.append(part)
+        chunk = pd.concat(parts, ignore_index=True)
+        columns = list(chunk.columns)
+        if filters:
+            chunk = apply_sync_filter(chunk, filters)
+            if chunk.empty:
+                continue
+
+        if fmt == "ndjson":
+            # pandas ends the lines with a newline or not depending on its version
+            yield chunk.to_json(orient="records", lines=True, date_format="iso").rstrip("\n") + "\n"
+        else:
+            yield chunk.to_csv(index=False, header=header)
+            header = False
+
+    if fmt == "csv" and missing:
+        # Lots that were not found close the CSV, one row each
+        columns = columns or ["lot", "matched"]
+        yield pd.DataFrame({"lot": missing, "matched": "not found"}, columns=columns) \
+            .to_csv(index=False, header=header)
+
+
+@app.route("/search/batch", methods=["POST"])
+@timed_search
+def batch_search():
+    try:
+        job_id = request.form.get("job_id")
+        fmt = request.form.get("format", "ndjson").lower()
+        field = request.form.get("field", "any").lower()
+
+        if not job_id:
+            return jsonify({"error": "Job ID not provided"}), 400
+        if fmt not in ("ndjson", "csv"):
+            return jsonify({"error": "format must be 'ndjson' or 'csv'"}), 400
+        if field not in ("a", "b", "any"):
+            return jsonify({"error": "field must be 'a', 'b' or 'any'"}), 400
+        try:
+            filters = sync_filter_args(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # LOTs come as a text field, an uploaded list, or both
+        lots = lot_index.parse_lots(request.form.get("lots", ""))
+        lots_file = request.files.get("lots_file")
+        if lots_file and lots_file.filename:
+            lots += lot_index.parse_lots(lots_file.read().decode("utf-8-sig", errors="replace"))
+
+        if not lots:
+            return jsonify({"error": "Please provide the LOTs to trace"}), 400
+        if len(lots) > MAX_BATCH_LOTS:
+            return jsonify({"error": f"Too many LOTs, at most {MAX_BATCH_LOTS} per request"}), 400
+
+        job_dir = os.path.join(JOBS, secure_filename(job_id))
+        if not store.exists(job_dir, pipeline.FINAL):
+            return jsonify({"error": "Data not found. Please run the pipeline first."}), 404
+
+        if filters and not {column for column, _, _ in filters} <= set(store.columns(job_dir, pipeline.FINAL)):
+            return jsonify({"error": "This job has no sync delta columns, please re-run the pipeline"}), 400
+
+        index = lot_index.load_index(job_dir)
+        if not index.columns:
+            return jsonify({"error": "LOT columns not found in data"}), 400
+
+        columns = {"a": ["LOT A"], "b": ["LOT B"], "any": None}[field]
+        hits, missing = index.resolve(lots, columns)
+        print(f"Batch trace: {len(lots)} LOTs requested, {len(missing)} not found")
+
+        headers = {"X-Lots-Not-Found": str(len(missing))}
+        if fmt == "csv":
+            headers["Content-Disposition"] = "attachment; filename=lot_trace_batch.csv"
+        return Response(
+            stream_with_context(iter_batch_trace(job_dir, hits, missing, fmt, filters)),
+            mimetype="application/x-ndjson" if fmt == "ndjson" else "text/csv",
+            headers=headers
+        )
+
+    except Exception as e:
+        print(f"Batch search error: {traceback.format_exc()}")
+        return jsonify({"error": f"Batch search failed: {str(e)}"}), 500
+
+# ---------------- LOT CATALOG ----------------
+@app.route("/lots/<path:lot>")
+def lot_jobs(lot):
+    try:
+        # Jobs deleted from disk may still be listed in the catalog
+        matches = [m for m in catalog.find_lot(lot.strip()) if os.path.isdir(os.path.join(JOBS, m["job_id"]))]
+        if not matches:
+            return jsonify({"error": f"LOT {lot} not found in any job"}), 404
+
+        return jsonify({
+            "lot": lot,
+            "jobs": len({m["job_id"] for m in matches}),
+            "matches": matches
+        })
+
+    except Exception as e:
+        print(f"Catalog lookup error: {traceback.format_exc()}")
+        return jsonify({"error": f"Catalog lookup failed: {str(e)}"}), 500
+
+# ---------------- GENEALOGY ----------------
+def genealogy_walk_args():
+    """direction, depth and kinds query parameters shared by the genealogy endpoints."""
+    direction = request.args.get("direction", "down")
+    depth = request.args.get("depth", type=int)
+    kinds = request.args.get("kinds")
+    kinds = [k.strip() for k in kinds.split(",")] if kinds else None
+    if direction not in ("down", "up", "both"):
+        raise ValueError("direction must be 'down', 'up' or 'both'")
+    if kinds and any(k not in genealogy.KINDS for k in kinds):
+        raise ValueError(f"kinds must be among {list(genealogy.KINDS)}")
+    return direction, depth, kinds
+
+def load_job_graph(job_id):
+    job_dir = os.path.join(JOBS, secure_filename(job_id))
+    if not store.exists(job_dir, pipeline.FINAL):
+        return None
+    return genealogy.load_graph(job_dir)
+
+@app.route("/jobs/<job_id>/genealogy")
+def genealogy_walk(job_id):
+    try:
+        kind = request.args.get("kind", "")
+        key = request.args.get("key", "").strip()
+        if kind not in genealogy.KINDS or not key:
+            return jsonify({"error": f"Please provide a key and a kind among {list(genealogy.KINDS)}"}), 400
+        direction, depth, kinds = genealogy_walk_args()
+
+        graph = load_job_graph(job_id)
+        if graph is None:
+            return jsonify({"error": "Data not found. Please run the pipeline first."}), 404
+        node = graph.find(kind, key)
+        if node is None:
+            return jsonify({"error": f"No {kind} '{key}' in this job"}), 404
+
+        reached = graph.walk(node, direction, depth, kinds)
+        return jsonify({
+            "node": graph.describe(node),
+            "direction": direction,
+            "nodes": [graph.describe(n, d) for n, d in sorted(reached.items(), key=lambda item: (item[1], item[0]))]
+        })
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Genealogy error: {traceback.format_exc()}")
+        return jsonify({"error": f"Genealogy lookup failed: {str(e)}"}), 500
+
+@app.route("/jobs/<job_id>/genealogy/window")
+def genealogy_window(job_id):
+    """Everything linked to the tool events in a time window, by default the LOTs that went through it."""
+    try:
+        tool = request.args.get("tool", "etcher")
+        start = request.args.get("start")
+        end = request.args.get("end")
+        if tool not in genealogy.EVENTS or not start or not end:
+            return jsonify({"error": f"Please provide start, end and a tool among {genealogy.EVENTS}"}), 400
+        if "direction" not in request.args and "kinds" not in request.args:
+            direction, depth, kinds = "up", None, ["lot_a", "lot_b"]
+        else:
+            direction, depth, kinds = genealogy_walk_args()
+
+        graph = load_job_graph(job_id)
+        if graph is None:
+            return jsonify({"error": "Data not found. Please run the pipeline first."}), 404
+
+        events = graph.in_window(tool, start, end)
+        reached = graph.walk(events, direction, depth, kinds) if len(events) else {}
+        return jsonify({
+            "tool": tool,
+            "start": start,
+            "end": end,
+            "events": len(events),
+            "nodes": [graph.describe(n, d) for n, d in sorted(reached.items(), key=lambda item: (item[1], item[0]))]
+        })
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Genealogy error: {traceback.format_exc()}")
+        return jsonify({"error": f"Genealogy lookup failed: {str(e)}"}), 500
+
+# ---------------- LOT TYPEAHEAD ----------------
+@app.route("/jobs/<job_id>/lots")
+@timed_search
+def lot_suggestions(job_id):
+    try:
+        column = {"a": "LOT A", "b": "LOT B"}.get(request.args.get("field", "").lower())
+        query = request.args.get("q", "").strip()
+        limit = min(request.args.get("limit", 10, type=int), 50)
+
+        if column is None:
+            return jsonify({"error": "field must be 'a' or 'b'"}), 400
+
+        job_dir = os.path.join(JOBS, secure_filename(job_id))
+        if not store.exists(job_dir, pipeline.FINAL):
+            return jsonify({"error": "Data not found. Please run the pipeline first."}), 404
+
+        lots = lot_index.load_index(job_dir).suggest(column, query, limit) if query else []
+        return jsonify({"field": column, "q": query, "lots": lots})
+
+    except Exception as e:
+        print(f"Typeahead error: {traceback.format_exc()}")
+        return jsonify({"error": f"Typeahead failed: {str(e)}"}), 500
+
 
 # ---------------- DEBUG ENDPOINT ----------------
 @app.route("/debug/<job_id>")
 def debug_data(job_id):
     try:
-        final_csv_path = os.path.join(JOBS, job_id, "final_data.csv")
-        
-        if not os.path.exists(final_csv_path):
-            return jsonify({"error": "final_data.csv not found"}), 404
-            
-        df = pd.read_csv(final_csv_path)
-        
-        # Get basic info
-        info = {
-            "total_rows": len(df),
-            "columns": list(df.columns),
-            "sample_data": df.head(5).to_dict('records')
-        }
-        
-        # Get LOT A and LOT B info if they exist
-        if "LOT A" in df.columns:
-            lot_a_values = df["LOT A"].dropna().unique()[:20]  # First 20 unique values
-            info["lot_a_sample"] = [str(x) for x in lot_a_values]
-            info["lot_a_count"] = len(df["LOT A"].dropna().unique())
-            
-        if "LOT B" in df.columns:
-            lot_b_values = df["LOT B"].dropna().unique()[:20]  # First 20 unique values
-            info["lot_b_sample"] = [str(x) for x in lot_b_values]
-            info["lot_b_count"] = len(df["LOT B"].dropna().unique())
-            
-        return jsonify(info)
-        
+        job_dir = os.path.join(JOBS, secure_filename(job_id))
+
+        if not store.exists(job_dir, pipeline.FINAL):
+            return jsonify({"error": "final_data not found"}), 404
+
+        # Written by the pipeline (see manifest.py), final_data is not read here
+        return jsonify(manifest.load_manifest(job_dir, pipeline.FINAL))
+
     except Exception as e:
         return jsonify({"error": f"Debug failed: {str(e)}"}), 500
 
+# ---------------- HEALTH ----------------
+@app.route("/health")
+def health():
+    """Liveness for load balancers; 503 when jobs/ cannot be written."""
+    info = {
+        "status": "ok",
+        "pid": os.getpid(),
+        "pending_jobs": jobs.count_pending(JOBS),
+        "janitor": _janitor_thread is not None and _janitor_thread.is_alive(),
+        "job_cache": job_cache.CACHE.stats(),
+    }
+    if not os.access(JOBS, os.W_OK):
+        info["status"] = "unavailable"
+        info["error"] = f"{JOBS} is not writable"
+        return jsonify(info), 503
+    return jsonify(info)
+
+@app.route("/warmup", methods=["POST"])
+def warmup():
+    """Loads the given job, or the WARM_JOBS most recently used ones, into this process's job cache."""
+    try:
+        job_id = request.form.get("job_id") or request.args.get("job_id")
+        started = time.perf_counter()
+        if job_id:
+            job_dir = os.path.join(JOBS, secure_filename(job_id))
+            if not store.exists(job_dir, pipeline.FINAL):
+                return jsonify({"error": "Data not found. Please run the pipeline first."}), 404
+            warm_job(job_dir)
+            warmed = [os.path.basename(job_dir)]
+        else:
+            warmed = warm_recent()
+        return jsonify({"warmed": warmed, "seconds": round(time.perf_counter() - started, 3),
+                        "job_cache": job_cache.CACHE.stats()})
+    except Exception as e:
+        print(f"Warm-up error: {traceback.format_exc()}")
+        return jsonify({"error": f"Warm-up failed: {str(e)}"}), 500
+
 # ---------------- RUN ----------------
 if __name__ == "__main__":
+    clear_metrics()
     app.run(debug=True)
 
@@ -0,0 +1,45 @@
+"""
+Production server settings, read by gunicorn from the working directory:
+
+    gunicorn app:app
+
+The app, pandas and the pipeline stage modules are imported once in the
+master before it forks the workers (preload_app), so workers start warm and
+share those pages. Each worker serves requests on a few threads and keeps
+its own job cache; the job tables in it are memory-mapped files that all
+workers share (see scripts/job_cache.py). A new worker loads the most
+recently used jobs before it takes requests.
+
+PIPELINE_WORKERS and MAX_PENDING_JOBS in app.py hold for all workers
+together, through lock and marker files in jobs/ (see scripts/jobs.py), and
+/metrics adds up the totals every worker saves to jobs/.metrics.
+JOB_CACHE_BYTES is a limit per worker.
+
+LOT_TRACE_BIND, LOT_TRACE_WORKERS and LOT_TRACE_THREADS override the
+defaults below.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("LOT_TRACE_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("LOT_TRACE_WORKERS", min(multiprocessing.cpu_count(), 4)))
+worker_class = "gthread"
+threads = int(os.environ.get("LOT_TRACE_THREADS", 4))
+preload_app = True
+timeout = 300  # large downloads and batch traces stream for a while
+graceful_timeout = 60
+max_requests = 0  # workers keep their job cache for their whole life
+accesslog = "-"
+
+
+def when_ready(server):
+    import app
+    import pipeline
+    pipeline.preload()
+    app.clear_metrics()
+
+
+def post_worker_init(worker):
+    import app
+    warmed = app.warm_recent()
+    worker.log.info("Worker %s warmed jobs %s", worker.pid, warmed)
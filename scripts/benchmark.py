@@ -0,0 +1,271 @@
+"""
+Benchmark harness for the pipeline and /search.
+
+For each size (cleaner events; the other inputs scale with it, see
+plan()) a synthetic job is generated with synthetic.py. The harness then:
+
+- runs the pipeline on it with an empty stage cache and takes the stage
+  records run_pipeline() writes (wall/CPU time, peak RSS, rows, join
+  fan-out; see metrics.py);
+- times the two window joins on their own, on the stage outputs, so a
+  regression in joins.py shows apart from the I/O around it;
+- times a series of /search calls through the app, the first one cold.
+
+Results are saved as JSON, one entry per size, and can be compared with an
+earlier file; the run fails when a timing got slower than the tolerance:
+
+    python benchmark.py --sizes 10000 100000 --out base.json
+    python benchmark.py --sizes 10000 100000 --out new.json --compare base.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import catalog
+import incremental
+import job_cache
+import joins
+import lot_index
+import metrics
+import pipeline
+import store
+import synthetic
+import tbl_merge
+import uploads
+
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+MAX_LOTS = 20_000  # the 6h join output grows with the LOTs times the events in 6h
+SEARCHES = 50
+TOLERANCE = 0.2  # slowdown that counts as a regression
+NOISE_SECONDS = 0.05  # differences below this are never regressions
+
+
+def plan(size, seed=0):
+    """synthetic.generate() arguments for a size."""
+    return {"lots": min(max(size // 50, 100), MAX_LOTS), "events": size, "events_per_minute": 1.0,
+            "developer_rate": 0.9, "etcher_rate": 0.85, "batch_rate": 0.8, "seed": seed}
+
+
+def inputs(data_dir, size, seed=0):
+    """Directory with the generated upload files of a size, generated once per arguments."""
+    args = plan(size, seed)
+    out = os.path.join(data_dir, f"{size}-{seed}")
+    params = os.path.join(out, "params.json")
+    try:
+        with open(params) as f:
+            if json.load(f)["args"] == args:
+                return out
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    shutil.rmtree(out, ignore_errors=True)
+    print(f"Generating {size} events...")
+    rows = synthetic.generate(out, **args)
+    with open(params, "w") as f:
+        json.dump({"args": args, "rows": rows}, f, indent=2)
+    return out
+
+
+def _job(source, jobs_dir, name):
+    """A fresh job directory with the upload files of source linked in."""
+    job_dir = os.path.join(jobs_dir, name)
+    shutil.rmtree(job_dir, ignore_errors=True)
+    os.makedirs(job_dir)
+    for filename in os.listdir(source):
+        if filename.endswith((".csv", ".xlsx")):
+            try:
+                os.link(os.path.join(source, filename), os.path.join(job_dir, filename))
+            except OSError:  # data dir on another file system
+                shutil.copy2(os.path.join(source, filename), os.path.join(job_dir, filename))
+    return job_dir
+
+
+def _stage_result(record):
+    return {
+        "wall_seconds": record["wall_seconds"],
+        "cpu_seconds": record["cpu_seconds"],
+        "peak_rss_bytes": record["peak_rss_bytes"],
+        "rows_in": record["counts"].get("rows_in", 0),
+        "rows_out": record["counts"].get("rows_out", 0),
+        "joins": record["joins"],
+    }
+
+
+def run_pipeline(job_dir):
+    """Runs the pipeline without cache hits; returns (wall seconds, {stage: result})."""
+    cache_dir = tempfile.mkdtemp(prefix="bench-cache-")
+    try:
+        started = time.perf_counter()
+        pipeline.run_pipeline(job_dir, cache_dir=cache_dir)
+        wall = time.perf_counter() - started
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    stages = {r["name"]: _stage_result(r) for r in metrics.load(job_dir) if r["kind"] == "stage"}
+    return round(wall, 6), stages
+
+
+def time_joins(job_dir):
+    """Times the two window joins alone on the job's stored inputs and outputs."""
+    state_dir = os.path.join(job_dir, incremental.STATE_DIR)
+    cleaner = store.read_frame(state_dir, "CL_Cleaner")
+    developer = store.read_frame(state_dir, "CL_Developer")
+    sync = store.read_frame(job_dir, "final_sequential_sync")
+    batches = store.read_frame(job_dir, "final_combined_data_raw_etch")
+    batches["Created"] = pd.to_datetime(batches["Created"])
+
+    results = {}
+    with metrics.Recorder("join", "forward_window_join", reset_peak=True) as recorder:
+        joins.forward_window_join(cleaner, developer, "timestamp_cleaner", "timestamp_developer", "60s", "_dv")
+    results["forward_window_join"] = _stage_result(recorder.record)
+    with metrics.Recorder("join", "iter_window_join", reset_peak=True) as recorder:
+        for chunk in tbl_merge.iter_expand_merge_6h(batches, sync, "Created", "timestamp_etcher",
+                                                    pipeline.MAX_JOIN_MEMORY_MB):
+            metrics.count("rows_out", len(chunk))
+    results["iter_window_join"] = _stage_result(recorder.record)
+    return results
+
+
+def time_searches(job_dir, searches=SEARCHES, seed=0):
+    """
+    Times `searches` exact LOT A searches through the app; the first runs on
+    a cold job cache. The app works in the benchmark's jobs directory only,
+    without its janitor.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    app.JOBS = os.path.dirname(job_dir)
+    app.JANITOR_INTERVAL = 0
+    uploads.BLOB_DIR = os.path.join(app.JOBS, "blobs")
+    catalog.CATALOG_PATH = os.path.join(app.JOBS, "catalog.sqlite3")
+    client = app.app.test_client()
+    job_cache.CACHE.clear()
+    lots = lot_index.load_index(job_dir).keys("LOT A")
+    job_cache.CACHE.clear()
+    rng = np.random.default_rng(seed)
+    for lot in rng.choice(lots, min(searches, len(lots)), replace=False):
+        client.post("/search", data={"job_id": os.path.basename(job_dir), "lot_a": lot})
+
+    walls = [r["wall_seconds"] for r in metrics.load(job_dir) if r["kind"] == "search"]
+    if not walls:
+        return {}
+    warm = sorted(walls[1:]) or walls
+    return {
+        "searches": len(walls),
+        "cold_seconds": walls[0],
+        "p50_seconds": warm[len(warm) // 2],
+        "p95_seconds": warm[min(int(0.95 * len(warm)), len(warm) - 1)],
+        "max_seconds": warm[-1],
+    }
+
+
+def _meta():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        rev = None
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git": rev,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run(sizes, data_dir, searches=SEARCHES, seed=0):
+    """Benchmarks every size; returns the results document."""
+    results = []
+    jobs_dir = tempfile.mkdtemp(prefix="bench-jobs-")
+    try:
+        for size in sizes:
+            source = inputs(data_dir, size, seed)
+            job_dir = _job(source, jobs_dir, f"bench-{size}")
+            print(f"Benchmarking {size} events...")
+            wall, stages = run_pipeline(job_dir)
+            with open(os.path.join(source, "params.json")) as f:
+                params = json.load(f)
+            results.append({
+                "size": size,
+                "inputs": params["rows"],
+                "lots": params["args"]["lots"],
+                "pipeline_wall_seconds": wall,
+                "stages": stages,
+                "joins": time_joins(job_dir),
+                "search": time_searches(job_dir, searches, seed),
+            })
+            shutil.rmtree(job_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(jobs_dir, ignore_errors=True)
+    return {"meta": _meta(), "results": results}
+
+
+def _timings(result):
+    """(name, seconds) of every timing of a result that compare() looks at."""
+    yield "pipeline", result["pipeline_wall_seconds"]
+    for group in ("stages", "joins"):
+        for name, timing in result[group].items():
+            yield f"{group[:-1]} {name}", timing["wall_seconds"]
+    for key in ("cold_seconds", "p95_seconds"):
+        if key in result["search"]:
+            yield f"search {key.replace('_seconds', '')}", result["search"][key]
+
+
+def compare(new, old, tolerance=TOLERANCE):
+    """
+    Prints the timings of new next to those of old for the sizes both
+    have. Returns the regressions as (size, name, old, new).
+    """
+    old_results = {r["size"]: r for r in old["results"]}
+    regressions = []
+    print(f"{'size':>10}  {'timing':<32} {'old s':>9} {'new s':>9} {'ratio':>6}")
+    for result in new["results"]:
+        if result["size"] not in old_results:
+            continue
+        before = dict(_timings(old_results[result["size"]]))
+        for name, seconds in _timings(result):
+            if name not in before:
+                continue
+            ratio = seconds / before[name] if before[name] else float("inf")
+            slower = seconds > before[name] * (1 + tolerance) and seconds - before[name] > NOISE_SECONDS
+            if slower:
+                regressions.append((result["size"], name, before[name], seconds))
+            print(f"{result['size']:>10}  {name:<32} {before[name]:>9.3f} {seconds:>9.3f} {ratio:>6.2f}"
+                  f"{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline and /search on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="cleaner events per benchmark")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "lot-trace-bench"),
+                        help="where generated inputs are kept between runs")
+    parser.add_argument("--searches", type=int, default=SEARCHES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=f"benchmark-{datetime.date.today()}.json")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    document = run(args.sizes, args.data_dir, args.searches, args.seed)
+    with open(args.out, "w") as f:
+        json.dump(document, f, indent=2)
+    print(f"Results written to {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            found = compare(document, json.load(f), args.tolerance)
+        if found:
+            print(f"{len(found)} timings regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
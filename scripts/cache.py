@@ -0,0 +1,109 @@
+"""
+Content-addressed cache of pipeline stage outputs.
+
+An entry is a directory cache/<key>/ holding the files one stage wrote,
+where the key hashes the stage's code and the content of everything it
+read. Entries are shared by all jobs; the least recently used ones are
+evicted once the cache grows past its size limit.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache")
+MAX_BYTES = 2 * 1024 ** 3  # 2 GiB
+
+
+def make_key(*parts):
+    """sha256 over the given strings, in order."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def code_version(*modules):
+    """Hash of the source files of the given modules, so edits invalidate their entries."""
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _link(src, dst):
+    """Hard links src to dst (copies across file systems), replacing dst."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def restore(key, job_dir, files, cache_dir=None):
+    """
+    Links the cached files of entry `key` into job_dir. Returns False on a
+    miss (including an entry evicted while it was being read).
+    """
+    entry = os.path.join(cache_dir or CACHE_DIR, key)
+    try:
+        for rel in files:
+            _link(os.path.join(entry, rel), os.path.join(job_dir, rel))
+        os.utime(entry)  # mark as recently used
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def put(key, job_dir, files, cache_dir=None, max_bytes=None):
+    """Stores the files a stage wrote to job_dir under `key` and evicts old entries."""
+    cache_dir = cache_dir or CACHE_DIR
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(entry):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}.tmp")
+    for rel in files:
+        _link(os.path.join(job_dir, rel), os.path.join(tmp, rel))
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another worker stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict(cache_dir, max_bytes)
+
+
+def _entry_size(entry):
+    total = 0
+    for root, _, names in os.walk(entry):
+        for name in names:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def evict(cache_dir=None, max_bytes=None):
+    """Removes least recently used entries until the cache fits in max_bytes."""
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(path):
+            continue
+        try:
+            entries.append((os.path.getmtime(path), _entry_size(path), path))
+        except FileNotFoundError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        print(f"Cache: evicted {os.path.basename(path)} ({size} bytes)")
+
@@ -0,0 +1,135 @@
+"""
+Cross-job LOT catalog.
+
+A single SQLite database that every finished job adds its LOTs to: per job,
+column and normalized LOT the Melt_IDs, the Date range and the row offsets
+in that job's final_data. /lots/<lot> answers "which jobs saw this lot"
+with one indexed lookup instead of opening every job.
+"""
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import lot_index
+import store
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jobs", "catalog.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id   TEXT PRIMARY KEY,
+    rows     INTEGER NOT NULL,
+    added_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lots (
+    lot        TEXT NOT NULL,
+    lot_lower  TEXT NOT NULL,
+    field      TEXT NOT NULL,
+    job_id     TEXT NOT NULL REFERENCES jobs(job_id) ON DELETE CASCADE,
+    melt_ids   TEXT NOT NULL,
+    first_date TEXT,
+    last_date  TEXT,
+    rows       INTEGER NOT NULL,
+    offsets    BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lots_by_lot ON lots (lot_lower);
+CREATE INDEX IF NOT EXISTS lots_by_job ON lots (job_id);
+"""
+
+
+def connect(path=None):
+    """Opens the catalog, creating it on first use. Safe for several worker processes."""
+    path = path or CATALOG_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _entries(job_id, df):
+    """One catalog row per (column, LOT) of a job's final_data."""
+    lots = [c for c in lot_index.LOT_COLUMNS if c in df]
+    melt = df["Melt_ID"].astype(str).where(df["Melt_ID"].notna()) if "Melt_ID" in df else None
+    dates = pd.to_datetime(df["Date"], errors="coerce") if "Date" in df else None
+
+    for column in lots:
+        keys = lot_index.normalize_lots(df[column]).to_numpy()
+        rows = np.flatnonzero(keys != "")
+        for key, group in pd.Series(rows).groupby(keys[rows], sort=False):
+            offsets = group.to_numpy(dtype="int64")
+            melt_ids = "" if melt is None else ",".join(sorted(melt.iloc[offsets].dropna().unique()))
+            first = last = None
+            if dates is not None and dates.iloc[offsets].notna().any():
+                first = dates.iloc[offsets].min().isoformat()
+                last = dates.iloc[offsets].max().isoformat()
+            yield (key, key.lower(), column, job_id, melt_ids, first, last, len(offsets), offsets.tobytes())
+
+
+def add_job(job_dir, name="final_data", path=None):
+    """Adds (or replaces) a finished job's LOTs in the catalog."""
+    job_id = os.path.basename(os.path.normpath(job_dir))
+    present = set(store.columns(job_dir, name))
+    columns = [c for c in lot_index.LOT_COLUMNS + ["Melt_ID", "Date"] if c in present]
+    df = store.read_frame(job_dir, name, columns=columns)
+    entries = list(_entries(job_id, df))
+
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            conn.execute("INSERT INTO jobs (job_id, rows, added_at) VALUES (?, ?, ?)", (job_id, len(df), time.time()))
+            conn.executemany("INSERT INTO lots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+    finally:
+        conn.close()
+    print(f"Catalog: added {len(entries)} LOT entries of job {job_id}")
+    return len(entries)
+
+
+def remove_job(job_id, path=None):
+    """Drops a job from the catalog, e.g. when its directory is deleted."""
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+    finally:
+        conn.close()
+
+
+def find_lot(lot, path=None):
+    """
+    Every job and row where the normalized LOT occurs in LOT A or LOT B,
+    ignoring case, newest job first.
+    """
+    key = lot_index.normalize_lot(lot)
+    conn = connect(path)
+    try:
+        cur = conn.execute(
+            "SELECT l.lot, l.field, l.job_id, l.melt_ids, l.first_date, l.last_date, l.rows, l.offsets, j.added_at "
+            "FROM lots l JOIN jobs j ON j.job_id = l.job_id "
+            "WHERE l.lot_lower = ? ORDER BY j.added_at DESC, l.field",
+            (key.lower(),),
+        )
+        return [{
+            "job_id": job_id,
+            "lot": found,
+            "field": field,
+            "melt_ids": melt_ids.split(",") if melt_ids else [],
+            "first_date": first,
+            "last_date": last,
+            "rows": rows,
+            "row_offsets": np.frombuffer(offsets, dtype="int64").tolist(),
+        } for found, field, job_id, melt_ids, first, last, rows, offsets, _ in cur]
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # Backfill: python catalog.py jobs/<uuid> [jobs/<uuid> ...]
+    for job_dir in sys.argv[1:]:
+        add_job(job_dir)
@@ -1,83 +1,108 @@
 import pandas as pd
 
-# --- 1. Load Data ---
-df_cl = pd.read_csv("CL_Cleaner.csv")
-df_dv = pd.read_csv("CL_Developer.csv")
-df_et = pd.read_csv("CL_Etcher4.csv")
+import joins
+import store
+import tool_logs
 
-# Rename and convert to datetime
-df_cl = df_cl.rename(columns={'TimeStamp': 'timestamp_cleaner'})
-df_dv = df_dv.rename(columns={'TimeStamp': 'timestamp_developer'})
-df_et = df_et.rename(columns={'TimeStamp': 'timestamp_etcher'})
+# Dev-Cl and Et-Dv deltas in seconds, missing where a tool had no match
+SYNC_COLUMNS = ['sync_dv_cl', 'sync_et_dv']
 
-for df, col in zip([df_cl, df_dv, df_et], ['timestamp_cleaner', 'timestamp_developer', 'timestamp_etcher']):
-    df[col] = pd.to_datetime(df[col])
-    df.sort_values(col, inplace=True)
 
 def merge_sequential_farthest(left_df, right_df, left_col, right_col, suffix):
     """
-    Finds the farthest record that occurs AFTER the previous step 
+    Finds the farthest record that occurs AFTER the previous step
     but within a 1-minute window. Uses left join to preserve all left records.
     """
-    left_df['bin'] = left_df[left_col].dt.floor('1min')
-    right_df['bin'] = right_df[right_col].dt.floor('1min')
-
-    # Since it's sequential, we only need the current bin and the NEXT bin
-    right_shifted = right_df.copy().assign(bin=right_df['bin'] - pd.Timedelta(minutes=1))
-    right_pool = pd.concat([right_df, right_shifted])
-
-    # Use left join to preserve all records from left_df
-    merged = pd.merge(left_df, right_pool, on='bin', how='left', suffixes=('', suffix))
-    
-    # For records that have matches, apply the timing filter
-    has_match = merged[right_col].notna()
-    
-    if has_match.any():
-        # CRITICAL: Only keep rows where the next process happened AFTER the current one
-        merged.loc[has_match, 'diff_seconds'] = (merged.loc[has_match, right_col] - merged.loc[has_match, left_col]).dt.total_seconds()
-        
-        # Filter: Must be between 0 and 60 seconds ahead (only for matched records)
-        valid_timing = (merged['diff_seconds'] > 0) & (merged['diff_seconds'] <= 60)
-        
-        # Keep records that either have valid timing OR have no match (preserve unmatched)
-        keep_mask = valid_timing | merged[right_col].isna()
-        merged = merged[keep_mask]
-        
-        # For records with multiple valid matches, take the largest difference (farthest in the future)
-        if 'diff_seconds' in merged.columns:
-            merged = merged.sort_values('diff_seconds', ascending=False, na_position='last').drop_duplicates(subset=[left_col])
-    
-    # Cleanup
-    columns_to_drop = ['bin']
-    if 'diff_seconds' in merged.columns:
-        columns_to_drop.append('diff_seconds')
-    
-    return merged.drop(columns=columns_to_drop, errors='ignore')
-
-# --- 2. Execute Sequential Merge ---
-print("Syncing: Cleaner -> Developer (Forward only, preserving all cleaner records)...")
-df_final = merge_sequential_farthest(df_cl, df_dv, 'timestamp_cleaner', 'timestamp_developer', '_dv')
-print(f"After Cleaner->Developer: {len(df_final)} records (from {len(df_cl)} cleaner records)")
-
-print("Syncing: Developer -> Etcher (Forward only, preserving all records)...")
-df_final = merge_sequential_farthest(df_final, df_et, 'timestamp_developer', 'timestamp_etcher', '_et')
-print(f"After Developer->Etcher: {len(df_final)} records")
-
-# --- 3. Calculate Sync Data Tuples ---
-# Format: (Dev-Cl, Et-Dv) -> Both should now be positive seconds
-diff_dv_cl = (df_final['timestamp_developer'] - df_final['timestamp_cleaner']).dt.total_seconds()
-diff_et_dv = (df_final['timestamp_etcher'] - df_final['timestamp_developer']).dt.total_seconds()
-
-df_final['sync_data'] = list(zip(diff_dv_cl.fillna('null'), diff_et_dv.fillna('null')))
-
-# --- 4. Reorganize ---
-cols = ['sync_data'] + [c for c in df_final.columns if c != 'sync_data']
-df_final = df_final[cols]
-
-# --- 5. Export ---
-df_final.to_csv("final_sequential_sync.csv", index=False)
-print(f"\nDone! All differences in sync_data should now be positive (Forward Time).")
-print(f"Total records preserved: {len(df_final)}")
-records_with_full_sync = df_final.dropna(subset=['timestamp_developer', 'timestamp_etcher']).shape[0]
-print(f"Records with complete sync chain: {records_with_full_sync}")
-print(f"Records with partial/no sync: {len(df_final) - records_with_full_sync}")
\ No newline at end of file
+    return joins.forward_window_join(left_df, right_df, left_col, right_col, '60s', suffix)
+
+
+def prepare_tool_logs(df_cl, df_dv, df_et):
+    """
+    Renames each log's 'TimeStamp' to timestamp_<tool>, parses it and sorts
+    the log by it. Returns the three prepared frames.
+    """
+    # Rename and convert to datetime
+    df_cl = df_cl.rename(columns={'TimeStamp': 'timestamp_cleaner'})
+    df_dv = df_dv.rename(columns={'TimeStamp': 'timestamp_developer'})
+    df_et = df_et.rename(columns={'TimeStamp': 'timestamp_etcher'})
+
+    for df, col in zip([df_cl, df_dv, df_et], ['timestamp_cleaner', 'timestamp_developer', 'timestamp_etcher']):
+        df[col] = tool_logs.parse_timestamps(df[col])
+        df.sort_values(col, inplace=True, kind='stable')
+
+    return df_cl, df_dv, df_et
+
+
+def _with_deltas(df_final):
+    """Adds the sync delta columns and moves them to the front."""
+    # --- 3. Calculate Sync Deltas ---
+    # Dev-Cl and Et-Dv -> Both should now be positive seconds
+    df_final['sync_dv_cl'] = (df_final['timestamp_developer'] - df_final['timestamp_cleaner']).dt.total_seconds().astype('Float32')
+    df_final['sync_et_dv'] = (df_final['timestamp_etcher'] - df_final['timestamp_developer']).dt.total_seconds().astype('Float32')
+
+    # --- 4. Reorganize ---
+    cols = SYNC_COLUMNS + [c for c in df_final.columns if c not in SYNC_COLUMNS]
+    return df_final[cols]
+
+
+def sync_prepared_logs(df_cl, df_dv, df_et):
+    """
+    Chains already prepared Cleaner, Developer and Etcher4 logs forward in
+    time and adds the Dev-Cl and Et-Dv deltas in seconds as the nullable
+    float32 columns 'sync_dv_cl' and 'sync_et_dv'.
+    """
+    # --- 2. Execute Sequential Merge ---
+    print("Syncing: Cleaner -> Developer (Forward only, preserving all cleaner records)...")
+    df_final = merge_sequential_farthest(df_cl, df_dv, 'timestamp_cleaner', 'timestamp_developer', '_dv')
+    print(f"After Cleaner->Developer: {len(df_final)} records (from {len(df_cl)} cleaner records)")
+
+    print("Syncing: Developer -> Etcher (Forward only, preserving all records)...")
+    df_final = merge_sequential_farthest(df_final, df_et, 'timestamp_developer', 'timestamp_etcher', '_et')
+    print(f"After Developer->Etcher: {len(df_final)} records")
+
+    df_final = _with_deltas(df_final)
+
+    print("\nDone! All sync deltas should now be positive (Forward Time).")
+    print(f"Total records preserved: {len(df_final)}")
+    records_with_full_sync = df_final.dropna(subset=['timestamp_developer', 'timestamp_etcher']).shape[0]
+    print(f"Records with complete sync chain: {records_with_full_sync}")
+    print(f"Records with partial/no sync: {len(df_final) - records_with_full_sync}")
+
+    return df_final
+
+
+def iter_sync_sorted_logs(cl_chunks, dv_chunks, et_chunks):
+    """
+    sync_prepared_logs() over the prepared logs as streams of sorted chunks
+    (see tool_logs.py). Yields the synced rows chunk by chunk, holding only
+    the developer and etcher rows inside the windows of the current chunk.
+    """
+    print("Syncing: Cleaner -> Developer -> Etcher (Forward only, streamed)...")
+    synced = joins.iter_forward_window_join(cl_chunks, dv_chunks, 'timestamp_cleaner', 'timestamp_developer', '60s', '_dv')
+    synced = joins.iter_forward_window_join(synced, et_chunks, 'timestamp_developer', 'timestamp_etcher', '60s', '_et')
+    total = complete = 0
+    for chunk in synced:
+        total += len(chunk)
+        complete += chunk[['timestamp_developer', 'timestamp_etcher']].notna().all(axis=1).sum()
+        yield _with_deltas(chunk)
+    print(f"Total records preserved: {total}")
+    print(f"Records with complete sync chain: {complete}")
+    print(f"Records with partial/no sync: {total - complete}")
+
+
+def sync_tool_logs(df_cl, df_dv, df_et):
+    """
+    Chains the Cleaner, Developer and Etcher4 logs forward in time and adds
+    the Dev-Cl and Et-Dv deltas in seconds (see sync_prepared_logs()).
+    """
+    return sync_prepared_logs(*prepare_tool_logs(df_cl, df_dv, df_et))
+
+
+if __name__ == "__main__":
+    # --- 1. Load Data ---
+    df_cl = pd.read_csv("CL_Cleaner.csv")
+    df_dv = pd.read_csv("CL_Developer.csv")
+    df_et = pd.read_csv("CL_Etcher4.csv")
+
+    # --- 5. Export ---
+    store.write_frame(".", "final_sequential_sync", sync_tool_logs(df_cl, df_dv, df_et))
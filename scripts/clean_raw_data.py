@@ -1,69 +1,89 @@
 import pandas as pd
 
-# --- 1. Load Data ---
-df = pd.read_excel("raw_data.xlsx")
+import incremental
+import store
+import workbook
 
-# --- 2. Extract Metadata & Initial Drops ---
-supplier_name = df.iloc[1, 1] 
+# Sheet columns the cleaning uses: Date to the last element spec (B:AA) and
+# the inspection columns on the far right. Column A only holds the
+# "Material - supplier CoA" title and AB:DB are unused, so neither is read.
+USECOLS = "B:AA,DC:"
 
-# Drop metadata rows and columns early to reduce memory usage
-df = df.drop("Material - supplier CoA", axis=1)
-df = df.drop(df.columns[26:105], axis=1) # Drop wide range of Unnamed columns
-df = df.drop(df.index[[0, 1, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13]])
 
-# --- 3. Header Repair (Merging Rows 2 and 3) ---
-# We align the labels before promoting them to the header
-row2 = df.loc[2].values.copy()
-row3 = df.loc[3].values.copy()
-start_col = 7
+def load_raw_data(path="raw_data.xlsx", digest=None, cache_dir=None):
+    """
+    Reads the used columns of the supplier CoA workbook (see workbook.py),
+    from the converted-sheet cache when the same workbook was read before.
+    """
+    return workbook.load_sheet(path, USECOLS, digest or incremental.file_digest(path), cache_dir)
 
-row2[start_col:] = row3[start_col:]
-df.loc[2] = row2
 
-# Drop the redundant Row 3 and the empty column at index 6
-df = df.drop(index=3)
-df = df.drop(df.columns[6], axis=1)
+def clean_raw_data(df):
+    """
+    Repairs the two-row header of the supplier workbook, drops the metadata
+    rows and the empty spacer column, and keeps only valid LOT rows.
+    """
+    # --- 2. Extract Metadata & Initial Drops ---
+    supplier_name = df.at[1, "Unnamed: 1"]
 
-# --- 4. Column Label Refinement (Min/Max Suffixes) ---
-# Loop through the Unnamed pairs to create descriptive headers
-for i in range(15, 26, 2):
-    col_current = f'Unnamed: {i}'
-    col_next = f'Unnamed: {i+1}'
-    
-    base_label = df.at[2, col_current]
-    df.at[2, col_current] = f"{base_label}-min"
-    df.at[2, col_next] = f"{base_label}-max"
+    # The unused columns were never read (USECOLS); drop the metadata rows
+    df = df.drop(df.index[[0, 1, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13]])
 
-# Set the refined Row 2 as the actual DataFrame columns
-df.columns = df.loc[2]
-df = df.drop(index=2) # Drop the row used as header
-df = df.reset_index(drop=True)
+    # --- 3. Header Repair (Merging Rows 2 and 3) ---
+    # The labels are aligned in a list, so the typed data columns below
+    # the header are never written to
+    start_col = 7
+    labels = list(df.loc[2].values[:start_col]) + list(df.loc[3].values[start_col:])
 
-# --- 5. Data Cleaning & Filtering ---
-# Step A: Standardize Date column
-df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
+    # --- 4. Column Label Refinement (Min/Max Suffixes) ---
+    # Loop through the Unnamed pairs to create descriptive headers
+    for i in range(15, 26, 2):
+        current = df.columns.get_loc(f'Unnamed: {i}')
 
-# Step B: Standardize Numeric columns
-df['Heat Melt'] = pd.to_numeric(df['Heat Melt'], errors='coerce')
+        base_label = labels[current]
+        labels[current] = f"{base_label}-min"
+        labels[current + 1] = f"{base_label}-max"
 
-# Step C: Remove invalid rows (German phrases, empty rows, or only-date rows)
-# 1. Drop rows where Date conversion failed (the text phrases)
-df = df.dropna(subset=['Date'])
+    # Set the refined labels as the actual DataFrame columns, then drop the
+    # two header rows and the empty column at index 6
+    df.columns = labels
+    df = df.drop(index=[2, 3])
+    df = df.drop(df.columns[6], axis=1)
+    df = df.reset_index(drop=True)
 
-# 2. Drop rows where 'Heat Melt' is non-numeric or missing
-df = df.dropna(subset=['Heat Melt'])
+    # --- 5. Data Cleaning & Filtering ---
+    # Step A: Standardize Date column
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
 
-# 3. Drop rows where 'Heat Melt' AND 'LOT A' are both missing (extra check)
-df = df.dropna(subset=['Heat Melt', 'LOT A'], how='all')
+    # Step B: Standardize Numeric columns
+    df['Heat Melt'] = pd.to_numeric(df['Heat Melt'], errors='coerce')
 
-# 4. Final sweep for completely empty rows
-df = df.dropna(how='all')
+    # Step C: Remove invalid rows (German phrases, empty rows, or only-date rows)
+    # 1. Drop rows where Date conversion failed (the text phrases)
+    df = df.dropna(subset=['Date'])
 
-# --- 6. Final Formatting & Export ---
-df['Date'] = df['Date'].dt.date
-df = df.reset_index(drop=True)
+    # 2. Drop rows where 'Heat Melt' is non-numeric or missing
+    df = df.dropna(subset=['Heat Melt'])
 
-print(f"Cleaned data for Supplier: {supplier_name}")
-print(df.head())
+    # 3. Drop rows where 'Heat Melt' AND 'LOT A' are both missing (extra check)
+    df = df.dropna(subset=['Heat Melt', 'LOT A'], how='all')
 
-df.to_excel("cleaned_raw_data.xlsx", index=False)
\ No newline at end of file
+    # 4. Final sweep for completely empty rows
+    df = df.dropna(how='all')
+
+    # --- 6. Final Formatting ---
+    df['Date'] = df['Date'].dt.date
+    if (df['Heat Melt'] % 1 == 0).all():
+        df['Heat Melt'] = df['Heat Melt'].astype('int64')
+    df = df.reset_index(drop=True)
+
+    print(f"Cleaned data for Supplier: {supplier_name}")
+    print(df.head())
+
+    # Same dtypes the XLSX round-trip between the old scripts used to produce
+    return df.infer_objects()
+
+
+if __name__ == "__main__":
+    df = clean_raw_data(load_raw_data("raw_data.xlsx"))
+    store.write_frame(".", "cleaned_raw_data", df)
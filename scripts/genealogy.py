@@ -0,0 +1,213 @@
+"""
+Genealogy graph of a job.
+
+final_data repeats every LOT once per tool event it was matched to; this
+module condenses it into the links it is made of:
+
+    LOT A / LOT B -> melt (Melt_ID) -> etching batch (Melt_ID@Created)
+        -> etcher event -> developer event -> cleaner event
+
+The batch table has no batch id, a batch is its melt and creation time.
+
+Nodes are interned per kind and numbered in sorted key order, so a node is
+found by binary search and a tool time window is a contiguous id range (the
+event keys are ISO timestamps). Edges are kept as CSR arrays in both
+directions and saved with the node keys as <job_dir>/genealogy.npz.
+"Downstream" follows the arrows above, "upstream" goes against them.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+import job_cache
+import lot_index
+import store
+
+GRAPH_FILE = "genealogy.npz"
+
+# Node kinds in id order, with the final_data column(s) each is read from
+KINDS = {
+    "lot_a": "LOT A",
+    "lot_b": "LOT B",
+    "melt": "Melt_ID",
+    "batch": ("Melt_ID", "Created"),
+    "etcher": "timestamp_etcher",
+    "developer": "timestamp_developer",
+    "cleaner": "timestamp_cleaner",
+}
+EVENTS = ["etcher", "developer", "cleaner"]
+EDGES = [
+    ("lot_a", "melt"),
+    ("lot_b", "melt"),
+    ("melt", "batch"),
+    ("batch", "etcher"),
+    ("etcher", "developer"),
+    ("developer", "cleaner"),
+]
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def _columns(kind):
+    cols = KINDS[kind]
+    return list(cols) if isinstance(cols, tuple) else [cols]
+
+
+def _times(series):
+    ts = pd.to_datetime(series, errors="coerce")
+    return ts.dt.strftime(TIME_FORMAT).where(ts.notna(), None)
+
+
+def _keys(kind, df):
+    """Node keys of a kind from the columns of df; missing values become None."""
+    if kind == "batch":
+        melts, created = _keys("melt", df), _times(df["Created"])
+        return (melts + "@" + created).where(melts.notna() & created.notna(), None)
+    series = df[KINDS[kind]]
+    if kind in EVENTS:
+        return _times(series)
+    if kind.startswith("lot_"):
+        keys = lot_index.normalize_lots(series)
+        return keys.where(keys != "", None)
+    keys = series.astype(str).str.replace(r"\.0+$", "", regex=True)
+    return keys.where(series.notna(), None)
+
+
+def _csr(src, dst, n):
+    order = np.lexsort((dst, src))
+    ptr = np.zeros(n + 1, dtype="int64")
+    np.add.at(ptr, src + 1, 1)
+    return np.cumsum(ptr), dst[order]
+
+
+def build_graph(job_dir, name="final_data"):
+    """Writes <job_dir>/genealogy.npz from a stored frame and returns its path."""
+    present = set(store.columns(job_dir, name))
+    kinds = [k for k in KINDS if set(_columns(k)) <= present]
+    df = store.read_frame(job_dir, name, columns=list(dict.fromkeys(c for k in kinds for c in _columns(k))))
+
+    # Intern keys kind by kind; ids of one kind are contiguous and sorted by key
+    keys, kind_ptr, ids = [], [0], {}
+    for kind in KINDS:
+        if kind in kinds:
+            col = _keys(kind, df)
+            codes, uniques = pd.factorize(col, sort=True)
+            ids[kind] = np.where(codes >= 0, codes + kind_ptr[-1], -1)
+            keys.extend(uniques)
+        kind_ptr.append(len(keys))
+    n = len(keys)
+
+    src, dst = [], []
+    for a, b in EDGES:
+        if a in ids and b in ids:
+            ok = (ids[a] >= 0) & (ids[b] >= 0)
+            src.append(ids[a][ok])
+            dst.append(ids[b][ok])
+    edges = np.unique(np.stack([np.concatenate(src or [[]]), np.concatenate(dst or [[]])]).astype("int64"), axis=1)
+    down_ptr, down_idx = _csr(edges[0], edges[1], n)
+    up_ptr, up_idx = _csr(edges[1], edges[0], n)
+
+    path = os.path.join(job_dir, GRAPH_FILE)
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, keys=np.array(keys, dtype=str), kind_ptr=np.array(kind_ptr, dtype="int64"),
+             down_ptr=down_ptr, down_idx=down_idx, up_ptr=up_ptr, up_idx=up_idx)
+    os.replace(tmp, path)
+    print(f"Genealogy graph: {n} nodes, {edges.shape[1]} edges")
+    return path
+
+
+class Graph:
+    """A loaded genealogy graph; node ids index into the arrays."""
+
+    def __init__(self, arrays):
+        self.keys = arrays["keys"]
+        self.kind_ptr = arrays["kind_ptr"]
+        self._adj = {
+            "down": (arrays["down_ptr"], arrays["down_idx"]),
+            "up": (arrays["up_ptr"], arrays["up_idx"]),
+        }
+        self._kinds = list(KINDS)
+        self.nbytes = sum(array.nbytes for array in arrays.values())
+
+    def kind(self, node):
+        return self._kinds[np.searchsorted(self.kind_ptr, node, side="right") - 1]
+
+    def _range(self, kind):
+        i = self._kinds.index(kind)
+        return self.kind_ptr[i], self.kind_ptr[i + 1]
+
+    def find(self, kind, key):
+        """Id of the node of `kind` with `key`, or None."""
+        lo, hi = self._range(kind)
+        if kind in EVENTS:
+            key = pd.Timestamp(key).strftime(TIME_FORMAT)
+        elif kind == "batch":
+            melt, _, created = key.partition("@")
+            key = f"{melt}@{pd.Timestamp(created).strftime(TIME_FORMAT)}"
+        elif kind.startswith("lot_"):
+            key = lot_index.normalize_lot(key)
+        i = lo + np.searchsorted(self.keys[lo:hi], key)
+        return int(i) if i < hi and self.keys[i] == key else None
+
+    def in_window(self, kind, start, end):
+        """Ids of the tool events of `kind` between start and end (inclusive)."""
+        lo, hi = self._range(kind)
+        window = self.keys[lo:hi]
+        first = np.searchsorted(window, pd.Timestamp(start).strftime(TIME_FORMAT), side="left")
+        last = np.searchsorted(window, pd.Timestamp(end).strftime(TIME_FORMAT), side="right")
+        return np.arange(lo + first, lo + last)
+
+    def _neighbours(self, direction, nodes):
+        ptr, idx = self._adj[direction]
+        starts, counts = ptr[nodes], ptr[nodes + 1] - ptr[nodes]
+        total = counts.sum()
+        if not total:
+            return idx[:0]
+        # Positions of all neighbour slices in idx, gathered without a Python loop
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return idx[offsets + np.arange(total)]
+
+    def walk(self, start, direction="down", depth=None, kinds=None):
+        """
+        Breadth-first walk from the node ids in `start` along one direction
+        ("down", "up"), or both. Returns {node id: distance}, the start
+        nodes excluded, optionally only for the given kinds.
+        """
+        directions = ["down", "up"] if direction == "both" else [direction]
+        dist = np.full(len(self.keys), -1, dtype="int64")
+        frontier = np.unique(np.atleast_1d(np.asarray(start, dtype="int64")))
+        dist[frontier] = 0
+        distance = 0
+        while len(frontier) and (depth is None or distance < depth):
+            distance += 1
+            found = np.concatenate([self._neighbours(d, frontier) for d in directions])
+            frontier = np.unique(found[dist[found] < 0])
+            dist[frontier] = distance
+        reached = np.flatnonzero(dist > 0)
+        if kinds is not None:
+            ranges = [self._range(kind) for kind in kinds]
+            reached = reached[np.any([(reached >= lo) & (reached < hi) for lo, hi in ranges], axis=0)]
+        return dict(zip(reached.tolist(), dist[reached].tolist()))
+
+    def describe(self, node, distance=None):
+        info = {"kind": self.kind(node), "key": str(self.keys[node])}
+        if distance is not None:
+            info["distance"] = distance
+        return info
+
+
+def _load(path):
+    with np.load(path) as arrays:
+        return Graph({name: arrays[name] for name in arrays.files})
+
+
+def load_graph(job_dir, name="final_data"):
+    """
+    Returns the job's Graph, building it first for jobs that predate it.
+    Loaded graphs are kept in the job cache (see job_cache.py).
+    """
+    path = os.path.join(job_dir, GRAPH_FILE)
+    if not os.path.exists(path):
+        build_graph(job_dir, name)
+    return job_cache.CACHE.get(("genealogy", path, os.path.getmtime(path)), lambda: _load(path),
+                               lambda graph: graph.nbytes)
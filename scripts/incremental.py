@@ -0,0 +1,298 @@
+"""
+Incremental pipeline runs.
+
+Every finished job keeps the sorted, typed tool logs it processed and a
+high-water mark per source under <job_dir>/state/. A later job that names it
+as its base only parses the rows appended to each CL_*.csv since then, and
+recomputes the tool sync and the 6h batch join for a look-back window around
+that boundary; everything older is taken over from the base job as is.
+
+Whenever the inputs are not a plain append of what the base saw (a file was
+edited, rows arrived out of time order, ...) the caller falls back to a full
+run. An incremental run stores the same rows, in the same order, as a full
+run would.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import cde_merger
+import metrics
+import schema
+import store
+import tbl_merge
+import tool_logs
+
+STATE_DIR = "state"
+SOURCES_FILE = "sources.json"
+INPUTS_FILE = "inputs.json"
+
+# Source file -> timestamp column after cde_merger.prepare_tool_logs()
+TOOL_LOGS = {
+    "CL_Cleaner.csv": "timestamp_cleaner",
+    "CL_Developer.csv": "timestamp_developer",
+    "CL_Etcher4.csv": "timestamp_etcher",
+}
+BATCH_INPUTS = ["raw_data.xlsx", "tbl_etching_batch.csv"]
+
+# Cleaner->Developer (60s) plus Developer->Etcher (60s)
+SYNC_LOOKBACK = pd.Timedelta("120s")
+# tbl_merge etcher window after the batch was created
+BATCH_WINDOW = pd.Timedelta("6h")
+# Column that carries the position of each batch through the incremental batch join
+_POSITION = "__batch_position"
+
+
+def file_digest(path, limit=None):
+    """sha256 of the first `limit` bytes of path (the whole file by default)."""
+    digest = hashlib.sha256()
+    remaining = os.path.getsize(path) if limit is None else limit
+    with open(path, "rb") as f:
+        while remaining > 0:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+def _state_dir(job_dir):
+    return os.path.join(job_dir, STATE_DIR)
+
+
+def _stem(filename):
+    return filename.rsplit(".", 1)[0]
+
+
+def state_files():
+    """Files save_state() writes, relative to the job directory."""
+    return [os.path.join(STATE_DIR, _stem(name) + store.EXTENSION) for name in TOOL_LOGS] + \
+        [os.path.join(STATE_DIR, SOURCES_FILE)]
+
+
+def sort_tool_logs(job_dir):
+    """
+    Writes the prepared tool logs of job_dir's CL_*.csv to its state
+    directory without loading them whole (see tool_logs.py). Returns them
+    as streams of sorted chunks, in TOOL_LOGS order.
+    """
+    state_dir = _state_dir(job_dir)
+    for name, col in TOOL_LOGS.items():
+        rows = tool_logs.sort_log(os.path.join(job_dir, name), col, state_dir, _stem(name))
+        print(f"Sorted {rows} rows of {name}")
+        metrics.count("rows_in", rows)
+    return [tool_logs.iter_sorted(state_dir, _stem(name)) for name in TOOL_LOGS]
+
+
+def save_state(job_dir, digests):
+    """
+    Records the size, hash and high-water mark of each CL_*.csv next to the
+    prepared tool logs sort_tool_logs() or sync_tool_logs() stored, so this
+    job can serve as the base of a later one.
+    """
+    state_dir = _state_dir(job_dir)
+    sources = {}
+    for name, col in TOOL_LOGS.items():
+        hwm = store.read_frame(state_dir, _stem(name), columns=[col])[col].max()
+        sources[name] = {
+            "size": os.path.getsize(os.path.join(job_dir, name)),
+            "sha256": digests[name],
+            "hwm": None if pd.isna(hwm) else hwm.isoformat(),
+        }
+
+    with open(os.path.join(state_dir, SOURCES_FILE), "w") as f:
+        json.dump(sources, f, indent=2)
+
+
+def save_inputs(job_dir, digests):
+    """Records the hashes of all input files of a run."""
+    os.makedirs(_state_dir(job_dir), exist_ok=True)
+    with open(os.path.join(_state_dir(job_dir), INPUTS_FILE), "w") as f:
+        json.dump(digests, f, indent=2)
+
+
+def _load_json(base_dir, name):
+    try:
+        with open(os.path.join(_state_dir(base_dir), name)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def load_state(base_dir):
+    """
+    Returns what a base job recorded about its inputs as
+    {"sources": ..., "inputs": ...}, or None if it has no incremental state.
+    """
+    sources = _load_json(base_dir, SOURCES_FILE)
+    inputs = _load_json(base_dir, INPUTS_FILE)
+    if sources is None or inputs is None:
+        return None
+    return {"sources": sources, "inputs": inputs}
+
+
+def read_appended(path, source):
+    """
+    Parses only the rows appended to path since the base job saw it.
+    Returns None when path is not the base file plus appended rows.
+    """
+    if os.path.getsize(path) < source["size"] or file_digest(path, source["size"]) != source["sha256"]:
+        return None
+    with open(path, "rb") as f:
+        header = f.readline()
+        f.seek(source["size"])
+        tail = f.read()
+    return pd.read_csv(io.BytesIO(header + tail))
+
+
+def _iter_rows(job_dir, name, mask):
+    """The rows of a stored frame where the boolean array mask is True, chunk by chunk."""
+    start = 0
+    for chunk in store.iter_frame(job_dir, name):
+        rows = chunk[mask[start:start + len(chunk)]]
+        start += len(chunk)
+        if len(rows):
+            yield rows
+
+
+def sync_tool_logs(job_dir, base_dir, sources):
+    """
+    Incremental counterpart of sort_tool_logs() plus the sync of its logs
+    for the CL_*.csv files in job_dir. Writes the state of job_dir, the
+    base job's logs with the appended rows merged in, and returns (synced,
+    cutoff): synced streams the rows of final_sequential_sync, those with a
+    cleaner timestamp after cutoff recomputed, the others read from the
+    base job. Returns None if a full run is needed.
+    """
+    if not set(cde_merger.SYNC_COLUMNS) <= set(store.columns(base_dir, "final_sequential_sync")):
+        print("Incremental run not possible: the base job predates the current sync columns")
+        return None
+
+    appended = []
+    for name in TOOL_LOGS:
+        df = read_appended(os.path.join(job_dir, name), sources[name])
+        if df is None or sources[name]["hwm"] is None:
+            print(f"Incremental run not possible: {name} is not an append of the base job's file")
+            return None
+        metrics.count("rows_in", len(df))
+        appended.append(df)
+    appended = dict(zip(TOOL_LOGS, cde_merger.prepare_tool_logs(*appended)))
+
+    hwms = {name: pd.Timestamp(sources[name]["hwm"]) for name in TOOL_LOGS}
+    for name, col in TOOL_LOGS.items():
+        if (appended[name][col] <= hwms[name]).any():
+            print(f"Incremental run not possible: {name} has new rows older than the base job's last row")
+            return None
+
+    # Sync rows whose cleaner event is at or before the cutoff can only match
+    # developer/etcher events the base job already had, so they are final.
+    cutoff = min(hwms.values()) - SYNC_LOOKBACK
+    state_dir = _state_dir(job_dir)
+    run_dir = os.path.join(state_dir, tool_logs.RUNS_DIR)
+    os.makedirs(run_dir, exist_ok=True)
+    tails = []
+    try:
+        for name, col in TOOL_LOGS.items():
+            # The appended rows are one more sorted run after the base job's log
+            new = schema.apply(appended[name])
+            store.write_frame(run_dir, _stem(name), new)
+            runs = [(_state_dir(base_dir), _stem(name)), (run_dir, _stem(name))]
+            store.write_chunks(state_dir, _stem(name), tool_logs.merge_runs(runs, col))
+            times = store.read_frame(state_dir, _stem(name), columns=[col])[col]
+            tails.append(store.concat(list(_iter_rows(state_dir, _stem(name), (times > cutoff).to_numpy()))
+                                      + [new[new[col].isna()]]))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    print(f"Incremental sync: recomputing {len(tails[0])} cleaner records after {cutoff}")
+    recomputed = cde_merger.sync_prepared_logs(*tails)
+
+    def synced():
+        # In cleaner time order, as a full run has them: cleaner records without a
+        # timestamp come last, the base job's before the appended ones
+        times = store.read_frame(base_dir, "final_sequential_sync", columns=["timestamp_cleaner"])["timestamp_cleaner"]
+        missing = recomputed["timestamp_cleaner"].isna()
+        yielded = False
+        for part in (_iter_rows(base_dir, "final_sequential_sync", (times <= cutoff).to_numpy()),
+                     [recomputed[~missing]],
+                     _iter_rows(base_dir, "final_sequential_sync", times.isna().to_numpy()),
+                     [recomputed[missing]]):
+            for rows in part:
+                if len(rows):
+                    yielded = True
+                    yield rows
+        if not yielded:
+            yield store.empty_frame(base_dir, "final_sequential_sync")
+
+    return synced(), cutoff
+
+
+def _run_starts(flags):
+    """Positions where a run of Trues in flags starts."""
+    return np.flatnonzero(flags & ~np.r_[False, flags[:-1]])
+
+
+def iter_merge_sync_with_batches(digests, base_dir, base_inputs, df_sync, df_tbl, cutoff, max_memory_mb=None,
+                                 sync_rows=None):
+    """
+    Incremental counterpart of tbl_merge.iter_merge_sync_with_batches().
+    Batches created more than BATCH_WINDOW before the sync cutoff keep the
+    rows of the base job's final_data; only the later ones are joined again,
+    and the rows of both are yielded in batch order, as the full join does.
+    Returns None if the LOT/batch inputs changed since the base job.
+    """
+    for name in BATCH_INPUTS:
+        if digests.get(name) != base_inputs.get(name):
+            print(f"Incremental batch join not possible: {name} changed since the base job")
+            return None
+
+    threshold = cutoff - BATCH_WINDOW
+    created = pd.to_datetime(df_tbl["Created"])
+    recent_sync = df_sync[pd.to_datetime(df_sync["timestamp_etcher"]) > threshold]
+    recent = (created > threshold).to_numpy()
+
+    base_created = pd.to_datetime(store.read_frame(base_dir, "final_data", columns=["Created"])["Created"])
+    base_kept = ((base_created <= threshold) | base_created.isna()).to_numpy()
+    # The rows of a batch follow one another in batch order, so a run of kept
+    # batches has a run of kept rows in the base job's final_data, the n-th to
+    # the n-th. Each kept row is placed at the position of its run's first batch.
+    run_starts, base_starts = _run_starts(~recent), _run_starts(base_kept)
+    if len(run_starts) != len(base_starts):
+        print("Incremental batch join not possible: the base job's final_data does not match its batches")
+        return None
+    kept_positions = run_starts[np.searchsorted(base_starts, np.flatnonzero(base_kept), side="right") - 1]
+    kept_rows = _iter_rows(base_dir, "final_data", base_kept)
+    buffer = store.empty_frame(base_dir, "final_data")
+
+    def kept(n):
+        """The next n kept rows of the base job's final_data."""
+        nonlocal buffer
+        while len(buffer) < n:
+            rows = next(kept_rows)
+            buffer = store.concat([buffer, rows]) if len(buffer) else rows
+        rows, buffer = buffer.iloc[:n], buffer.iloc[n:]
+        return rows
+
+    def chunks():
+        joined = tbl_merge.iter_merge_sync_with_batches(
+            recent_sync, df_tbl[recent].assign(**{_POSITION: np.flatnonzero(recent)}), max_memory_mb, sync_rows)
+        done, yielded = 0, False
+        for chunk in joined:
+            positions = chunk.pop(_POSITION).to_numpy()
+            if not len(chunk):
+                # An empty chunk would fix the parquet schema with untyped columns
+                continue
+            end = int(np.searchsorted(kept_positions, positions[-1]))
+            order = np.argsort(np.r_[kept_positions[done:end], positions], kind="stable")
+            yield store.concat([kept(end - done), chunk]).iloc[order].reset_index(drop=True)
+            done, yielded = end, True
+        if done < len(kept_positions) or not yielded:
+            yield kept(len(kept_positions) - done)
+
+    return chunks()
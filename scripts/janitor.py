@@ -0,0 +1,266 @@
+"""
+Retention of job directories.
+
+sweep() keeps jobs/ within an age limit and a size quota. It runs in the
+app's background thread, or once from the command line:
+
+    python janitor.py [--dry-run]
+
+1. Jobs not used for max_age seconds are deleted. A job's directory mtime
+   is its last use: the app touches it whenever a job is read (see touch()).
+2. While jobs/ and the upload blobs together exceed max_bytes, least
+   recently used jobs first lose the files the app can produce again
+   (ARTIFACTS: CSV/XLSX exports, compressed copies, converted sheets,
+   the Arrow copies the job cache maps, incremental state), then whole
+   jobs go, oldest use first.
+3. Blobs no job or kept chunked upload refers to any more and stale
+   chunked uploads are removed.
+
+Queued and running jobs are never touched unless abandoned, and neither
+is anything in jobs/ that is not a job directory, e.g. the LOT catalog
+database.
+Deleted jobs are dropped from the catalog.
+"""
+import argparse
+import glob
+import os
+import shutil
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app runs as one process
+    fcntl = None
+
+import catalog
+import incremental
+import job_cache
+import jobs
+import store
+import uploads
+import workbook
+
+MAX_AGE = 30 * 24 * 3600  # seconds since a job was last used
+MAX_BYTES = 50 * 1024 ** 3  # jobs/ plus the upload blobs
+LOCK_FILE = ".janitor.lock"
+BLOB_GRACE = 3600  # seconds an unlinked blob is kept, it may be about to be linked
+# Files of a job that are produced again on demand, relative to the job directory
+ARTIFACTS = [
+    "*.csv.zst", "*.csv.gz", "*" + workbook.SHEET_SUFFIX, "*" + job_cache.MAPPED_SUFFIX, "lot_trace_result.csv",
+    incremental.STATE_DIR,
+] + [f"*.{fmt}" for fmt in store.EXPORT_FORMATS]
+
+
+_lock_fd = None
+
+
+def acquire(jobs_dir):
+    """
+    True in the one process that holds the janitor lock of jobs_dir, taken
+    on the first call and kept while the process lives, so several server
+    processes do not sweep at the same time.
+    """
+    global _lock_fd
+    if _lock_fd is not None or fcntl is None:
+        return True
+    fd = os.open(os.path.join(jobs_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _lock_fd = fd
+    return True
+
+
+def touch(job_dir):
+    """Marks a job as used now."""
+    try:
+        os.utime(job_dir)
+    except OSError:
+        pass
+
+
+def _files(paths):
+    """(path, stat) of every file under paths."""
+    for top in paths:
+        if os.path.isfile(top):
+            yield top, os.stat(top)
+        for root, _, names in os.walk(top):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+
+def inodes(paths):
+    """{(st_dev, st_ino): [links under paths, size]} of the files under paths."""
+    table = {}
+    for _, st in _files(paths):
+        table.setdefault((st.st_dev, st.st_ino), [0, st.st_size])[0] += 1
+    return table
+
+
+def disk_usage(paths):
+    """Bytes under paths, counting hard-linked files once."""
+    return sum(size for _, size in inodes(paths).values())
+
+
+def release(paths, table, blobs=frozenset()):
+    """
+    Takes the links under paths out of `table` (see inodes()) and returns
+    the bytes that frees: files left with no link in the table, or only
+    their blob in `blobs`, which collect_blobs() removes. Links from outside
+    the table, e.g. from the stage cache, do not count; the cache keeps
+    to its own size limit.
+    """
+    freed = 0
+    for _, st in _files(paths):
+        entry = table.get((st.st_dev, st.st_ino))
+        if entry is None or entry[0] == 0:
+            continue
+        entry[0] -= 1
+        if entry[0] == ((st.st_dev, st.st_ino) in blobs):
+            freed += entry[1]
+    return freed
+
+
+def _jobs(jobs_dir, now, max_age):
+    """
+    [(last use, job_dir, status)] of the finished or failed jobs, least
+    recently used first. Queued or running jobs whose status has not changed
+    for max_age seconds were abandoned (e.g. by a server restart) and count
+    as finished.
+    """
+    found = []
+    for name in os.listdir(jobs_dir) if os.path.isdir(jobs_dir) else []:
+        job_dir = os.path.join(jobs_dir, name)
+        if not os.path.isdir(job_dir):
+            continue  # the catalog database
+        status = jobs.read_status(job_dir)
+        if status is None:
+            continue  # a job being created
+        if status["state"] in (jobs.QUEUED, jobs.RUNNING) and \
+                now - os.path.getmtime(os.path.join(job_dir, jobs.STATUS_FILE)) <= max_age:
+            continue
+        found.append((os.path.getmtime(job_dir), job_dir, status))
+    return sorted(found, key=lambda job: job[0])
+
+
+def _inputs(job_dir, status):
+    """Upload files of a job, which are never artifacts even when they are CSV/XLSX."""
+    return {os.path.join(job_dir, name) for name in status.get("files_processed") or []}
+
+
+def artifacts(job_dir, status):
+    """Paths of the regenerable files of a job."""
+    found = {path for pattern in ARTIFACTS for path in glob.glob(os.path.join(job_dir, pattern))}
+    return sorted(found - _inputs(job_dir, status))
+
+
+def drop_artifacts(job_dir, status, dry_run=False):
+    """Removes the regenerable files of a job; returns their paths."""
+    removed = artifacts(job_dir, status)
+    if removed and not dry_run:
+        used = os.path.getmtime(job_dir)
+        for path in removed:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        os.utime(job_dir, (used, used))  # removing files is not a use
+    return removed
+
+
+def remove_job(job_dir, dry_run=False):
+    if dry_run:
+        return
+    shutil.rmtree(job_dir, ignore_errors=True)
+    try:
+        catalog.remove_job(os.path.basename(job_dir))
+    except Exception as e:
+        print(f"Janitor: catalog update failed for {job_dir}: {e}")
+
+
+def _blobs(blob_dir):
+    """(path, stat) of the blobs no finished chunked upload refers to."""
+    kept = uploads.session_digests(blob_dir)
+    for path, st in _files([os.path.join(blob_dir, "sha256")]):
+        if os.path.basename(path) not in kept:
+            yield path, st
+
+
+def collect_blobs(blob_dir=None, grace=BLOB_GRACE, now=None, dry_run=False):
+    """
+    Removes blobs no job links to; returns their paths. A blob stored or
+    uploaded again within grace seconds is kept, its job may be about to
+    link it (see uploads._commit()).
+    """
+    now = now or time.time()
+    removed = []
+    for path, st in _blobs(blob_dir or uploads.BLOB_DIR):
+        if st.st_nlink == 1 and now - st.st_mtime > grace:
+            try:
+                if now - os.stat(path).st_mtime <= grace:
+                    continue  # uploaded again meanwhile
+            except FileNotFoundError:
+                continue
+            removed.append(path)
+            if not dry_run:
+                os.remove(path)
+    return removed
+
+
+def sweep(jobs_dir, max_age=MAX_AGE, max_bytes=MAX_BYTES, blob_dir=None, now=None, dry_run=False):
+    """Applies the age limit and size quota (see the module docstring); returns what was done."""
+    now = now or time.time()
+    blob_dir = blob_dir or uploads.BLOB_DIR
+    report = {"expired_jobs": [], "trimmed_jobs": [], "evicted_jobs": [], "artifacts": 0, "blobs": 0}
+
+    candidates = []
+    for used, job_dir, status in _jobs(jobs_dir, now, max_age):
+        if now - used > max_age:
+            remove_job(job_dir, dry_run)
+            report["expired_jobs"].append(os.path.basename(job_dir))
+        else:
+            candidates.append((job_dir, status))
+
+    # Expired jobs are gone already, unless this is a dry run
+    table = inodes([jobs_dir, blob_dir])
+    blobs = set(inodes([path for path, _ in _blobs(blob_dir)]))
+    total = sum(size for _, size in table.values())
+    if dry_run:
+        total -= release([os.path.join(jobs_dir, job_id) for job_id in report["expired_jobs"]], table, blobs)
+    for job_dir, status in candidates:
+        if total <= max_bytes:
+            break
+        paths = artifacts(job_dir, status)
+        if paths:
+            total -= release(paths, table, blobs)
+            drop_artifacts(job_dir, status, dry_run)
+            report["trimmed_jobs"].append(os.path.basename(job_dir))
+            report["artifacts"] += len(paths)
+    while candidates and total > max_bytes:
+        job_dir, _ = candidates.pop(0)
+        total -= release([job_dir], table, blobs)
+        remove_job(job_dir, dry_run)
+        report["evicted_jobs"].append(os.path.basename(job_dir))
+
+    if not dry_run:
+        uploads.expire_sessions(blob_dir)
+    report["blobs"] = len(collect_blobs(blob_dir, now=now, dry_run=dry_run))
+    report["bytes"] = disk_usage([jobs_dir, blob_dir])
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Applies the job retention limits once.")
+    parser.add_argument("--jobs-dir", default=os.path.dirname(catalog.CATALOG_PATH))
+    parser.add_argument("--max-age-days", type=float, default=MAX_AGE / 86400)
+    parser.add_argument("--max-gb", type=float, default=MAX_BYTES / 1024 ** 3)
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+    args = parser.parse_args()
+    result = sweep(args.jobs_dir, args.max_age_days * 86400, int(args.max_gb * 1024 ** 3), dry_run=args.dry_run)
+    print(result)
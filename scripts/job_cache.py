@@ -0,0 +1,167 @@
+"""
+Size-bounded LRU cache of job tables and LOT indexes for the search
+endpoints.
+
+A job table is served from an uncompressed Arrow IPC copy of its parquet
+file (<name>.arrow in the job directory), written once by whichever
+process needs it first and then only read. Every process memory-maps that
+file read-only, so its pages sit in the OS page cache once and are shared
+by all server workers; a cached table costs no read or decode, and
+take() touches only the rows a search asks for.
+
+LOT indexes (see lot_index.LotIndex) and genealogy graphs (see
+genealogy.Graph) are loaded per process; they share the cache and its size
+limit with the tables.
+
+Entries are keyed by the source file and its mtime, so a rewritten file is
+loaded again, and the least recently used ones are dropped once their
+sizes add up past max_bytes. A mapped table counts with its full size.
+"""
+import collections
+import os
+import threading
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+import store
+
+MAPPED_SUFFIX = ".arrow"
+MAX_BYTES = 1024 ** 3  # 1 GiB per process
+
+
+class LRUCache:
+    """Values with a size in bytes, least recently used dropped first past max_bytes."""
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self._loading = {}  # key -> lock, so concurrent requests load a value once
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load, size):
+        """The cached value of key, else load() stored with size(value) bytes."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            with self._lock:
+                if key in self._entries:  # loaded by the request this one waited for
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][0]
+                self.misses += 1
+            try:
+                value = load()
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(key, None)
+                raise
+            with self._lock:
+                self._entries[key] = (value, size(value))
+                self._loading.pop(key, None)
+                self._evict()
+        return value
+
+    def _evict(self):
+        total = sum(nbytes for _, nbytes in self._entries.values())
+        while len(self._entries) > 1 and total > self.max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            total -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(nbytes for _, nbytes in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+CACHE = LRUCache()
+
+
+def _dictionaries(f):
+    """{column: all its values} of the dictionary columns of a parquet file, read column by column."""
+    found = {}
+    for field in f.schema_arrow:
+        if pa.types.is_dictionary(field.type):
+            values = pa.array([], type=field.type.value_type)
+            for batch in f.iter_batches(columns=[field.name]):
+                values = pc.unique(pa.concat_arrays([values, batch.column(0).dictionary]))
+            found[field.name] = values
+    return found
+
+
+def _with_dictionaries(batch, dictionaries):
+    """batch with its dictionary columns recoded to the given dictionaries."""
+    columns = list(batch.columns)
+    for name, dictionary in dictionaries.items():
+        i = batch.schema.get_field_index(name)
+        column = columns[i]
+        positions = pc.index_in(column.dictionary, value_set=dictionary)
+        indices = positions.take(column.indices).cast(column.type.index_type)
+        columns[i] = pa.DictionaryArray.from_arrays(indices, dictionary)
+    return pa.RecordBatch.from_arrays(columns, schema=batch.schema)
+
+
+def mapped_path(job_dir, name):
+    """<job_dir>/<name>.arrow, written from the stored frame if missing or older."""
+    source = store.frame_path(job_dir, name)
+    path = os.path.join(job_dir, name + MAPPED_SUFFIX)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        return path
+    # Written batch by batch. The IPC file format wants one dictionary per
+    # column, while parquet row groups each have their own, so the
+    # dictionaries are collected first and every batch is recoded to them.
+    f = pq.ParquetFile(source)
+    dictionaries = _dictionaries(f)
+    tmp = os.path.join(job_dir, f".{name}.{uuid.uuid4().hex}.tmp{MAPPED_SUFFIX}")
+    with pa.OSFile(tmp, "wb") as sink, ipc.new_file(sink, f.schema_arrow) as writer:
+        for batch in f.iter_batches(batch_size=store.ROW_GROUP_SIZE):
+            writer.write_batch(_with_dictionaries(batch, dictionaries))
+    os.chmod(tmp, 0o444)
+    if os.path.exists(path):
+        os.replace(tmp, path)
+    else:
+        try:
+            os.link(tmp, path)  # a process that wrote it meanwhile wins, its copy may be mapped already
+        except FileExistsError:
+            pass
+        os.remove(tmp)
+    return path
+
+
+def _map(path):
+    # Zero-copy: the table's buffers point into the mapping, which lives as long as they do
+    return ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def table(job_dir, name="final_data"):
+    """The stored frame as a memory-mapped Arrow table."""
+    path = mapped_path(job_dir, name)
+    return CACHE.get(("table", path, os.path.getmtime(path)), lambda: _map(path), lambda t: t.nbytes)
+
+
+def read_frame(job_dir, name="final_data"):
+    """store.read_frame() from the mapped table."""
+    return table(job_dir, name).to_pandas()
+
+
+def read_rows(job_dir, name, rows):
+    """store.read_rows() from the mapped table."""
+    return table(job_dir, name).take(pa.array(rows, type=pa.int64())).to_pandas()
@@ -0,0 +1,231 @@
+"""
+Job status bookkeeping for pipeline runs.
+
+Every job directory carries a small status.json that the worker process
+updates on each stage transition, so the web process can report progress
+without sharing memory with the workers.
+
+The limits on pipelines hold for the whole server, however many server
+processes share the jobs directory, through files next to the jobs:
+
+- jobs/.pending/<job_id> marks a job queued or running, and names the
+  server process that queued it (see add_pending(), count_pending());
+- jobs/.slots/<n>.lock are the run slots; a pipeline runs while it holds
+  the lock of one of them (see run_slot()).
+
+These are POSIX record locks (lockf), which belong to the process that took
+them: the stage workers a pipeline forks do not keep its slot.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app runs as one process
+    fcntl = None
+
+import catalog
+import pipeline
+import store
+
+STATUS_FILE = "status.json"
+PENDING_DIR = ".pending"
+SLOTS_DIR = ".slots"
+SLOT_POLL = 1.0  # seconds between looks for a free run slot
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def read_status(job_dir):
+    """Returns the status dict of a job, or None if the job has no status yet."""
+    try:
+        with open(os.path.join(job_dir, STATUS_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_status(job_dir, **fields):
+    """Merges fields into the job status and writes it atomically."""
+    status = read_status(job_dir) or {}
+    status.update(fields)
+    status["updated_at"] = time.time()
+    tmp = os.path.join(job_dir, STATUS_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp, os.path.join(job_dir, STATUS_FILE))
+    return status
+
+
+def mark_queued(job_dir, job_id, files, base_job_id=None):
+    return write_status(
+        job_dir,
+        job_id=job_id,
+        base_job_id=base_job_id,
+        state=QUEUED,
+        stage=0,
+        stages=len(pipeline.STAGES),
+        stage_name=None,
+        files_processed=files,
+        submitted_at=time.time(),
+    )
+
+
+def mark_failed(job_dir, error, details=""):
+    return write_status(job_dir, state=FAILED, error=error, details=details[:500])
+
+
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def pending_lock(jobs_dir):
+    """Serializes counting and adding pending jobs across the threads and processes of the server."""
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(os.path.join(jobs_dir, PENDING_DIR + ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def add_pending(job_dir):
+    """Marks a job as queued or running on behalf of this process."""
+    pending_dir = os.path.join(os.path.dirname(job_dir), PENDING_DIR)
+    os.makedirs(pending_dir, exist_ok=True)
+    with open(os.path.join(pending_dir, os.path.basename(job_dir)), "w") as f:
+        f.write(str(os.getpid()))
+
+
+def remove_pending(job_dir):
+    try:
+        os.remove(os.path.join(os.path.dirname(job_dir), PENDING_DIR, os.path.basename(job_dir)))
+    except FileNotFoundError:
+        pass
+
+
+def count_pending(jobs_dir):
+    """
+    Jobs queued or running in any server process. Jobs of a server process
+    that is gone are failed and no longer count.
+    """
+    pending_dir = os.path.join(jobs_dir, PENDING_DIR)
+    count = 0
+    for job_id in os.listdir(pending_dir) if os.path.isdir(pending_dir) else []:
+        job_dir = os.path.join(jobs_dir, job_id)
+        try:
+            with open(os.path.join(pending_dir, job_id)) as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            continue  # being written
+        if _alive(pid):
+            count += 1
+            continue
+        if (read_status(job_dir) or {}).get("state") in (QUEUED, RUNNING):
+            mark_failed(job_dir, "Server process stopped before the pipeline finished. Please retry.")
+        remove_pending(job_dir)
+    return count
+
+
+@contextlib.contextmanager
+def run_slot(jobs_dir, slots):
+    """
+    Waits for one of `slots` run slots of the server and holds it inside
+    the block. The lock goes with the process, so a dead worker frees its
+    slot. Without fcntl (one server process) or slots, nothing is held.
+    """
+    if fcntl is None or not slots:
+        yield
+        return
+    slots_dir = os.path.join(jobs_dir, SLOTS_DIR)
+    os.makedirs(slots_dir, exist_ok=True)
+    while True:
+        for n in range(slots):
+            fd = os.open(os.path.join(slots_dir, f"{n}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            try:
+                yield
+            finally:
+                os.close(fd)
+            return
+        time.sleep(SLOT_POLL)
+
+
+def run_job(job_dir, base_dir=None, stage_timeout=None, slots=None):
+    """
+    Worker entry point: runs the pipeline for job_dir (incrementally on top
+    of base_dir if given) and records progress. A stage that runs longer
+    than stage_timeout seconds fails the job. With slots, the job stays
+    queued until one of that many server-wide run slots is free (see
+    run_slot()).
+    Never raises, the outcome is always written to status.json.
+    """
+    def progress(step, total, name, running):
+        write_status(job_dir, state=RUNNING, stage=step, stages=total, stage_name=name,
+                     stage_started_at=running.get(name), running=running)
+
+    with run_slot(os.path.dirname(job_dir), slots):
+        write_status(job_dir, state=RUNNING, started_at=time.time())
+        try:
+            pipeline.run_pipeline(job_dir, progress=progress, base_dir=base_dir, stage_timeout=stage_timeout)
+        except pipeline.StageError as e:
+            return mark_failed(job_dir, str(e), e.details)
+        except Exception as e:
+            return mark_failed(job_dir, f"Failed to execute pipeline: {str(e)}")
+
+    if not store.exists(job_dir, pipeline.FINAL):
+        return mark_failed(job_dir, "Pipeline completed but final_data was not generated")
+
+    # The catalog only speeds up cross-job lookups, a failure there does not fail the job
+    try:
+        catalog.add_job(job_dir, pipeline.FINAL)
+    except Exception as e:
+        print(f"Catalog update failed for {job_dir}: {e}")
+    return write_status(job_dir, state=DONE, error=None, running={}, finished_at=time.time())
+
+
+def stuck_stage(status, timeout):
+    """Name of a stage the status shows running for more than timeout seconds, or None."""
+    running = status.get("running")
+    if running is None and status.get("stage_started_at"):
+        running = {status["stage_name"]: status["stage_started_at"]}
+    for name, started in (running or {}).items():
+        if started and time.time() - started > timeout:
+            return name
+    return None
+
+
+def describe(status):
+    """
+    Human readable one-liner for the UI, e.g. 'stage 2 of 4: merge_raw_w_etch.py'
+    or 'stage 2 of 4: clean_raw_data.py, cde_merger.py' while both run.
+    """
+    state = status.get("state")
+    if state == RUNNING and status.get("stage"):
+        names = list(status.get("running") or {}) or [status["stage_name"]]
+        return f"stage {status['stage']} of {status['stages']}: {', '.join(names)}"
+    return state
@@ -0,0 +1,214 @@
+"""
+Time-window join primitives shared by the pipeline stages.
+
+All joins work on sorted int64 nanosecond timestamps with np.searchsorted,
+so they never build the many-to-many product of two frames.
+"""
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+def _times(series):
+    """series as datetime64; pd.to_datetime() is slow on columns that already are."""
+    if pd.api.types.is_datetime64_dtype(series.dtype):
+        return series
+    return pd.to_datetime(series)
+
+
+def _ns(series):
+    """Timestamps as int64 nanoseconds plus a NaT mask."""
+    values = _times(series).to_numpy(dtype="datetime64[ns]")
+    return values.view("int64"), np.isnat(values)
+
+
+def _suffix_overlap(left_columns, right_df, suffix):
+    """Renames right columns that collide with left ones, as pd.merge(suffixes=('', suffix)) does."""
+    overlap = set(left_columns) & set(right_df.columns)
+    if not overlap:
+        return right_df
+    return right_df.rename(columns={c: f"{c}{suffix}" for c in overlap})
+
+
+def forward_window_join(left_df, right_df, left_col, right_col, window, suffix):
+    """
+    Left join that attaches to every left row the farthest right row with
+    0 < right_col - left_col <= window. Left rows without such a row (or
+    with a missing timestamp) are kept with empty right columns.
+
+    Cost is one sort of the right side plus a binary search per left row,
+    O((n + m) log m), and the result has exactly len(left_df) rows in the
+    order of left_df.
+    """
+    window_ns = pd.Timedelta(window).value
+
+    right_ns, right_nat = _ns(right_df[right_col])
+    order = np.argsort(right_ns[~right_nat], kind="stable")
+    right_sorted = right_df[~right_nat].iloc[order].reset_index(drop=True)
+    right_ns = right_ns[~right_nat][order]
+
+    left_ns, left_nat = _ns(left_df[left_col])
+
+    # Last right event at or before left + window; it is the farthest one
+    # inside the window if it is still strictly after the left event.
+    idx = np.searchsorted(right_ns, left_ns + window_ns, side="right") - 1
+    valid = ~left_nat & (idx >= 0)
+    valid[valid] = right_ns[idx[valid]] > left_ns[valid]
+
+    if metrics.recording():
+        # Right rows inside each left row's window, before all but the farthest are dropped
+        lo = np.searchsorted(right_ns, left_ns, side="right")
+        pairs = np.where(valid, idx + 1 - lo, 0)
+        metrics.join(f"{left_col} -> {right_col}", len(left_df), len(right_df), pairs.sum(), valid.sum(), len(left_df))
+
+    # reindex with -1 yields an all-missing row, like an unmatched left join
+    matched = right_sorted.reindex(np.where(valid, idx, -1)).reset_index(drop=True)
+    matched = _suffix_overlap(left_df.columns, matched, suffix)
+
+    return pd.concat([left_df.reset_index(drop=True), matched], axis=1)
+
+
+def iter_forward_window_join(left_chunks, right_chunks, left_col, right_col, window, suffix):
+    """
+    forward_window_join() over two streams of chunks. The right chunks must
+    come sorted by right_col with missing timestamps last, and the present
+    left_col values must not decrease from chunk to chunk (missing ones may
+    be anywhere); the output of a forward_window_join() on a sorted left
+    frame has that property itself, so joins can be chained.
+
+    Only the right rows inside the window of the current left chunk are
+    held, so memory depends on the chunk size and the window, not on the
+    length of the streams. Yields one chunk per left chunk, equal to the
+    matching rows of the join on the whole frames.
+    """
+    window = pd.Timedelta(window)
+    right_chunks = iter(right_chunks)
+    buffer = next(right_chunks, None)
+    if buffer is None:  # an empty stream, e.g. a header-only log
+        buffer = pd.DataFrame({right_col: pd.Series(dtype="datetime64[ns]")})
+    empty = buffer.iloc[:0]
+    exhausted = False
+
+    for left in left_chunks:
+        times = _times(left[left_col])
+        if times.isna().all():
+            yield forward_window_join(left, empty, left_col, right_col, window, suffix)
+            continue
+        first, last = times.min(), times.max() + window
+        # Pull right chunks until the buffer reaches past the window end
+        while not exhausted and not (_times(buffer[right_col]) > last).any():
+            chunk = next(right_chunks, None)
+            if chunk is None:
+                exhausted = True
+            elif len(chunk):
+                buffer = pd.concat([buffer, chunk], ignore_index=True) if len(buffer) else chunk
+        # Rows at or before the first left event can match neither this chunk nor later ones
+        buffer = buffer[_times(buffer[right_col]) > first].reset_index(drop=True)
+        yield forward_window_join(left, buffer, left_col, right_col, window, suffix)
+
+
+def _row_bytes(df, sample=1000):
+    """Approximate in-memory bytes per row, measured on a sample of df."""
+    if len(df) == 0:
+        return 0
+    head = df.iloc[:sample]
+    return int(head.memory_usage(index=False, deep=True).sum() / len(head)) + 1
+
+
+def _fetch(right_rows, positions):
+    """The rows right_rows() reads for positions in any order, in that order."""
+    order = np.argsort(positions, kind="stable")
+    fetched = right_rows(positions[order])
+    return fetched.iloc[np.argsort(order)].reset_index(drop=True)
+
+
+def iter_window_join(left_df, right_df, left_col, right_col, window, suffix, max_memory_mb=None, right_rows=None):
+    """
+    Left join that pairs every left row with every right row where
+    0 < right_col - left_col <= window. Left rows without a partner (or with
+    a missing timestamp) are kept once with empty right columns, right rows
+    with a missing timestamp never match.
+
+    Only the matching pairs are ever materialised: the right frame is sorted
+    once, each left row gets its [lo, hi) range of right rows via
+    np.searchsorted, and the output is yielded in chunks of left rows whose
+    estimated size stays under max_memory_mb (None = one chunk). A single
+    left row is never split, so one chunk may exceed the ceiling if that row
+    alone has more partners than fit.
+
+    With right_rows, right_df only needs right_col and an index of row
+    positions; right_rows(positions) returns the full right rows at the
+    given sorted positions, and each chunk fetches just the rows it pairs
+    with, so a stored right frame never has to be loaded whole.
+
+    Every chunk has the same columns and dtypes (categories aside with
+    right_rows); at least one (possibly empty) chunk is always yielded.
+    """
+    window_ns = pd.Timedelta(window).value
+
+    right_ns, right_nat = _ns(right_df[right_col])
+    order = np.argsort(right_ns[~right_nat], kind="stable")
+    right_sorted = right_df[~right_nat].iloc[order]
+    positions = right_sorted.index.to_numpy()
+    right_sorted = right_sorted.reset_index(drop=True)
+    right_ns = right_ns[~right_nat][order]
+    # One extra all-missing row at position m stands in for "no partner", so
+    # every chunk gets the same (upcast) dtypes whether it has misses or not.
+    missing = len(right_sorted)
+    if right_rows is None:
+        right_ext = _suffix_overlap(left_df.columns, right_sorted.reindex(range(missing + 1)), suffix)
+    else:
+        right_sorted = _fetch(right_rows, positions[:1000])  # a sample for the size estimate
+
+    left = left_df.reset_index(drop=True)
+    left_ns, left_nat = _ns(left[left_col])
+
+    lo = np.searchsorted(right_ns, left_ns, side="right")
+    hi = np.searchsorted(right_ns, left_ns + window_ns, side="right")
+    counts = np.where(left_nat, 0, hi - lo)
+    out_counts = np.maximum(counts, 1)
+    metrics.join(f"{left_col} -> {right_col}", len(left), len(right_df), counts.sum(), (counts > 0).sum(), out_counts.sum())
+
+    if max_memory_mb is None:
+        max_rows = max(int(out_counts.sum()), 1)
+    else:
+        row_bytes = max(_row_bytes(left) + _row_bytes(right_sorted), 1)
+        max_rows = max(int(max_memory_mb * 2**20 // row_bytes), 1)
+
+    # Cut the left rows into runs whose output stays under max_rows
+    ends = np.cumsum(out_counts)
+    bounds = [0]
+    while bounds[-1] < len(left):
+        start_total = ends[bounds[-1] - 1] if bounds[-1] else 0
+        nxt = int(np.searchsorted(ends, start_total + max_rows, side="right"))
+        bounds.append(max(nxt, bounds[-1] + 1))
+
+    if len(bounds) == 1:
+        bounds.append(0)
+
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        rows = out_counts[a:b]
+        left_idx = np.repeat(np.arange(a, b), rows)
+        first = np.repeat(np.cumsum(rows) - rows, rows)
+        right_idx = np.repeat(lo[a:b], rows) + np.arange(len(left_idx)) - first
+        right_idx[np.repeat(counts[a:b] == 0, rows)] = missing
+        if right_rows is None:
+            right = right_ext.iloc[right_idx]
+        else:
+            hit = right_idx < missing
+            needed, local = np.unique(right_idx[hit], return_inverse=True)
+            fetched = _fetch(right_rows, positions[needed])
+            right_idx = np.full(len(right_idx), len(fetched))
+            right_idx[hit] = local
+            right = _suffix_overlap(left.columns, fetched.reindex(range(len(fetched) + 1)), suffix).iloc[right_idx]
+
+        yield pd.concat([
+            left.iloc[left_idx].reset_index(drop=True),
+            right.reset_index(drop=True),
+        ], axis=1)
+
+
+def window_join(left_df, right_df, left_col, right_col, window, suffix):
+    """iter_window_join() collected into one DataFrame."""
+    return pd.concat(list(iter_window_join(left_df, right_df, left_col, right_col, window, suffix)), ignore_index=True)
@@ -0,0 +1,212 @@
+"""
+Per-job LOT index.
+
+Built once at the end of a pipeline run from the LOT columns of final_data:
+every distinct normalized LOT value maps to the row offsets it occurs at,
+with a lower-cased variant for case-insensitive lookups. /search loads the
+index lazily and then only reads the matching rows of final_data.
+
+Partial and prefix lookups work on the distinct lower-cased LOTs through a
+trigram index, so they cost in the number of distinct LOTs and hits rather
+than in the number of rows.
+"""
+import bisect
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+import job_cache
+import store
+
+INDEX_NAME = "lot_index"
+LOT_COLUMNS = ["LOT A", "LOT B"]
+NGRAM = 3
+
+
+def normalize_lots(series):
+    """The LOT normalization /search has always applied to the table."""
+    return (
+        series.astype(object).fillna("").astype(str)
+        .str.strip()
+        .str.replace(r"\.0+$", "", regex=True)  # Remove trailing .0 or .00
+        .str.replace("nan", "", regex=False)    # Remove 'nan' strings
+    )
+
+
+def normalize_lot(value):
+    """normalize_lots() for a single value, without the pandas overhead."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    return re.sub(r"\.0+$", "", str(value).strip()).replace("nan", "")
+
+
+def build_index(job_dir, name="final_data"):
+    """Writes <job_dir>/lot_index.parquet for the LOT columns of a stored frame."""
+    present = [c for c in LOT_COLUMNS if c in store.columns(job_dir, name)]
+    df = store.read_frame(job_dir, name, columns=present)
+
+    # One row per (column, key, row offset), sorted by column and key
+    parts = []
+    for column in present:
+        keys = normalize_lots(df[column])
+        part = pd.DataFrame({"column": column, "key": keys, "row": np.arange(len(df), dtype="int64")})
+        parts.append(part[part["key"] != ""].sort_values("key", kind="stable"))
+    index = pd.concat(parts, ignore_index=True) if parts else \
+        pd.DataFrame({"column": [], "key": [], "row": []})
+    index = index.astype({"column": "string", "key": "string", "row": "int64"})
+    return store.write_frame(job_dir, INDEX_NAME, index)
+
+
+class LotIndex:
+    """In-memory form of a job's LOT index."""
+
+    def __init__(self, table, columns):
+        self.columns = list(columns)  # LOT columns final_data has
+        self._exact = {}
+        self._folded = {}
+        self._originals = {}  # lower-cased LOT -> the LOTs as written
+        for column, group in table.groupby("column", sort=False):
+            keys = group["key"].to_numpy(dtype=object)
+            rows = group["row"].to_numpy(dtype="int64")
+            bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+            for key, key_rows in zip(keys[np.concatenate([[0], bounds])] if len(keys) else [],
+                                     np.split(rows, bounds)):
+                self._exact.setdefault(column, {})[key] = key_rows
+                self._folded.setdefault(column, {}).setdefault(key.lower(), []).append(key_rows)
+                self._originals.setdefault(column, {}).setdefault(key.lower(), []).append(key)
+        self._folded = {
+            column: {k: np.sort(np.concatenate(v)) for k, v in folded.items()}
+            for column, folded in self._folded.items()
+        }
+        # Sorted distinct lower-cased LOTs and their trigram postings, per column
+        self._sorted = {column: sorted(folded) for column, folded in self._folded.items()}
+        self._grams = {}
+        # Rough size for the job cache: the row offsets and the LOT strings
+        self.nbytes = sum(rows.nbytes + sys.getsizeof(key) for exact in (self._exact, self._folded)
+                          for keys in exact.values() for key, rows in keys.items())
+
+    def keys(self, column):
+        return sorted(self._exact.get(column, {}))
+
+    def exact(self, column, value):
+        return self._exact.get(column, {}).get(value, np.empty(0, dtype="int64"))
+
+    def folded(self, column, value):
+        return self._folded.get(column, {}).get(value.lower(), np.empty(0, dtype="int64"))
+
+    def _postings(self, column):
+        """trigram -> sorted positions in self._sorted[column], built on first use."""
+        if column not in self._grams:
+            grams = {}
+            for i, key in enumerate(self._sorted.get(column, [])):
+                for gram in {key[j:j + NGRAM] for j in range(len(key) - NGRAM + 1)}:
+                    grams.setdefault(gram, []).append(i)
+            self._grams[column] = {gram: np.asarray(ids, dtype="int64") for gram, ids in grams.items()}
+        return self._grams[column]
+
+    def containing(self, column, value):
+        """Distinct lower-cased LOTs that contain value, in sorted order."""
+        needle = value.lower()
+        keys = self._sorted.get(column, [])
+        if len(needle) < NGRAM:
+            return [key for key in keys if needle in key]
+
+        postings = self._postings(column)
+        candidates = None
+        for gram in sorted({needle[j:j + NGRAM] for j in range(len(needle) - NGRAM + 1)},
+                           key=lambda g: len(postings.get(g, ()))):
+            ids = postings.get(gram)
+            if ids is None:
+                return []
+            candidates = ids if candidates is None else np.intersect1d(candidates, ids, assume_unique=True)
+            if not len(candidates):
+                return []
+        # Trigrams only narrow the candidates down; confirm the substring
+        return [keys[i] for i in candidates if needle in keys[i]]
+
+    def starting_with(self, column, value):
+        """Distinct lower-cased LOTs that start with value, in sorted order."""
+        prefix = value.lower()
+        keys = self._sorted.get(column, [])
+        start = bisect.bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+        return keys[start:end]
+
+    def partial(self, column, value):
+        """Rows whose LOT contains value, ignoring case."""
+        hits = [self._folded[column][key] for key in self.containing(column, value)]
+        return np.sort(np.concatenate(hits)) if hits else np.empty(0, dtype="int64")
+
+    def suggest(self, column, value, limit=10):
+        """
+        Typeahead: up to `limit` LOTs starting with value, then ones that
+        contain it elsewhere, each with its number of rows.
+        """
+        folded = self.starting_with(column, value)[:limit]
+        if len(folded) < limit:
+            seen = set(folded)
+            folded += [key for key in self.containing(column, value) if key not in seen][:limit - len(folded)]
+        exact = self._exact[column] if folded else {}
+        lots = [key for f in folded for key in self._originals[column][f]][:limit]
+        return [{"lot": key, "rows": len(exact[key])} for key in lots]
+
+    def match(self, column, value, within=None):
+        """
+        Same fallback /search has always used: exact match, then
+        case-insensitive, then partial. Returns (rows, kind), restricted to
+        the sorted row offsets in `within` if given.
+        """
+        for kind, lookup in (("Exact", self.exact), ("Case-insensitive", self.folded), ("Partial", self.partial)):
+            rows = lookup(column, value)
+            if within is not None:
+                rows = np.intersect1d(rows, within, assume_unique=True)
+            if len(rows):
+                return rows, kind
+        return rows, kind
+
+    def resolve(self, lots, columns=None):
+        """
+        Looks up many LOTs at once (exact, then case-insensitive; no partial
+        matches). lots are normalized like the table. Returns (hits, missing):
+        hits is a list of (lot, column, rows) in request order, missing the
+        LOTs no column had.
+        """
+        columns = self.columns if columns is None else [c for c in columns if c in self.columns]
+        keys = normalize_lots(pd.Series(list(lots), dtype=object))
+        hits, missing = [], []
+        for lot in dict.fromkeys(k for k in keys if k):
+            found = False
+            for column in columns:
+                rows = self.exact(column, lot)
+                if not len(rows):
+                    rows = self.folded(column, lot)
+                if len(rows):
+                    hits.append((lot, column, rows))
+                    found = True
+            if not found:
+                missing.append(lot)
+        return hits, missing
+
+
+def parse_lots(text):
+    """LOTs from pasted text or an uploaded list: one per line or comma separated, header lines skipped."""
+    lots = [part.strip().strip('"') for line in text.splitlines() for part in line.split(",")]
+    return [lot for lot in lots if lot and lot.lower() not in ("lot", "lot a", "lot b")]
+
+
+def load_index(job_dir, name="final_data"):
+    """
+    Returns the job's LotIndex, building it first for jobs that predate it.
+    Loaded indexes are kept in the job cache (see job_cache.py).
+    """
+    path = store.frame_path(job_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        build_index(job_dir, name)
+    columns = tuple(c for c in LOT_COLUMNS if c in store.columns(job_dir, name))
+    return job_cache.CACHE.get(("lot_index", path, os.path.getmtime(path), columns),
+                               lambda: LotIndex(pd.read_parquet(path), columns), lambda index: index.nbytes)
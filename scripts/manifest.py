@@ -0,0 +1,100 @@
+"""
+Precomputed summary of a job's final table.
+
+build_manifest() runs at the end of the pipeline and writes
+<job_dir>/manifest.json with what /debug reports: row count, columns, five
+sample rows, memory use and the unique LOT A/LOT B values, plus per-column
+stats (dtype, missing values, distinct values, min/max/mean). It reads the
+stored table one column at a time, so /debug never loads the table itself.
+"""
+import json
+import math
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import schema
+import store
+
+MANIFEST_FILE = "manifest.json"
+SAMPLE_ROWS = 5
+LOT_SAMPLE = 20
+
+
+def _number(value):
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def column_stats(series):
+    """dtype, missing and distinct values and, where they apply, min/max/mean of a column."""
+    stats = {
+        "dtype": str(series.dtype),
+        "missing": int(series.isna().sum()),
+        "memory_bytes": int(series.memory_usage(deep=True, index=False)),
+    }
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(dtype) \
+            or pd.api.types.is_string_dtype(dtype):
+        stats["distinct"] = int(series.nunique())
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+        stats["distinct"] = int(series.nunique())
+        present = series.dropna()
+        stats["min"] = present.min().isoformat() if len(present) else None
+        stats["max"] = present.max().isoformat() if len(present) else None
+    elif pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        stats["distinct"] = int(series.nunique())
+        present = series.dropna().astype("float64")
+        stats["min"] = _number(present.min()) if len(present) else None
+        stats["max"] = _number(present.max()) if len(present) else None
+        stats["mean"] = _number(present.mean()) if len(present) else None
+    return stats
+
+
+def _sample(job_dir, name):
+    batches = pq.ParquetFile(store.frame_path(job_dir, name)).iter_batches(batch_size=SAMPLE_ROWS)
+    head = next(batches, None)
+    if head is None:
+        return []
+    return json.loads(head.to_pandas().head(SAMPLE_ROWS).to_json(orient="records", date_format="iso"))
+
+
+def build_manifest(job_dir, name="final_data"):
+    """Writes <job_dir>/manifest.json for a stored frame and returns it."""
+    columns = store.columns(job_dir, name)
+    manifest = {
+        "total_rows": store.num_rows(job_dir, name),
+        "columns": columns,
+        "sample_data": _sample(job_dir, name),
+        "memory_bytes": 0,
+        "column_stats": {},
+    }
+    for column in columns:
+        series = store.read_frame(job_dir, name, columns=[column])[column]
+        stats = column_stats(series)
+        manifest["column_stats"][column] = stats
+        manifest["memory_bytes"] += stats["memory_bytes"]
+        if column in ("LOT A", "LOT B"):
+            key = column.lower().replace(" ", "_")
+            values = series.dropna().unique()
+            manifest[f"{key}_sample"] = [str(x) for x in values[:LOT_SAMPLE]]
+            manifest[f"{key}_count"] = len(values)
+
+    path = os.path.join(job_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+    return manifest
+
+
+def load_manifest(job_dir, name="final_data"):
+    """The job's manifest, built first for jobs that predate it."""
+    try:
+        with open(os.path.join(job_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = build_manifest(job_dir, name)
+    # Read on request, as /debug always did
+    manifest["memory_report"] = schema.load_report(job_dir, name)
+    return manifest
@@ -0,0 +1,348 @@
+"""
+Runtime metrics of the pipeline stages and of /search.
+
+A Recorder measures one unit of work, a stage run or a search call: wall
+time, CPU time, peak resident memory, and whatever the code inside it
+reports through count() and join(). The window joins use join() to report
+their fan-out, i.e. the rows on each side, the pairs inside the window and
+the rows that come out.
+
+Records are appended as JSON lines to <job>/metrics.jsonl, which
+/jobs/<id>/metrics summarizes; searches only keep their latest records there. Registry adds them up for the
+Prometheus-style /metrics endpoint; with several server processes each
+saves its totals to a file and /metrics adds those up.
+"""
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app runs as one process
+    fcntl = None
+
+METRICS_FILE = "metrics.jsonl"
+# A job's metrics file past this size keeps only its latest KEPT_SEARCHES search records
+MAX_FILE_BYTES = 1024 ** 2
+KEPT_SEARCHES = 1000
+PREFIX = "lot_trace"
+# Upper bounds (seconds) of the /search latency histogram
+SEARCH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RECENT_SEARCHES = 20
+
+_local = threading.local()
+
+
+def _reset_peak():
+    """Resets the process' peak RSS (VmHWM) where Linux allows it; returns whether it did."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _status(field):
+    """A memory field of /proc/self/status (e.g. VmRSS) in bytes, or None."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss():
+    """Peak resident memory of the process in bytes, or None."""
+    peak = _status("VmHWM")
+    if peak is not None or resource is None:
+        return peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+class Recorder:
+    """
+    Context manager that measures the work done inside it. cpu_clock is
+    time.process_time for a whole worker process, time.thread_time for a
+    request in a threaded server.
+
+    The peak RSS is the process' peak since it started (peak_rss_scope
+    "process"). With reset_peak, which only a process doing nothing else
+    at the time may ask for, e.g. a stage worker, the peak is reset first
+    where the kernel allows it and then covers the recorder alone
+    ("since_start"); the reset is process-wide and would spoil the peaks
+    of other recorders running alongside. rss_delta_bytes is the change of
+    the process' RSS from start to end, whatever else ran meanwhile.
+    """
+
+    def __init__(self, kind, name, cpu_clock=time.process_time, reset_peak=False):
+        self.cpu_clock = cpu_clock
+        self.reset_peak = reset_peak
+        self.record = {"kind": kind, "name": name, "counts": {}, "joins": {}}
+
+    def __enter__(self):
+        _stack().append(self)
+        self._scope = "since_start" if self.reset_peak and _reset_peak() else "process"
+        self._rss = _status("VmRSS")
+        self.record["started_at"] = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = self.cpu_clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _stack().remove(self)
+        rss = _status("VmRSS")
+        self.record.update(
+            wall_seconds=round(time.perf_counter() - self._wall, 6),
+            cpu_seconds=round(self.cpu_clock() - self._cpu, 6),
+            peak_rss_bytes=_peak_rss(),
+            peak_rss_scope=self._scope,
+            rss_bytes=rss,
+            rss_delta_bytes=rss - self._rss if rss is not None and self._rss is not None else None,
+            ok=exc_type is None,
+        )
+        return False
+
+    def count(self, key, n):
+        counts = self.record["counts"]
+        counts[key] = counts.get(key, 0) + int(n)
+
+    def join(self, label, **rows):
+        totals = self.record["joins"].setdefault(label, {})
+        for key, n in rows.items():
+            totals[key] = totals.get(key, 0) + int(n)
+
+
+def recording():
+    """Whether a Recorder is active in this thread; lets callers skip work only metrics need."""
+    return bool(_stack())
+
+
+def count(key, n):
+    """Adds n to a counter of the innermost active Recorder, if any."""
+    if _stack():
+        _stack()[-1].count(key, n)
+
+
+def join(label, left_rows, right_rows, window_pairs, matched, rows_out):
+    """
+    Reports the fan-out of a window join to the active Recorder: left and
+    right input rows, (left, right) pairs inside the window before any of
+    them is dropped, left rows with at least one pair and output rows.
+    """
+    if _stack():
+        _stack()[-1].join(label, left_rows=left_rows, right_rows=right_rows,
+                          window_pairs=window_pairs, matched=matched, rows_out=rows_out)
+
+
+def extend(job_dir, records):
+    """
+    Appends records to the job's metrics file. Once the file grows past
+    MAX_FILE_BYTES it is cut down to the stage records and the latest
+    KEPT_SEARCHES searches. Writers in other processes wait on a lock of
+    the file meanwhile.
+    """
+    with open(os.path.join(job_dir, METRICS_FILE), "a+") as f:
+        if fcntl is not None:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+        f.writelines(json.dumps(record, default=str) + "\n" for record in records)
+        f.flush()
+        if f.tell() > MAX_FILE_BYTES:
+            f.seek(0)
+            lines = f.readlines()
+            searches = [i for i, line in enumerate(lines) if _kind(line) == "search"]
+            dropped = set(searches[:len(searches) - KEPT_SEARCHES])
+            f.truncate(0)
+            f.writelines(line for i, line in enumerate(lines) if i not in dropped)
+
+
+def _kind(line):
+    try:
+        return json.loads(line).get("kind")
+    except (json.JSONDecodeError, AttributeError):
+        return None
+
+
+def append(job_dir, record):
+    """Appends a record to the job's metrics file."""
+    extend(job_dir, [record])
+
+
+def load(job_dir):
+    """All records of a job, oldest first; unreadable lines are skipped."""
+    records = []
+    try:
+        with open(os.path.join(job_dir, METRICS_FILE)) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summarize(records):
+    """
+    The view /jobs/<id>/metrics returns: every stage record, each with its
+    share of the stages' wall time and the fan-out of its joins, and the
+    searches as latency percentiles plus the most recent calls.
+    """
+    stages = [r for r in records if r["kind"] == "stage"]
+    total = sum(r["wall_seconds"] for r in stages)
+    for r in stages:
+        r["wall_share"] = round(r["wall_seconds"] / total, 4) if total else None
+        for rows in r["joins"].values():
+            rows["fan_out"] = round(rows["rows_out"] / rows["left_rows"], 4) if rows["left_rows"] else None
+
+    searches = [r for r in records if r["kind"] == "search"]
+    walls = [r["wall_seconds"] for r in searches]
+    latency = {}
+    if walls:
+        latency = {"p50": _percentile(walls, 0.5), "p95": _percentile(walls, 0.95), "max": max(walls),
+                   "mean": round(sum(walls) / len(walls), 6)}
+    return {
+        "stages": stages,
+        "stage_wall_seconds": round(total, 6),
+        "slowest_stage": max(stages, key=lambda r: r["wall_seconds"])["name"] if stages else None,
+        "searches": {"count": len(searches), "wall_seconds": latency, "recent": searches[-RECENT_SEARCHES:]},
+    }
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+class Registry:
+    """
+    Process-wide totals of the records seen, in the Prometheus text format.
+    Server processes each save() theirs, and merged() adds them up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # metric -> {labels tuple: value}
+        self._types = {}
+        self._help = {}
+        self._max = set()  # gauges that keep the highest value instead of a sum
+
+    def _add(self, metric, kind, help, value, labels=None, gauge_max=False):
+        labels = tuple((labels or {}).items())
+        with self._lock:
+            self._types[metric], self._help[metric] = kind, help
+            if gauge_max:
+                self._max.add(metric)
+            series = self._series.setdefault(metric, {})
+            if gauge_max:
+                series[labels] = max(series.get(labels, value), value)
+            else:
+                series[labels] = series.get(labels, 0) + value
+
+    def set(self, metric, help, value, **labels):
+        """Sets a gauge."""
+        with self._lock:
+            self._types[metric], self._help[metric] = "gauge", help
+            self._series.setdefault(metric, {})[tuple(labels.items())] = value
+
+    def save(self, path):
+        """Writes the totals to path atomically, for merged()."""
+        with self._lock:
+            state = {metric: {"type": self._types[metric], "help": self._help[metric], "max": metric in self._max,
+                              "series": [[list(labels), value] for labels, value in series.items()]}
+                     for metric, series in self._series.items()}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def merged(cls, paths):
+        """A registry with the totals saved at paths added up; peak gauges take the highest value."""
+        registry = cls()
+        for path in paths:
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            for metric, saved in state.items():
+                for labels, value in saved["series"]:
+                    registry._add(metric, saved["type"], saved["help"], value,
+                                  {key: label for key, label in labels}, gauge_max=saved["max"])
+        return registry
+
+    def observe(self, record):
+        """Adds a stage or search record to the totals."""
+        kind = record["kind"]
+        if kind == "stage":
+            stage = {"stage": record["name"]}
+            cached = "true" if record.get("cached") else "false"
+            self._add(f"{PREFIX}_stage_runs_total", "counter", "Pipeline stage runs.", 1,
+                      dict(stage, cached=cached, ok=str(record["ok"]).lower()))
+            self._add(f"{PREFIX}_stage_wall_seconds_total", "counter", "Wall time spent in pipeline stages.",
+                      record["wall_seconds"], stage)
+            self._add(f"{PREFIX}_stage_cpu_seconds_total", "counter", "CPU time spent in pipeline stages.",
+                      record["cpu_seconds"], stage)
+            if record.get("peak_rss_bytes") is not None:
+                self._add(f"{PREFIX}_stage_peak_rss_bytes", "gauge", "Highest peak RSS seen for a stage.",
+                          record["peak_rss_bytes"], stage, gauge_max=True)
+            for key in ("rows_in", "rows_out"):
+                self._add(f"{PREFIX}_stage_{key}_total", "counter", f"Pipeline stage {key.replace('_', ' ')}.",
+                          record["counts"].get(key, 0), stage)
+            for label, rows in record["joins"].items():
+                for key in ("left_rows", "right_rows", "window_pairs", "matched", "rows_out"):
+                    self._add(f"{PREFIX}_join_rows_total", "counter", "Rows through the window joins.",
+                              rows.get(key, 0), {"join": label, "rows": key})
+        elif kind == "search":
+            endpoint = {"endpoint": record["name"]}
+            self._add(f"{PREFIX}_search_requests_total", "counter", "Search requests.", 1,
+                      dict(endpoint, status=record.get("status", "")))
+            self._add(f"{PREFIX}_search_cpu_seconds_total", "counter", "CPU time spent in searches.",
+                      record["cpu_seconds"], endpoint)
+            self._add(f"{PREFIX}_search_rows_total", "counter", "Rows returned by searches.",
+                      record["counts"].get("rows_out", 0), endpoint)
+            metric = f"{PREFIX}_search_seconds"
+            for bound in SEARCH_BUCKETS + ("+Inf",):
+                hit = bound == "+Inf" or record["wall_seconds"] <= bound
+                self._add(metric + "_bucket", "histogram", "Search latency.", int(hit), dict(endpoint, le=bound))
+            self._add(metric + "_sum", "histogram", "Search latency.", record["wall_seconds"], endpoint)
+            self._add(metric + "_count", "histogram", "Search latency.", 1, endpoint)
+
+    def render(self):
+        """The totals in the Prometheus text exposition format."""
+        lines, described = [], set()
+        with self._lock:
+            for metric, series in self._series.items():
+                family = metric.rsplit("_", 1)[0] if self._types[metric] == "histogram" else metric
+                if family not in described:
+                    described.add(family)
+                    lines.append(f"# HELP {family} {self._help[metric]}")
+                    lines.append(f"# TYPE {family} {self._types[metric]}")
+                for labels, value in series.items():
+                    lines.append(f"{metric}{_labels(dict(labels))} {value}")
+        return "\n".join(lines) + "\n"
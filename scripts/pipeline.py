@@ -0,0 +1,397 @@
+"""
+Pipeline runner.
+
+The four stages form a small DAG:
+
+    clean_raw_data -> merge_raw_w_etch --+
+                                         +--> tbl_merge
+    cde_merger --------------------------+
+
+run_pipeline() starts every stage as soon as the stages it needs are done,
+on a pool of worker processes, so the Excel branch and the tool log sync
+run side by side. The pool is kept for the later runs of the process, so
+its workers import pandas and the stage modules only once. Stages hand their outputs over through the job's columnar
+store (see store.py) instead of intermediate XLSX/CSV files, and reuse them
+from the stage cache (see cache.py) when the stage's inputs and code are
+unchanged.
+"""
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+import uuid
+from collections import namedtuple
+
+import pandas as pd
+
+import cache
+import cde_merger
+import clean_raw_data
+import genealogy
+import incremental
+import joins
+import lot_index
+import manifest
+import merge_raw_w_etch
+import metrics
+import schema
+import store
+import tbl_merge
+import tool_logs
+import uploads
+import workbook
+
+# Memory ceiling for one chunk of the 6h window join output
+MAX_JOIN_MEMORY_MB = 256
+# Stages that may run at the same time; the DAG is two branches wide
+STAGE_WORKERS = 2
+# Seconds between checks of the running stages
+POLL_INTERVAL = 0.2
+
+FINAL = "final_data"
+FINAL_CSV = FINAL + ".csv"
+
+
+class StageError(Exception):
+    """Raised when a pipeline stage fails; carries the position of the stage."""
+
+    def __init__(self, step, total, stage, details):
+        super().__init__(step, total, stage, details)
+        self.step = step
+        self.total = total
+        self.stage = stage
+        self.details = details
+
+    def __str__(self):
+        return f"Pipeline failed at step {self.step}/{self.total}: {self.stage}"
+
+
+class StageTimeout(StageError):
+    """Raised when a stage runs longer than the stage timeout."""
+
+    def __init__(self, step, total, stage, timeout):
+        super().__init__(step, total, stage, f"TimeoutError: no result after {timeout} seconds")
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"Script {self.stage} timed out after {self.timeout // 60} minutes"
+
+
+class Run:
+    """State of one pipeline run, handed to each stage's worker process."""
+
+    def __init__(self, job_dir, base_dir=None, cache_dir=None):
+        self.id = uuid.uuid4().hex
+        self.job_dir = job_dir
+        # Taken here rather than in the workers, which keep the CACHE_DIR of when the pool started
+        self.cache_dir = cache_dir or cache.CACHE_DIR
+        self.frames = {}
+        self.digests = {}
+        self.keys = {}
+        self.base = None
+        if base_dir is not None:
+            self.base = incremental.load_state(base_dir)
+            if self.base is None:
+                print(f"Base job {base_dir} has no incremental state, running in full")
+            else:
+                self.base["dir"] = base_dir
+
+    def path(self, name):
+        return os.path.join(self.job_dir, name)
+
+
+def _clean_raw_data(run):
+    raw = clean_raw_data.load_raw_data(run.path("raw_data.xlsx"), run.digests["raw_data.xlsx"], run.cache_dir)
+    metrics.count("rows_in", len(raw))
+    run.frames["cleaned_raw_data"] = clean_raw_data.clean_raw_data(raw)
+
+
+def _merge_raw_w_etch(run):
+    batches = pd.read_csv(run.path("tbl_etching_batch.csv"))
+    metrics.count("rows_in", len(batches))
+    run.frames["final_combined_data_raw_etch"] = merge_raw_w_etch.merge_raw_with_etch(
+        run.frames["cleaned_raw_data"], batches
+    )
+
+
+def _cde_merger(run):
+    result = None
+    if run.base is not None:
+        result = incremental.sync_tool_logs(run.job_dir, run.base["dir"], run.base["sources"])
+    if result is None:
+        # Sorted out of core into the job state, then synced chunk by chunk
+        synced = cde_merger.iter_sync_sorted_logs(*incremental.sort_tool_logs(run.job_dir))
+    else:
+        synced, run.base["cutoff"] = result
+    report = schema.MemoryReport("final_sequential_sync")
+    store.write_chunks(run.job_dir, "final_sequential_sync", (report.apply(chunk) for chunk in synced))
+    report.save(run.job_dir)
+    incremental.save_state(run.job_dir, run.digests)
+
+
+def _tbl_merge(run):
+    # The 6h expansion is the only stage whose output can outgrow memory, so
+    # it is streamed to the store in bounded chunks instead of kept in frames.
+    # The sync table is read from the store row by row as the join needs it
+    sync_keys, sync_rows = tbl_merge.stored_sync(run.job_dir)
+    chunks = None
+    if run.base is not None and "cutoff" in run.base:
+        chunks = incremental.iter_merge_sync_with_batches(
+            run.digests, run.base["dir"], run.base["inputs"],
+            sync_keys, run.frames["final_combined_data_raw_etch"],
+            run.base["cutoff"], max_memory_mb=MAX_JOIN_MEMORY_MB, sync_rows=sync_rows,
+        )
+    if chunks is None:
+        chunks = tbl_merge.iter_merge_sync_with_batches(
+            sync_keys, run.frames["final_combined_data_raw_etch"],
+            max_memory_mb=MAX_JOIN_MEMORY_MB, sync_rows=sync_rows,
+        )
+    report = schema.MemoryReport(FINAL)
+    store.write_chunks(run.job_dir, FINAL, (report.apply(chunk) for chunk in chunks))
+    report.save(run.job_dir)
+    lot_index.build_index(run.job_dir, FINAL)
+    genealogy.build_graph(run.job_dir, FINAL)
+    manifest.build_manifest(run.job_dir, FINAL)
+    # The download everybody takes, ready in every encoding
+    store.precompress(store.export_frame(run.job_dir, FINAL, "csv"))
+
+
+# name:    kept identical to the old script names so that error messages and
+#          logs look the same as before
+# inputs:  uploaded files the stage reads
+# needs:   outputs of earlier stages the stage reads
+# outputs: store frames the stage writes
+# files:   any other files the stage writes, relative to the job directory
+# code:    hash of the modules whose source is part of the stage's cache key
+Stage = namedtuple("Stage", "name run inputs needs outputs files code")
+
+STAGES = [
+    Stage("clean_raw_data.py", _clean_raw_data,
+          inputs=["raw_data.xlsx"], needs=[], outputs=["cleaned_raw_data"], files=[],
+          code=cache.code_version(clean_raw_data, workbook, schema, store)),
+    Stage("merge_raw_w_etch.py", _merge_raw_w_etch,
+          inputs=["tbl_etching_batch.csv"], needs=["cleaned_raw_data"],
+          outputs=["final_combined_data_raw_etch"], files=[],
+          code=cache.code_version(merge_raw_w_etch, schema, store)),
+    Stage("cde_merger.py", _cde_merger,
+          inputs=list(incremental.TOOL_LOGS), needs=[],
+          outputs=["final_sequential_sync"], files=incremental.state_files(),
+          code=cache.code_version(cde_merger, joins, incremental, tool_logs, schema, store)),
+    Stage("tbl_merge.py", _tbl_merge,
+          inputs=[], needs=["final_sequential_sync", "final_combined_data_raw_etch"],
+          outputs=[FINAL],
+          files=[lot_index.INDEX_NAME + store.EXTENSION, genealogy.GRAPH_FILE, manifest.MANIFEST_FILE, FINAL_CSV] +
+          [FINAL_CSV + suffix for suffix in store.ENCODINGS.values()],
+          code=cache.code_version(tbl_merge, cde_merger, joins, lot_index, genealogy, manifest, schema, store)),
+]
+
+
+# Stages that read from the base job of an incremental run
+BASE_STAGES = {"cde_merger.py", "tbl_merge.py"}
+# Needs the stages read from the store themselves instead of from run.frames
+STREAMED = {"final_sequential_sync"}
+
+
+def _stage_key(run, stage):
+    """
+    Cache key of a stage: its code, its input files, the keys of the stages
+    it reads from and, in an incremental run, the base job it reads from.
+    """
+    producers = {output: run.keys[s.name] for s in STAGES if s.name in run.keys for output in s.outputs}
+    parts = [stage.name, stage.code]
+    parts += [f"{name}={run.digests[name]}" for name in stage.inputs]
+    parts += [f"{need}={producers[need]}" for need in stage.needs]
+    if run.base is not None and stage.name in BASE_STAGES:
+        parts.append(f"base={os.path.abspath(run.base['dir'])}")
+    return cache.make_key(*parts)
+
+
+def _stage_files(stage):
+    return [output + ext for output in stage.outputs for ext in (store.EXTENSION, schema.REPORT_SUFFIX)] + stage.files
+
+
+def _run_cached(run, stage):
+    """
+    Restores a stage's outputs from the cache, or runs it and caches them.
+    Returns whether the cache had them.
+    """
+    key = run.keys[stage.name] = _stage_key(run, stage)
+    if cache.restore(key, run.job_dir, _stage_files(stage), cache_dir=run.cache_dir):
+        print(f"Cache hit for {stage.name}, skipping")
+        return True
+
+    for need in stage.needs:
+        metrics.count("rows_in", store.num_rows(run.job_dir, need))
+        if need not in STREAMED:
+            run.frames[need] = store.read_frame(run.job_dir, need)
+    produced = set(run.frames)
+    stage.run(run)
+    for output in set(run.frames) - produced:
+        report = schema.MemoryReport(output)
+        store.write_frame(run.job_dir, output, report.apply(run.frames[output]))
+        report.save(run.job_dir)
+    cache.put(key, run.job_dir, _stage_files(stage), cache_dir=run.cache_dir)
+    return False
+
+
+def _run_stage(run, index):
+    """
+    Pool worker: runs STAGES[index] with the state of the run so far.
+    Returns what the stage adds to that state, or {"error": ...} if it
+    failed, along with the stage's metrics record.
+    """
+    if _start_queue is not None:
+        _start_queue.put((run.id, index, time.time()))
+    stage = STAGES[index]
+    # A pool worker runs one stage at a time, so it may reset the peak RSS
+    recorder = metrics.Recorder("stage", stage.name, reset_peak=True)
+    try:
+        with recorder:
+            for name in stage.inputs:
+                # Uploads were hashed on arrival (see uploads.py)
+                run.digests[name] = uploads.known_digest(run.path(name)) or incremental.file_digest(run.path(name))
+            recorder.record["cached"] = _run_cached(run, stage)
+            for output in stage.outputs:
+                metrics.count("rows_out", store.num_rows(run.job_dir, output))
+    except Exception as e:
+        print(f"Pipeline error in {stage.name}: {traceback.format_exc()}")
+        return {"error": f"{type(e).__name__}: {e}", "metrics": recorder.record}
+    print(f"Script {stage.name} completed successfully")
+    return {
+        "key": run.keys[stage.name],
+        "digests": {name: run.digests[name] for name in stage.inputs},
+        "base": run.base,
+        "metrics": recorder.record,
+    }
+
+
+def preload():
+    """Worker initializer: the stage modules (and pandas) are imported once per process."""
+    return [stage.name for stage in STAGES]
+
+
+_pool = None
+_pool_pid = None  # a forked child, e.g. an app pipeline worker, inherits _pool but not its processes
+# (run id, stage index, start time) of every stage a pool worker starts
+_start_queue = None
+
+
+def _init_worker(start_queue):
+    global _start_queue
+    _start_queue = start_queue
+    preload()
+
+
+def get_pool():
+    """The stage worker pool of this process, started on first use."""
+    global _pool, _pool_pid, _start_queue
+    if _pool is None or _pool_pid != os.getpid():
+        _start_queue = multiprocessing.Queue()
+        _pool = multiprocessing.Pool(STAGE_WORKERS, initializer=_init_worker, initargs=(_start_queue,))
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def stop_pool():
+    """Terminates the stage worker pool and whatever stages it runs; the next run starts a new one."""
+    global _pool, _pool_pid, _start_queue
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.terminate()
+        _pool.join()
+    _pool, _pool_pid, _start_queue = None, None, None
+
+
+def run_pipeline(job_dir, progress=None, base_dir=None, stage_timeout=None, cache_dir=None):
+    """
+    Runs every stage for the files in job_dir and stores every stage output,
+    final_data included, as parquet in job_dir, along with the LOT index
+    /search uses (see lot_index.py), the genealogy graph (genealogy.py), the
+    summary /debug serves (manifest.py) and final_data.csv with its
+    compressed copies for downloads.
+    Each stage's timings, peak memory and row counts are appended to the
+    job's metrics file (see metrics.py).
+    Stage outputs are cached in cache_dir, by default cache.CACHE_DIR.
+    Stages run as soon as the stages they need are done, at most
+    STAGE_WORKERS at a time.
+    progress(step, total, name, running) is called whenever a stage starts
+    or ends: step stages have been started, name is the last of them and
+    running maps the stages running now to their start times.
+    With base_dir (a finished job), only tool log rows appended since that
+    job are processed where possible (see incremental.py).
+    Raises StageError if a stage fails, StageTimeout if one runs longer
+    than stage_timeout seconds from when a worker started it; the other
+    running stages are stopped.
+    """
+    run = Run(job_dir, base_dir, cache_dir)
+    total = len(STAGES)
+    producers = {output: stage.name for stage in STAGES for output in stage.outputs}
+    done = set()
+    running = {}  # stage index -> (async result, time queued, time started or None)
+    last = None
+
+    def report():
+        if progress is not None:
+            progress(len(done) + len(running), total, last,
+                     {STAGES[i].name: started or queued for i, (_, queued, started) in running.items()})
+
+    def note_starts():
+        # A stage may wait in the pool's queue; its timeout counts from when a worker takes it
+        started = False
+        while True:
+            try:
+                run_id, i, at = _start_queue.get_nowait()
+            except queue.Empty:
+                return started
+            if run_id == run.id and i in running:
+                running[i] = running[i][:2] + (at,)
+                started = True
+
+    pool = get_pool()
+    try:
+        while len(done) < total:
+            for i, stage in enumerate(STAGES):
+                ready = all(producers[need] in done for need in stage.needs)
+                if ready and stage.name not in done and i not in running:
+                    running[i] = (pool.apply_async(_run_stage, (run, i)), time.time(), None)
+                    last = stage.name
+                    report()
+
+            finished = note_starts()
+            for i, (result, _, started) in list(running.items()):
+                stage = STAGES[i]
+                if result.ready():
+                    try:
+                        outcome = result.get()
+                    except Exception as e:
+                        outcome = {"error": f"{type(e).__name__}: {e}"}
+                    del running[i]
+                    if "metrics" in outcome:
+                        metrics.append(job_dir, outcome["metrics"])
+                    if "error" in outcome:
+                        raise StageError(i + 1, total, stage.name, outcome["error"])
+                    run.keys[stage.name] = outcome["key"]
+                    run.digests.update(outcome["digests"])
+                    if run.base is not None:
+                        run.base.update(outcome["base"])
+                    done.add(stage.name)
+                    finished = True
+                elif stage_timeout is not None and started is not None and time.time() - started > stage_timeout:
+                    print(f"Pipeline error in {stage.name}: no result after {stage_timeout} seconds")
+                    raise StageTimeout(i + 1, total, stage.name, stage_timeout)
+            if finished:
+                report()
+            elif running:
+                next(iter(running.values()))[0].wait(POLL_INTERVAL)
+    except BaseException:
+        if running:
+            stop_pool()  # stops the other stages of the failed run
+        raise
+
+    incremental.save_inputs(job_dir, run.digests)
+    return store.frame_path(job_dir, FINAL)
+
+
+if __name__ == "__main__":
+    run_pipeline(os.getcwd())
+    store.export_frame(os.getcwd(), FINAL, "csv")
@@ -0,0 +1,172 @@
+"""
+Compact dtypes of the pipeline tables.
+
+Every stage output goes through apply() before it is stored, so the
+traceability table is compact wherever it is loaded. Types follow the
+dtypes the stages produce rather than a list of every column, as the
+supplier workbook and tool logs carry columns the pipeline never names:
+
+- float64 columns become float32 when every value has at most 7
+  significant digits, which float32 keeps as written, so CSV exports do
+  not change, or was a float32 before; whole numbers past that (IDs) stay
+  float64;
+- int64 columns become int32 when the values fit; smaller types would let
+  the chunks of one table disagree (see store.write_chunks());
+- the LOT columns and a supplier column become string categoricals;
+- the workbook Date, the batch Created and the tool timestamps become
+  datetime64.
+
+Everything else keeps the dtype the stage gave it.
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import lot_index
+
+CATEGORY = "category"
+DATETIME = "datetime64[ns]"
+
+# Columns of the CoA workbook, the batch table and the tool logs the stages use by name
+DATETIMES = ["Date", "Created", "timestamp_cleaner", "timestamp_developer", "timestamp_etcher"]
+SUPPLIER = "supplier"  # a column with this in its name holds the supplier
+FLOAT32_DIGITS = 7
+
+REPORT_SUFFIX = ".memory.json"
+
+
+def declared(column):
+    """The dtype a column gets by its name, or None when its values decide."""
+    if column in lot_index.LOT_COLUMNS or SUPPLIER in str(column).lower():
+        return CATEGORY
+    if column in DATETIMES:
+        return DATETIME
+    return None
+
+
+def _as_category(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        if series.cat.categories.dtype == object:
+            return series
+        series = series.astype(object)
+    # Labels are stored as strings: Excel mixes numbers and text in them,
+    # and parquet only restores categoricals of strings on read
+    series = series.where(series.isna(), series.astype(str))
+    return series.astype(CATEGORY)
+
+
+def _as_datetime(series):
+    if pd.api.types.is_datetime64_dtype(series.dtype):
+        return series  # pd.to_datetime() is slow on columns that already are
+    return pd.to_datetime(series, errors="coerce")
+
+
+def _fits_float32(values):
+    """
+    Whether every value is a float32 already (one widened on the way) or
+    has no more than FLOAT32_DIGITS significant digits.
+    """
+    values = values[np.isfinite(values) & (values.astype(np.float32) != values)]
+    scaled = values * 10.0 ** (FLOAT32_DIGITS - 1 - np.floor(np.log10(np.abs(values))))
+    return bool((np.abs(scaled - np.round(scaled)) < 1e-4).all())
+
+
+def _downcast(series):
+    """A float64 or int64 column in the smaller type that holds it, else the column."""
+    if series.dtype == np.float64 and _fits_float32(series.to_numpy()):
+        return series.astype(np.float32)
+    if series.dtype == np.int64 and len(series):
+        info = np.iinfo(np.int32)
+        if info.min <= series.min() and series.max() <= info.max:
+            return series.astype(np.int32)
+    return series
+
+
+def apply(df):
+    """df with the compact dtypes described above; returns a new frame."""
+    df = df.copy()
+    for column in df.columns:
+        dtype = declared(column)
+        try:
+            if dtype == CATEGORY:
+                df[column] = _as_category(df[column])
+            elif dtype == DATETIME:
+                df[column] = _as_datetime(df[column])
+            else:
+                df[column] = _downcast(df[column])
+        except (TypeError, ValueError) as e:
+            print(f"Schema: kept {column} as {df[column].dtype} ({e})")
+    return df
+
+
+def memory_usage(df):
+    """Bytes held by df, strings and categories included."""
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+
+def _widened(df):
+    """df with pandas' default dtypes (object labels, 64-bit numbers), as a CSV read gives it."""
+    df = df.copy()
+    for column in df.columns:
+        dtype = df[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+        elif pd.api.types.is_float_dtype(dtype):
+            df[column] = df[column].astype("float64")
+        elif pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+            df[column] = df[column].astype("int64")
+    return df
+
+
+class MemoryReport:
+    """
+    Memory of a table with pandas' default dtypes and with the ones apply()
+    gives it, added up over its chunks.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.before = 0
+        self.after = 0
+
+    def apply(self, df):
+        """apply() that also records the memory use of df before and after."""
+        converted = apply(df)
+        self.rows += len(df)
+        self.before += memory_usage(_widened(converted))
+        self.after += memory_usage(converted)
+        return converted
+
+    def as_dict(self):
+        return {"table": self.name, "rows": self.rows, "before_bytes": self.before, "after_bytes": self.after}
+
+    def save(self, job_dir):
+        with open(os.path.join(job_dir, self.name + REPORT_SUFFIX), "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+        saved = 100 * (1 - self.after / self.before) if self.before else 0
+        print(f"Memory {self.name}: {self.before / 2**20:.1f} MiB -> {self.after / 2**20:.1f} MiB ({saved:.0f}% less)")
+
+
+def load_report(job_dir, name):
+    """The saved MemoryReport of a table as a dict, or None."""
+    try:
+        with open(os.path.join(job_dir, name + REPORT_SUFFIX)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+if __name__ == "__main__":
+    # Compares final_data read back the old way (CSV, default dtypes) with the stored table:
+    # python schema.py jobs/<uuid>
+    import store
+    job_dir = sys.argv[1] if len(sys.argv) > 1 else "."
+    csv = store.export_frame(job_dir, "final_data", "csv")
+    before = memory_usage(pd.read_csv(csv))
+    after = memory_usage(store.read_frame(job_dir, "final_data"))
+    print(f"final_data.csv with default dtypes: {before / 2**20:.1f} MiB")
+    print(f"final_data with the compact dtypes: {after / 2**20:.1f} MiB ({100 * (1 - after / before):.0f}% less)")
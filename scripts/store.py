@@ -0,0 +1,295 @@
+"""
+Typed columnar storage for pipeline stage outputs.
+
+Every stage output is kept as <job_dir>/<name>.parquet so dtypes (datetimes,
+dates, ints) survive between stages and later reads. CSV/XLSX files are only
+written by export_frame() when somebody asks for them, except final_data.csv,
+which the pipeline exports once along with gzip and zstd copies for
+downloads (see precompress()).
+"""
+import contextlib
+import gzip
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+EXTENSION = ".parquet"
+EXPORT_FORMATS = ("csv", "xlsx")
+# Small enough row groups that read_rows() can fetch a few rows cheaply
+ROW_GROUP_SIZE = 64 * 1024
+# Content codings of precompressed exports, in order of preference
+ENCODINGS = {"zstd": ".zst", "gzip": ".gz"}
+GZIP_LEVEL = 6
+COPY_BLOCK = 1024 * 1024
+
+
+def frame_path(job_dir, name):
+    return os.path.join(job_dir, name + EXTENSION)
+
+
+def exists(job_dir, name):
+    return os.path.exists(frame_path(job_dir, name))
+
+
+def _as_strings(series):
+    return series.where(series.isna(), series.astype(str))
+
+
+def _to_arrow(df, schema=None):
+    """
+    Converts df to an Arrow table. Object columns Arrow cannot type as a
+    scalar (mixed numbers and strings from Excel, tuples) are stored as
+    strings, missing values stay missing. With a schema, object columns the schema declares
+    as strings are stringified so later chunks fit the first one.
+    """
+    df = df.copy()
+    df.columns = [str(c) for c in df.columns]
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        if schema is not None:
+            if pa.types.is_string(schema.field(col).type):
+                df[col] = _as_strings(df[col])
+            continue
+        try:
+            inferred = pa.array(df[col], from_pandas=True).type
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            inferred = None
+        if inferred is None or pa.types.is_nested(inferred):
+            df[col] = _as_strings(df[col])
+        elif pa.types.is_null(inferred):
+            df[col] = df[col].astype(pd.StringDtype())
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    if schema is None:
+        # Categoricals get the widest dictionary index, so later chunks with
+        # more categories still fit the schema of the first one
+        fields = [pa.field(f.name, pa.dictionary(pa.int32(), f.type.value_type))
+                  if pa.types.is_dictionary(f.type) else f for f in table.schema]
+        table = table.cast(pa.schema(fields, metadata=table.schema.metadata))
+    return table
+
+
+def write_frame(job_dir, name, df):
+    """Writes a stage output atomically and returns its path."""
+    path = frame_path(job_dir, name)
+    tmp = path + ".tmp"
+    pq.write_table(_to_arrow(df), tmp, row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp, path)
+    return path
+
+
+def _numeric(df):
+    """The numpy int/float dtypes of df's columns."""
+    return {col: dtype for col, dtype in df.dtypes.items()
+            if isinstance(dtype, np.dtype) and dtype.kind in "iuf"}
+
+
+def widen(df, dtypes):
+    """
+    df with the columns in dtypes cast to those (wider) numeric dtypes.
+    float32 values widen to the float64 they print as, so 0.1 stays 0.1
+    instead of becoming 0.10000000149011612.
+    """
+    casts = {col: dtype for col, dtype in dtypes.items() if col in df.columns and df[col].dtype != dtype}
+    if not casts:
+        return df
+    df = df.copy()
+    for col, dtype in casts.items():
+        if df[col].dtype == np.float32 and dtype == np.float64:
+            df[col] = df[col].astype(str).astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def _promoted(dtypes, df):
+    """The numeric columns of df that need a wider dtype than dtypes; {column: dtype}."""
+    wider = {}
+    for col, dtype in _numeric(df).items():
+        if col in dtypes:
+            promoted = np.promote_types(dtypes[col], dtype)
+            if promoted != dtypes[col]:
+                wider[col] = promoted
+    return wider
+
+
+def concat(frames):
+    """
+    pd.concat() of frames whose numeric columns may differ in width (the
+    dtypes schema.apply() chose for each); each column gets the widest.
+    """
+    dtypes = {}
+    for df in frames:
+        for col, dtype in _numeric(df).items():
+            dtypes[col] = np.promote_types(dtypes.get(col, dtype), dtype)
+    return pd.concat([widen(df, dtypes) for df in frames], ignore_index=True)
+
+
+def _rewrite(path, wider):
+    """Rewrites the parquet file at path with the columns in wider widened; returns an open writer on it."""
+    old = path + ".old"
+    os.replace(path, old)
+    f = pq.ParquetFile(old)
+    schema = f.schema_arrow
+    fields = [pa.field(field.name, pa.from_numpy_dtype(wider[field.name]))
+              if field.name in wider else field for field in schema]
+    writer = pq.ParquetWriter(path, pa.schema(fields, metadata=schema.metadata))
+    for batch in f.iter_batches(batch_size=ROW_GROUP_SIZE):
+        writer.write_table(_to_arrow(widen(batch.to_pandas(), wider), writer.schema),
+                           row_group_size=ROW_GROUP_SIZE)
+    os.remove(old)
+    return writer
+
+
+def write_chunks(job_dir, name, chunks):
+    """
+    Streams DataFrame chunks with identical columns into one parquet file,
+    so the whole frame never has to be held in memory. The schema is taken
+    from the first chunk and widened when a later chunk needs a wider
+    numeric dtype (schema.apply() decides per chunk), rewriting what was
+    written so far; narrower chunks are widened to the schema, never the
+    other way round. Returns (path, rows).
+    """
+    path = frame_path(job_dir, name)
+    tmp = path + ".tmp"
+    writer = None
+    written = False
+    dtypes = {}
+    rows = 0
+    try:
+        for chunk in chunks:
+            if writer is not None:
+                wider = _promoted(dtypes, chunk)
+                if wider:
+                    writer.close()
+                    writer = None
+                    writer = _rewrite(tmp, wider)
+                    dtypes.update(wider)
+                chunk = widen(chunk, dtypes)
+            table = _to_arrow(chunk, None if writer is None else writer.schema)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp, table.schema)
+                written = True
+                dtypes = _numeric(chunk)
+            writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if not written:
+        raise ValueError(f"No data to write for {name}")
+    os.replace(tmp, path)
+    return path, rows
+
+
+def read_frame(job_dir, name, columns=None):
+    """Reads a stage output back with its stored dtypes."""
+    return pd.read_parquet(frame_path(job_dir, name), columns=columns)
+
+
+def columns(job_dir, name):
+    """Column names of a stored frame, read from the parquet footer only."""
+    return pq.read_schema(frame_path(job_dir, name)).names
+
+
+def num_rows(job_dir, name):
+    """Row count of a stored frame, read from the parquet footer only."""
+    return pq.ParquetFile(frame_path(job_dir, name)).metadata.num_rows
+
+
+def read_rows(job_dir, name, rows):
+    """
+    Reads the rows at the given sorted offsets of a stored frame, decoding
+    only the row groups that contain them.
+    """
+    f = pq.ParquetFile(frame_path(job_dir, name))
+    sizes = [f.metadata.row_group(i).num_rows for i in range(f.num_row_groups)]
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    rows = np.asarray(rows, dtype="int64")
+    groups = np.searchsorted(starts, rows, side="right") - 1
+    needed = np.unique(groups)
+    table = f.read_row_groups(needed.tolist()) if len(needed) else f.schema_arrow.empty_table()
+    # Offsets of the needed groups within the concatenated table
+    offset = np.concatenate([[0], np.cumsum(np.asarray(sizes, dtype="int64")[needed])])
+    local = rows - starts[groups] + offset[np.searchsorted(needed, groups)]
+    return table.take(pa.array(local, type=pa.int64())).to_pandas()
+
+
+def empty_frame(job_dir, name):
+    """A stored frame's columns and dtypes without its rows, read from the parquet footer only."""
+    return pq.read_schema(frame_path(job_dir, name)).empty_table().to_pandas()
+
+
+def iter_frame(job_dir, name, rows=None):
+    """A stored frame in chunks of up to `rows` rows (ROW_GROUP_SIZE); an empty one as a single empty chunk."""
+    f = pq.ParquetFile(frame_path(job_dir, name))
+    if not f.metadata.num_rows:
+        yield f.schema_arrow.empty_table().to_pandas()
+        return
+    for batch in f.iter_batches(batch_size=rows or ROW_GROUP_SIZE):
+        yield batch.to_pandas()
+
+
+def export_frame(job_dir, name, fmt="csv"):
+    """
+    Produces <name>.csv / <name>.xlsx from the stored frame and returns its
+    path. CSV is written chunk by chunk, so the frame is never in memory
+    whole; an XLSX sheet holds at most about a million rows and is written
+    in one go.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    path = os.path.join(job_dir, f"{name}.{fmt}")
+    tmp = os.path.join(job_dir, f".{name}.tmp.{fmt}")
+    if fmt == "csv":
+        with open(tmp, "w", newline="") as f:
+            for i, chunk in enumerate(iter_frame(job_dir, name)):
+                chunk.to_csv(f, index=False, header=i == 0)
+    else:
+        read_frame(job_dir, name).to_excel(tmp, index=False)
+    os.replace(tmp, path)
+    return path
+
+
+@contextlib.contextmanager
+def _compressed(path, encoding):
+    """A binary file at path that compresses what is written to it."""
+    if encoding == "gzip":
+        # No file name or time in the header, so equal files compress equally
+        with open(path, "wb") as f, gzip.GzipFile(filename="", mode="wb", fileobj=f,
+                                                   compresslevel=GZIP_LEVEL, mtime=0) as out:
+            yield out
+    else:
+        with pa.CompressedOutputStream(path, encoding) as out:  # standard zstd frames
+            yield out
+
+
+def precompress(path):
+    """Writes <path>.zst and <path>.gz next to an exported file; returns their paths."""
+    paths = []
+    for encoding, suffix in ENCODINGS.items():
+        tmp = f"{path}{suffix}.tmp"
+        with open(path, "rb") as src, _compressed(tmp, encoding) as dst:
+            shutil.copyfileobj(src, dst, COPY_BLOCK)
+        os.replace(tmp, path + suffix)
+        paths.append(path + suffix)
+    return paths
+
+
+def precompressed(path, encodings):
+    """
+    (encoding, path) of the precompressed copy of path to send to a client
+    that accepts `encodings`, or None. Copies older than path are ignored.
+    """
+    for encoding, suffix in ENCODINGS.items():
+        if encoding in encodings:
+            try:
+                if os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+                    return encoding, path + suffix
+            except OSError:
+                continue
+    return None
@@ -0,0 +1,177 @@
+"""
+Synthetic plant exports for benchmarks and tests.
+
+generate() writes the five upload files of a job with controllable sizes:
+
+- raw_data.xlsx in the supplier CoA layout clean_raw_data expects: the
+  title in A1, the supplier name in B3, the two-row header (B4:G4 and
+  I5:AA5 plus the inspection labels from DC5 on), ten filler rows, LOT rows
+  with German remark rows and blank rows in between, and the wide block
+  of unnamed columns (AB:DB) with stray marks in it.
+- tbl_etching_batch.csv with one batch per matched melt.
+- CL_Cleaner.csv, CL_Developer.csv and CL_Etcher4.csv, where a share of
+  the cleaner events are followed by a developer event and then an etcher
+  event within the 60s sync window.
+
+Only the labels the stages use by name are those of the plant exports:
+Date, Heat Melt, LOT A and LOT B in the workbook, TimeStamp in the logs and
+CB_MELT and Created in the batch table. Every other label is a numbered
+placeholder.
+
+The same arguments and seed always give the same files.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+START = pd.Timestamp("2024-03-01 06:00:00")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+SHEET_COLUMNS = 110  # A:DF
+SPECS = [f"Spec {i}" for i in range(1, 8)]
+ELEMENTS = [f"Element {i}" for i in range(1, 7)]
+INSPECTION = [f"Inspection {i}" for i in range(1, 5)]
+FILLER = ["Prüfbedingungen gemäß Norm", None, "Messwerte in mm", None, "Prüfer: siehe Spalte DC",
+          None, "Angaben ohne Gewähr", None, "Toleranzen nach Vereinbarung", None]
+REMARKS = ["Freigabe erteilt", "Nachprüfung erforderlich", "Sonderfreigabe"]
+REMARK_EVERY = 37  # LOT rows between remark rows
+
+
+def _times(values):
+    return pd.DatetimeIndex(values).strftime(TIME_FORMAT)
+
+
+def _tool_log(rng, times, prefix):
+    return pd.DataFrame({
+        "TimeStamp": _times(times),
+        "Label 1": rng.choice(["R1", "R2", "R3"], len(times)),
+        f"{prefix} Value 1": rng.normal(40, 2, len(times)).round(2),
+        "Label 2": rng.choice(["OK", "WARN"], len(times), p=[0.9, 0.1]),
+    })
+
+
+def _follow(rng, times, rate):
+    """Events 5-55s after a `rate` share of times, i.e. inside the 60s sync window."""
+    kept = times[rng.random(len(times)) < rate]
+    return np.sort(kept + pd.to_timedelta(rng.integers(5, 56, len(kept)), unit="s").to_numpy())
+
+
+def write_tool_logs(out_dir, rng, events, events_per_minute, developer_rate, etcher_rate):
+    """Writes the three CL_*.csv logs; returns their row counts and the time span they cover."""
+    span = pd.Timedelta(minutes=events / events_per_minute)
+    cleaner = np.sort(START.to_datetime64() + rng.integers(0, max(span.value, 1), events).astype("timedelta64[ns]"))
+    cleaner = cleaner.astype("datetime64[s]")
+    developer = _follow(rng, cleaner, developer_rate)
+    etcher = _follow(rng, developer, etcher_rate)
+    for name, prefix, times in (("CL_Cleaner.csv", "CL", cleaner), ("CL_Developer.csv", "DV", developer),
+                                ("CL_Etcher4.csv", "ET", etcher)):
+        _tool_log(rng, times, prefix).to_csv(os.path.join(out_dir, name), index=False)
+    return {"CL_Cleaner.csv": len(cleaner), "CL_Developer.csv": len(developer), "CL_Etcher4.csv": len(etcher)}, span
+
+
+def write_batches(out_dir, rng, melts, batch_rate, span):
+    """Writes tbl_etching_batch.csv with a batch for a `batch_rate` share of the melts, created within span."""
+    ids = melts[rng.random(len(melts)) < batch_rate]
+    created = START + pd.to_timedelta(rng.integers(0, max(int(span.total_seconds()), 1), len(ids)), unit="s")
+    batches = pd.DataFrame({
+        "CB_MELT": ids,
+        "Created": _times(created),
+    })
+    batches.sample(frac=1, random_state=int(rng.integers(2**31))).to_csv(
+        os.path.join(out_dir, "tbl_etching_batch.csv"), index=False)
+    return len(batches)
+
+
+def _header_rows():
+    labels = [None] * SHEET_COLUMNS
+    specs = [None] * SHEET_COLUMNS
+    for i, label in enumerate(["Date", "Heat Melt", "LOT A", "LOT B", "Field 5", "Field 6"]):
+        labels[1 + i] = label
+    labels[8] = "Spec"  # row 4 only holds the group label, row 5 the names
+    for i, label in enumerate(SPECS):
+        specs[8 + i] = label
+    for i, label in enumerate(ELEMENTS):
+        specs[15 + 2 * i] = label  # min column, the max column next to it stays empty
+    for i, label in enumerate(INSPECTION):
+        specs[106 + i] = label
+    return labels, specs
+
+
+def write_workbook(out_dir, rng, lots, melts, days):
+    """Writes raw_data.xlsx with `lots` LOT rows over the given melts; returns the sheet's row count."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    blank = [None] * SHEET_COLUMNS
+    ws.append(["Material - supplier CoA"] + blank[1:])
+    ws.append(blank)
+    ws.append([None, "ACME Metals GmbH"] + blank[2:])
+    for row in _header_rows():
+        ws.append(row)
+    for text in FILLER:
+        ws.append([None, text] + blank[2:])
+    rows = 5 + len(FILLER)
+
+    dates = (START.normalize() + pd.to_timedelta(rng.integers(0, max(days, 1), lots), unit="D")).to_pydatetime()
+    heat = rng.choice(melts, lots)
+    lot_a = rng.integers(2_400_000, 2_400_000 + 10 * lots, lots)
+    weight = rng.integers(100, 900, lots).astype(float)
+    specs = rng.normal(10, 1, (lots, len(SPECS))).round(3)
+    elements = rng.normal(1, 0.1, (lots, 2 * len(ELEMENTS))).round(3)
+    marks = rng.random((lots, 106 - 27)) < 0.05
+    shift = rng.integers(1, 4, lots)
+    for j in range(lots):
+        row = list(blank)
+        row[1:7] = [dates[j], int(heat[j]), int(lot_a[j]), f"L{j:06d}B", f"S{j}", weight[j]]
+        row[8:15] = specs[j].tolist()
+        row[15:27] = elements[j].tolist()
+        for i in np.flatnonzero(marks[j]):
+            row[27 + i] = "x"
+        row[106:110] = ["MK", None, int(shift[j]), "L1"]
+        ws.append(row)
+        rows += 1
+        if j % REMARK_EVERY == 0:
+            ws.append([None, REMARKS[j // REMARK_EVERY % len(REMARKS)]] + blank[2:])
+            ws.append(blank)
+            rows += 2
+    wb.save(os.path.join(out_dir, "raw_data.xlsx"))
+    return rows
+
+
+def generate(out_dir, lots=200, events=2000, events_per_minute=1.0, developer_rate=0.9, etcher_rate=0.85,
+             batch_rate=0.8, seed=0):
+    """
+    Writes a job's five upload files to out_dir.
+
+    lots:              LOT rows in raw_data.xlsx (two per melt)
+    events:            cleaner events in CL_Cleaner.csv
+    events_per_minute: cleaner events per minute, sets the time span
+    developer_rate:    share of cleaner events with a developer event after them
+    etcher_rate:       share of developer events with an etcher event after them
+    batch_rate:        share of melts with an etching batch
+
+    Returns the row counts of the files.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    rows, span = write_tool_logs(out_dir, rng, events, events_per_minute, developer_rate, etcher_rate)
+    melts = np.arange(100_000, 100_000 + max(lots // 2, 1))
+    rows["tbl_etching_batch.csv"] = write_batches(out_dir, rng, melts, batch_rate, span)
+    rows["raw_data.xlsx"] = write_workbook(out_dir, rng, lots, melts, span.days + 1)
+    return rows
+
+
+if __name__ == "__main__":
+    # python synthetic.py <out_dir> --lots 2000 --events 100000
+    parser = argparse.ArgumentParser(description="Writes synthetic upload files for one job.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--lots", type=int, default=200)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--events-per-minute", type=float, default=1.0)
+    parser.add_argument("--developer-rate", type=float, default=0.9)
+    parser.add_argument("--etcher-rate", type=float, default=0.85)
+    parser.add_argument("--batch-rate", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate(**vars(args)))
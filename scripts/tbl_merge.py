@@ -1,75 +1,97 @@
+import functools
+
 import pandas as pd
 
-# --- 1. Load Data ---
-df_existing = pd.read_csv("final_sequential_sync.csv")
-df_tbl = pd.read_csv("final_combined_data_raw_etch.csv")
+import cde_merger
+import joins
+import store
+
+
+ROW_HASH = "_row_hash"
+
+
+def stored_sync(job_dir, name="final_sequential_sync"):
+    """
+    A stored sync table as (keys, rows) for iter_merge_sync_with_batches(),
+    read chunk by chunk instead of whole: keys holds the timestamp_etcher of
+    every row and a 64-bit hash of the row, indexed by row position, and
+    rows(positions) reads the full rows at sorted positions.
+    """
+    keys = pd.concat([
+        pd.DataFrame({"timestamp_etcher": chunk["timestamp_etcher"],
+                      ROW_HASH: pd.util.hash_pandas_object(chunk, index=False)})
+        for chunk in store.iter_frame(job_dir, name)
+    ], ignore_index=True)
+    return keys, functools.partial(store.read_rows, job_dir, name)
+
+
+def iter_expand_merge_6h(left_df, right_df, left_ts, right_ts, max_memory_mb=None, right_rows=None):
+    """
+    Expands the dataframe so that every match in the 6h window gets its own row.
+    Uses left join to preserve all records from left_df. The result is yielded
+    in chunks that stay under max_memory_mb (None = a single chunk). With
+    right_rows, right_df holds the keys of a stored table (see stored_sync()).
+    """
+    # Identical sync records only count once, as with the old bucket pool
+    right_df = right_df.drop_duplicates()
+
+    print("Performing expanded merge (preserving all LOT records)...")
+    return joins.iter_window_join(left_df, right_df, left_ts, right_ts, '6h', '_sync', max_memory_mb=max_memory_mb,
+                                  right_rows=right_rows)
 
-# --- 2. Pre-process ---
-df_existing['timestamp_etcher'] = pd.to_datetime(df_existing['timestamp_etcher'])
-df_tbl['Created'] = pd.to_datetime(df_tbl['Created'])
 
 def expand_merge_6h(left_df, right_df, left_ts, right_ts):
     """
     Expands the dataframe so that every match in the 6h window gets its own row.
     Uses left join to preserve all records from left_df.
     """
-    # Create 6-hour buckets to prevent memory crash
-    bucket_size = "6h"
-    left_df['merge_key'] = left_df[left_ts].dt.floor(bucket_size)
-    right_df['merge_key'] = right_df[right_ts].dt.floor(bucket_size)
-
-    # Since a window can span across bucket boundaries, 
-    # we allow matches in the current and the previous bucket
-    right_shifted = right_df.copy()
-    right_shifted['merge_key'] = right_shifted['merge_key'] - pd.Timedelta(hours=6)
-    
-    right_pool = pd.concat([right_df, right_shifted]).drop_duplicates()
+    return pd.concat(list(iter_expand_merge_6h(left_df, right_df, left_ts, right_ts)), ignore_index=True)
 
-    print("Performing expanded merge (preserving all LOT records)...")
-    # Use left join to preserve all records from left_df
-    merged = pd.merge(left_df, right_pool, on='merge_key', how='left', suffixes=('', '_sync'))
-
-    # Calculate the exact time gap where both timestamps exist
-    mask_both_exist = merged[left_ts].notna() & merged[right_ts].notna()
-    merged.loc[mask_both_exist, 'diff_seconds'] = (merged.loc[mask_both_exist, right_ts] - merged.loc[mask_both_exist, left_ts]).dt.total_seconds()
-    
-    # For records with timestamp matches, filter by time window
-    time_mask = (merged['diff_seconds'] > 0) & (merged['diff_seconds'] <= 6 * 3600)
-    
-    # Keep all records: either they match the time window OR they have no sync data (preserve LOT-only records)
-    final_mask = time_mask | merged[right_ts].isna()
-    final = merged[final_mask].copy()
-
-    # Cleanup temporary columns
-    final = final.drop(columns=['merge_key'], errors='ignore')
-    if 'diff_seconds' in final.columns:
-        final = final.drop(columns=['diff_seconds'])
-    
-    return final
-
-# --- 3. Execution ---
-# Use left join to preserve all records from df_tbl (which contains LOT data)
-df_final = expand_merge_6h(df_tbl, df_existing, 'Created', 'timestamp_etcher')
-
-# If no matches were found, we still want to preserve the original LOT data
-if df_final.empty:
-    print("No timestamp matches found, preserving original LOT data without sync information")
-    df_final = df_tbl.copy()
-    # Add empty sync_data column for consistency
-    df_final['sync_data'] = None
-
-# --- 4. Final Formatting ---
-# Move sync_data to the first column
-cols = ['sync_data'] + [c for c in df_final.columns if c != 'sync_data']
-df_final = df_final[cols]
-
-# --- 5. Export ---
-df_final.to_csv("final_data.csv", index=False)
-
-print(f"\nProcessing Complete.")
-print(f"Original LOT Records: {len(df_tbl)}")
-print(f"Sync Records Available: {len(df_existing)}")
-print(f"Final Records (preserving all LOTs): {len(df_final)}")
-records_with_sync = df_final.dropna(subset=['sync_data']).shape[0] if 'sync_data' in df_final.columns else 0
-print(f"Records with sync data: {records_with_sync}")
-print(f"Records with LOT data only: {len(df_final) - records_with_sync}")
+
+def iter_merge_sync_with_batches(df_existing, df_tbl, max_memory_mb=None, sync_rows=None):
+    """
+    Attaches every tool sync record whose etcher timestamp falls within 6h
+    after the etching batch was created to the LOT records in df_tbl.
+    Yields the result in chunks that stay under max_memory_mb. df_existing
+    is the sync table, or with sync_rows its keys (see stored_sync()).
+    """
+    df_existing = df_existing.copy()
+    df_tbl = df_tbl.copy()
+
+    # --- 2. Pre-process ---
+    df_existing['timestamp_etcher'] = pd.to_datetime(df_existing['timestamp_etcher'])
+    df_tbl['Created'] = pd.to_datetime(df_tbl['Created'])
+
+    # --- 3. Execution ---
+    # Use left join to preserve all records from df_tbl (which contains LOT data)
+    total = with_sync = 0
+    for chunk in iter_expand_merge_6h(df_tbl, df_existing, 'Created', 'timestamp_etcher', max_memory_mb, sync_rows):
+        # --- 4. Final Formatting ---
+        # Move the sync deltas to the first columns
+        cols = cde_merger.SYNC_COLUMNS + [c for c in chunk.columns if c not in cde_merger.SYNC_COLUMNS]
+        chunk = chunk[cols]
+
+        total += len(chunk)
+        with_sync += int(chunk['timestamp_etcher'].notna().sum())
+        yield chunk
+
+    print("\nProcessing Complete.")
+    print(f"Original LOT Records: {len(df_tbl)}")
+    print(f"Sync Records Available: {len(df_existing)}")
+    print(f"Final Records (preserving all LOTs): {total}")
+    print(f"Records with sync data: {with_sync}")
+    print(f"Records with LOT data only: {total - with_sync}")
+
+
+def merge_sync_with_batches(df_existing, df_tbl):
+    """iter_merge_sync_with_batches() collected into one DataFrame."""
+    return pd.concat(list(iter_merge_sync_with_batches(df_existing, df_tbl)), ignore_index=True)
+
+
+if __name__ == "__main__":
+    # --- 1. Load Data ---
+    sync_keys, sync_rows = stored_sync(".")
+    df_tbl = store.read_frame(".", "final_combined_data_raw_etch")
+
+    # --- 5. Export ---
+    store.write_chunks(".", "final_data", iter_merge_sync_with_batches(sync_keys, df_tbl, sync_rows=sync_rows))
@@ -0,0 +1,146 @@
+"""
+Out-of-core ingestion of the CL_*.csv tool logs.
+
+A log is read CHUNK_ROWS rows at a time. Each chunk gets its TimeStamp
+parsed with the fixed TIME_FORMAT, is sorted by it and written as a sorted
+run; the runs are then k-way merged into one sorted, typed parquet file, and
+iter_sorted() hands that file on in BATCH_ROWS batches. Neither step holds
+more than a chunk, or a batch per run, so months of logs never have to fit
+in memory at once (see joins.iter_forward_window_join() for the sync).
+"""
+import os
+import shutil
+
+import pandas as pd
+
+import schema
+import store
+
+CHUNK_ROWS = 500_000
+BATCH_ROWS = 64 * 1024
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+RUNS_DIR = "runs"
+
+
+def parse_timestamps(series):
+    """
+    TimeStamp strings as datetime64, parsed with TIME_FORMAT; values in
+    another format fall back to pandas' inference.
+    """
+    parsed = pd.to_datetime(series, format=TIME_FORMAT, errors="coerce")
+    odd = parsed.isna() & series.notna()
+    if odd.any():
+        parsed[odd] = pd.to_datetime(series[odd])
+    return parsed
+
+
+def prepare_chunk(df, col):
+    """A chunk of a raw log with TimeStamp renamed to col, parsed and typed, sorted by col."""
+    df = df.rename(columns={"TimeStamp": col})
+    df[col] = parse_timestamps(df[col])
+    return schema.apply(df).sort_values(col, kind="stable")
+
+
+def _append(df, rows):
+    """df followed by rows; empty frames are skipped so they do not decide the dtypes."""
+    if not len(rows):
+        return df
+    return store.concat([df, rows]) if len(df) else rows.reset_index(drop=True)
+
+
+def write_runs(path, col, run_dir, chunk_rows=None):
+    """Writes the log at path as sorted runs to run_dir, in file order; returns them as (run_dir, name) pairs."""
+    os.makedirs(run_dir, exist_ok=True)
+    runs = []
+    for i, chunk in enumerate(pd.read_csv(path, chunksize=chunk_rows or CHUNK_ROWS)):
+        runs.append((run_dir, f"run-{i:05d}"))
+        store.write_frame(*runs[-1], prepare_chunk(chunk, col))
+    if not runs:
+        runs.append((run_dir, "run-00000"))
+        store.write_frame(*runs[-1], prepare_chunk(pd.read_csv(path, nrows=0), col))
+    return runs
+
+
+def merge_runs(runs, col, rows=None):
+    """
+    k-way merge of sorted runs, stored frames given as (directory, name)
+    pairs, into sorted chunks. Rows with equal timestamps keep the order of
+    the runs, and missing timestamps come last, so the result is the stable
+    sort of the whole log.
+    """
+    sources = [store.iter_frame(directory, name, rows or BATCH_ROWS) for directory, name in runs]
+    buffers = [store.empty_frame(directory, name) for directory, name in runs]
+    missing = list(buffers)  # rows without a timestamp, per run
+    done = [False] * len(runs)
+
+    def fill(i, more=False):
+        """Loads batches of run i until its buffer has a row (one more batch at least with more) or the run ends."""
+        while not done[i] and (more or not len(buffers[i])):
+            batch = next(sources[i], None)
+            if batch is None:
+                done[i] = True
+                break
+            more = False
+            absent = batch[col].isna()
+            missing[i] = _append(missing[i], batch[absent])
+            buffers[i] = _append(buffers[i], batch[~absent])
+
+    def take(before=None):
+        """Removes the buffered rows before `before` (all of them with None) and returns them merged."""
+        parts = []
+        for i, buffer in enumerate(buffers):
+            cut = len(buffer) if before is None else int((buffer[col] < before).sum())
+            if cut:
+                parts.append(buffer.iloc[:cut])
+                buffers[i] = buffer.iloc[cut:]
+        if not parts:
+            return None
+        return schema.apply(store.concat(parts)).sort_values(col, kind="stable")
+
+    for i in range(len(runs)):
+        fill(i)
+    emitted = False
+    while not all(done):
+        # A run not read to its end has no rows before its last buffered
+        # timestamp left, so everything before the smallest of those is final
+        ends = {i: buffers[i][col].iloc[-1] for i in range(len(runs)) if not done[i]}
+        watermark = min(ends.values())
+        chunk = take(watermark)
+        if chunk is not None:
+            emitted = True
+            yield chunk
+        for i, end in ends.items():
+            if end == watermark:
+                fill(i, more=True)
+
+    chunk = take()
+    if chunk is not None:
+        emitted = True
+        yield chunk
+    rest = missing[0]
+    for rows in missing[1:]:
+        rest = _append(rest, rows)
+    if len(rest) or not emitted:
+        yield schema.apply(rest)
+
+
+def sort_log(path, col, out_dir, name, chunk_rows=None):
+    """
+    Writes the log at path, prepared and sorted by col, to out_dir as the
+    stored frame `name`, going through sorted runs in out_dir/runs.
+    Returns the number of rows.
+    """
+    run_dir = os.path.join(out_dir, RUNS_DIR, name)
+    try:
+        runs = write_runs(path, col, run_dir, chunk_rows)
+        _, rows = store.write_chunks(out_dir, name, merge_runs(runs, col))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        if os.path.isdir(os.path.join(out_dir, RUNS_DIR)) and not os.listdir(os.path.join(out_dir, RUNS_DIR)):
+            os.rmdir(os.path.join(out_dir, RUNS_DIR))
+    return rows
+
+
+def iter_sorted(out_dir, name, rows=None):
+    """A frame written by sort_log() in batches of `rows` rows, in order."""
+    return store.iter_frame(out_dir, name, rows or BATCH_ROWS)
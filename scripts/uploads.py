@@ -0,0 +1,300 @@
+"""
+Content-addressed storage for uploaded files.
+
+Uploads are streamed to disk in COPY_BLOCK pieces and hashed (SHA-256, the
+digest incremental.file_digest() computes) while they arrive. Each content
+is stored once as blobs/sha256/<ab>/<digest>, and jobs get hard links to it,
+so a CL_Etcher4.csv uploaded for ten jobs takes the disk space of one. The
+blobs are read-only; nothing in a job writes to its input files.
+
+Large files can be sent in chunks over several requests (see Session): a
+session keeps the bytes received so far in blobs/uploads/<id>.part, and a
+client that lost its connection asks for the offset and continues from
+there.
+
+Every job records the digests of its uploads in uploads.json, so the
+pipeline does not have to hash its inputs again (see known_digest()).
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app runs as one process
+    fcntl = None
+
+BLOB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "blobs")
+SESSIONS = "uploads"
+RECORD_FILE = "uploads.json"
+COPY_BLOCK = 1024 * 1024
+SESSION_TTL = 24 * 3600  # seconds an unfinished chunked upload is kept
+
+
+class UploadError(Exception):
+    """An upload that cannot be accepted; the message is meant for the client."""
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+def blob_path(digest, blob_dir=None):
+    return os.path.join(blob_dir or BLOB_DIR, "sha256", digest[:2], digest)
+
+
+def _tmp_path(blob_dir):
+    tmp_dir = os.path.join(blob_dir, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    return os.path.join(tmp_dir, uuid.uuid4().hex)
+
+
+def _commit(tmp, digest, blob_dir):
+    """
+    Moves a fully written temp file into the store; an existing blob with
+    that content wins. Either way the blob's mtime is now, so the janitor
+    leaves it alone until the upload is linked to its job (see
+    janitor.collect_blobs()).
+    """
+    path = blob_path(digest, blob_dir)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    else:
+        os.remove(tmp)
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+    return path
+
+
+def put_stream(stream, max_size=None, blob_dir=None):
+    """
+    Stores what can be read from a binary stream, hashing it on the way.
+    Returns (digest, size). Raises UploadTooLarge past max_size bytes.
+    """
+    blob_dir = blob_dir or BLOB_DIR
+    tmp = _tmp_path(blob_dir)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp, "wb") as f:
+            while True:
+                block = stream.read(COPY_BLOCK)
+                if not block:
+                    break
+                size += len(block)
+                if max_size is not None and size > max_size:
+                    raise UploadTooLarge(f"File is larger than {max_size // 2**20} MB")
+                digest.update(block)
+                f.write(block)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    digest = digest.hexdigest()
+    _commit(tmp, digest, blob_dir)
+    return digest, size
+
+
+def link(digest, job_dir, filename, blob_dir=None):
+    """Makes job_dir/filename the stored blob; copies it where hard links are not possible."""
+    src = blob_path(digest, blob_dir)
+    dst = os.path.join(job_dir, filename)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+def record(job_dir, uploads):
+    """Writes {filename: {"sha256", "size"}} of a job's uploads to its uploads.json."""
+    with open(os.path.join(job_dir, RECORD_FILE), "w") as f:
+        json.dump(uploads, f, indent=2)
+
+
+def known_digest(path, blob_dir=None):
+    """
+    The SHA-256 of an uploaded job file from the job's uploads.json, as
+    long as the file still is the stored blob; None otherwise.
+    """
+    job_dir, filename = os.path.split(path)
+    try:
+        with open(os.path.join(job_dir, RECORD_FILE)) as f:
+            digest = json.load(f)[filename]["sha256"]
+        if os.path.samefile(path, blob_path(digest, blob_dir)):
+            return digest
+    except (OSError, KeyError, json.JSONDecodeError):
+        pass
+    return None
+
+
+# Hash states of the open sessions of this process, {id: (offset, sha256)};
+# a session continued in another process rebuilds its state from the .part
+_hashers = {}
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(upload_id):
+    with _locks_lock:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+
+class Session:
+    """A chunked upload of one file, resumable at the offset it reached."""
+
+    def __init__(self, upload_id, blob_dir=None):
+        self.id = upload_id
+        self.blob_dir = blob_dir or BLOB_DIR
+        base = os.path.join(self.blob_dir, SESSIONS, upload_id)
+        self.meta_path = base + ".json"
+        self.part_path = base + ".part"
+        self.lock_path = base + ".lock"
+        with open(self.meta_path) as f:
+            self.meta = json.load(f)
+
+    @classmethod
+    def create(cls, filename, size, blob_dir=None):
+        blob_dir = blob_dir or BLOB_DIR
+        upload_id = uuid.uuid4().hex
+        base = os.path.join(blob_dir, SESSIONS, upload_id)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        open(base + ".part", "wb").close()
+        with open(base + ".json", "w") as f:
+            json.dump({"filename": filename, "size": size, "created_at": time.time(), "sha256": None}, f)
+        return cls(upload_id, blob_dir)
+
+    @classmethod
+    def open(cls, upload_id, blob_dir=None):
+        """The session with that id, or None."""
+        if not upload_id or not all(c in "0123456789abcdef" for c in upload_id):
+            return None
+        try:
+            return cls(upload_id, blob_dir)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @property
+    def done(self):
+        return self.meta["sha256"] is not None
+
+    @property
+    def offset(self):
+        if self.done:
+            return self.meta["size"]
+        return os.path.getsize(self.part_path)
+
+    def state(self):
+        return {"upload_id": self.id, "filename": self.meta["filename"], "size": self.meta["size"],
+                "offset": self.offset, "done": self.done, "sha256": self.meta["sha256"]}
+
+    def _hasher(self, offset):
+        """The hash state after the first offset bytes of the .part file."""
+        state = _hashers.get(self.id)
+        if state is not None and state[0] == offset:
+            return state[1]
+        digest = hashlib.sha256()
+        with open(self.part_path, "rb") as f:
+            for block in iter(lambda: f.read(COPY_BLOCK), b""):
+                digest.update(block)
+        return digest
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Serializes appends to this session across the threads and processes
+        of the server. The lock is a POSIX record lock on a file of its own,
+        as closing any descriptor of a locked file would release it.
+        """
+        with _lock(self.id):
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                # Another process may have gone on or finished since the session was opened
+                with open(self.meta_path) as f:
+                    self.meta = json.load(f)
+                yield
+            finally:
+                os.close(fd)
+
+    def append(self, offset, stream):
+        """
+        Appends a chunk sent for the given offset. Raises UploadError if the
+        offset is not where the upload stands or the chunk runs past the
+        announced size. Finishes the upload once all bytes are there.
+        """
+        with self._locked():
+            if self.done:
+                raise UploadError("Upload already complete")
+            current = self.offset
+            if offset != current:
+                raise UploadError(f"Upload is at offset {current}, not {offset}")
+            digest = self._hasher(current)
+            with open(self.part_path, "ab") as f:
+                while True:
+                    block = stream.read(COPY_BLOCK)
+                    if not block:
+                        break
+                    if current + len(block) > self.meta["size"]:
+                        f.truncate(offset)
+                        raise UploadError(f"Chunk runs past the announced size of {self.meta['size']} bytes")
+                    digest.update(block)
+                    f.write(block)
+                    current += len(block)
+            _hashers[self.id] = (current, digest)
+            if current == self.meta["size"]:
+                self._finish(digest.hexdigest())
+        return self.state()
+
+    def _finish(self, digest):
+        _commit(self.part_path, digest, self.blob_dir)
+        self.meta["sha256"] = digest
+        with open(self.meta_path, "w") as f:
+            json.dump(self.meta, f)
+        _hashers.pop(self.id, None)
+        _locks.pop(self.id, None)
+
+
+def session_digests(blob_dir=None):
+    """Digests of the finished chunked uploads that are kept for a job to use."""
+    session_dir = os.path.join(blob_dir or BLOB_DIR, SESSIONS)
+    digests = set()
+    for name in os.listdir(session_dir) if os.path.isdir(session_dir) else []:
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(session_dir, name)) as f:
+                    digest = json.load(f)["sha256"]
+            except (OSError, KeyError, json.JSONDecodeError):
+                continue
+            if digest:
+                digests.add(digest)
+    return digests
+
+
+def expire_sessions(blob_dir=None, ttl=SESSION_TTL):
+    """Removes chunked uploads older than ttl seconds; returns how many."""
+    session_dir = os.path.join(blob_dir or BLOB_DIR, SESSIONS)
+    removed = 0
+    for name in os.listdir(session_dir) if os.path.isdir(session_dir) else []:
+        if name.endswith(".json"):
+            path = os.path.join(session_dir, name)
+            if time.time() - os.path.getmtime(path) > ttl:
+                for ext in (".json", ".part", ".lock"):
+                    try:
+                        os.remove(path[:-len(".json")] + ext)
+                    except FileNotFoundError:
+                        pass
+                _hashers.pop(name[:-len(".json")], None)
+                removed += 1
+    return removed
@@ -0,0 +1,175 @@
+"""
+Column-pruned reader for the supplier CoA workbook.
+
+pd.read_excel has openpyxl build a cell object for every cell of the sheet,
+and the supplier workbooks are over a hundred columns wide while
+clean_raw_data keeps about thirty. read_sheet() iterates the worksheet in
+openpyxl's read-only mode over the wanted column span only, takes plain
+values instead of cell objects, and converts only the wanted columns. Values are
+converted the way read_excel converts openpyxl cells and typed by the same
+parser, so the frame equals pd.read_excel(path) restricted to those
+columns.
+
+load_sheet() keeps converted sheets in the stage cache (see cache.py), keyed
+by the workbook content and the columns, so a workbook is parsed only once.
+"""
+import datetime
+import math
+import os
+import sys
+
+import openpyxl
+import pandas as pd
+from openpyxl.cell.cell import ERROR_CODES
+from openpyxl.utils.cell import column_index_from_string
+from pandas.io.parsers import TextParser
+
+import cache
+import store
+
+SHEET_SUFFIX = ".sheet" + store.EXTENSION
+
+# Mixed columns (header text above numbers) are stored as one typed column
+# per kind of cell value, named <column><_KIND_SEP><kind>
+_KIND_SEP = "\x1f"
+_KINDS = {"bool": "boolean", "int": "Int64", "float": "float64", "datetime": "datetime64[ns]", "str": "string"}
+
+
+def parse_usecols(usecols):
+    """
+    Column ranges in Excel letters, e.g. "B:AA,DC:"; a range without an end
+    runs to the last column. Returns (closed 0-based positions, first
+    position of the open range or None).
+    """
+    closed, open_from = [], None
+    for part in usecols.replace(" ", "").split(","):
+        first, colon, last = part.partition(":")
+        if colon and not last:
+            open_from = column_index_from_string(first) - 1
+            continue
+        start = column_index_from_string(first)
+        end = column_index_from_string(last or first)
+        closed.extend(range(start - 1, end))
+    return sorted(set(closed)), open_from
+
+
+def _convert(value):
+    """A cell value as read_excel gets it from openpyxl."""
+    if value is None:
+        return ""
+    if isinstance(value, str) and value in ERROR_CODES:
+        return math.nan
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if value == int(value):
+            return int(value)
+        return float(value)
+    return value
+
+
+def read_sheet(path, usecols):
+    """
+    The first sheet of the workbook at path as pd.read_excel(path) reads
+    it, but only with the columns in `usecols` (see parse_usecols), named
+    by their position in the full sheet. Rows and columns of an open range
+    that hold nothing in the read columns are left out at the end.
+    """
+    closed, open_from = parse_usecols(usecols)
+    first = min(closed + ([open_from] if open_from is not None else []))
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()  # the stored dimensions may be wrong, as read_excel assumes
+        rows = ws.iter_rows(min_col=first + 1, max_col=None if open_from is not None else closed[-1] + 1,
+                            values_only=True)
+        # Only the wanted cells are converted, the span between the ranges is skipped
+        data = []
+        for row in rows:
+            values = {c: _convert(row[c - first]) for c in closed if c - first < len(row)}
+            if open_from is not None:
+                values.update((open_from + i, _convert(value)) for i, value in enumerate(row[open_from - first:]))
+            data.append(values)
+    finally:
+        wb.close()
+
+    columns = list(closed)
+    if open_from is not None:
+        widest = max((c for values in data for c, value in values.items() if c >= open_from and value != ""),
+                     default=-1)
+        columns += [c for c in range(open_from, widest + 1) if c not in closed]
+    data = [[values.get(c, "") for c in columns] for values in data]
+    while len(data) > 1 and all(value == "" for value in data[-1]):
+        data.pop()
+    if not data:
+        data = [[""] * len(columns)]
+    # The header row is the first sheet row; name empty cells by their place in the full sheet
+    data[0] = [name if name != "" else f"Unnamed: {c}" for name, c in zip(data[0], columns)]
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return None if math.isnan(value) else "float"
+    if isinstance(value, datetime.datetime):
+        return "datetime"
+    return None if value is None else "str"
+
+
+def _split_kinds(df):
+    """df with every object column split into one typed column per kind of value, which parquet can hold."""
+    parts = {}
+    for col in df.columns:
+        series = df[col]
+        if series.dtype != object:
+            parts[str(col)] = series
+            continue
+        kinds = series.map(_kind)
+        for kind in kinds.dropna().unique():
+            values = series.where(kinds == kind, None)
+            if kind == "str":
+                values = values.map(str, na_action="ignore")
+            parts[f"{col}{_KIND_SEP}{kind}"] = values.astype(_KINDS[kind])
+        if kinds.isna().all():
+            parts[f"{col}{_KIND_SEP}"] = pd.Series(math.nan, index=df.index)
+    return pd.DataFrame(parts, index=df.index)
+
+
+def _join_kinds(df):
+    """The frame _split_kinds() was given."""
+    columns = {}
+    for name in df.columns:
+        col, sep, kind = name.rpartition(_KIND_SEP)
+        if not sep:
+            columns[name] = df[name]
+            continue
+        joined = columns.setdefault(col, pd.Series(math.nan, index=df.index, dtype=object))
+        present = df[name].notna()
+        values = df[name][present]
+        if kind == "datetime":
+            values = [ts.to_pydatetime() for ts in values]
+        else:
+            values = values.astype(object)
+        joined[present] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def load_sheet(path, usecols, digest, cache_dir=None):
+    """
+    read_sheet() through the stage cache. digest is the workbook's content
+    hash; the converted sheet is also left next to the workbook as
+    <name>.sheet.parquet. cache_dir is the stage cache to use, by default
+    cache.CACHE_DIR.
+    """
+    key = cache.make_key("sheet", cache.code_version(sys.modules[__name__]), digest, usecols)
+    job_dir, name = os.path.split(os.path.abspath(path))
+    files = [name + SHEET_SUFFIX]
+    if cache.restore(key, job_dir, files, cache_dir=cache_dir):
+        print(f"Cache hit for the converted sheet of {name}")
+        return _join_kinds(store.read_frame(job_dir, name + ".sheet"))
+    df = read_sheet(path, usecols)
+    store.write_frame(job_dir, name + ".sheet", _split_kinds(df))
+    cache.put(key, job_dir, files, cache_dir=cache_dir)
+    return df
@@ -14,6 +14,10 @@ document.addEventListener('DOMContentLoaded', function() {
   fileUploadArea.addEventListener('dragover', handleDragOver);
   fileUploadArea.addEventListener('dragleave', handleDragLeave);
   fileUploadArea.addEventListener('drop', handleDrop);
+
+  // LOT typeahead
+  setupLotSuggestions('lotA', 'lotAOptions', 'a');
+  setupLotSuggestions('lotB', 'lotBOptions', 'b');
   
   function handleDragOver(e) {
     e.preventDefault();
@@ -90,15 +94,27 @@ function upload() {
   }
 
   const data = new FormData();
-  for (let i = 0; i < files.length; i++) {
-    data.append("files", files[i]);
+
+  // Incremental runs build on the last finished job of this browser
+  const lastJobId = localStorage.getItem("lastJobId");
+  if (document.getElementById("incremental").checked && lastJobId) {
+    data.append("base_job_id", lastJobId);
   }
 
-  showStatus("Uploading files and running pipeline...", "loading");
-  updateHeaderStats("Processing pipeline...");
+  showStatus("Uploading files...", "loading");
+  updateHeaderStats("Uploading...");
   disableUI(true);
 
-  fetch("/upload", { method: "POST", body: data })
+  // Files go up in chunks, one after the other, then the job is created from them
+  Array.from(files).reduce(
+    (previous, file) => previous.then(() => uploadFile(file)).then(id => data.append("upload_ids", id)),
+    Promise.resolve()
+  )
+    .then(() => {
+      showStatus("Files uploaded, starting pipeline...", "loading");
+      updateHeaderStats("Processing pipeline...");
+      return fetch("/upload", { method: "POST", body: data });
+    })
     .then(r => {
       if (!r.ok) {
         return r.json().then(err => {
@@ -107,8 +123,13 @@ function upload() {
       }
       return r.json();
     })
+    .then(d => {
+      showStatus("Files uploaded, pipeline queued...", "loading");
+      return pollJob(d.status);
+    })
     .then(d => {
       currentJobId = d.job_id;
+      localStorage.setItem("lastJobId", d.job_id);
       showStatus("Pipeline completed successfully!", "success");
       updateHeaderStats("Pipeline completed");
       
@@ -143,6 +164,111 @@ function upload() {
     });
 }
 
+// Uploads a file in chunks through /uploads and resolves with its upload id.
+// An upload interrupted earlier (same name, size and date) continues where it stopped.
+function uploadFile(file) {
+  const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+  const known = localStorage.getItem(key);
+  const json = r => r.json().then(d => {
+    if (!r.ok && r.status !== 409) {
+      throw new Error(d.error || `Upload of ${file.name} failed`);
+    }
+    return d;
+  });
+
+  const resume = known
+    ? fetch(`/uploads/${known}`).then(r => r.ok ? r.json() : null)
+    : Promise.resolve(null);
+
+  return resume
+    .then(state => {
+      if (state) {
+        return state;
+      }
+      const form = new FormData();
+      form.append("filename", file.name);
+      form.append("size", file.size);
+      return fetch("/uploads", { method: "POST", body: form }).then(json);
+    })
+    .then(state => {
+      localStorage.setItem(key, state.upload_id);
+      const chunkSize = state.chunk_size || 8 * 1024 * 1024;
+      const send = state => {
+        if (state.done) {
+          localStorage.removeItem(key);
+          return state.upload_id;
+        }
+        showStatus(`Uploading ${file.name}: ${Math.floor(100 * state.offset / file.size)}%`, "loading");
+        return fetch(`/uploads/${state.upload_id}`, {
+          method: "PUT",
+          headers: { "Upload-Offset": String(state.offset) },
+          body: file.slice(state.offset, state.offset + chunkSize)
+        })
+          .then(json)
+          .then(next => send(Object.assign(next, { chunk_size: chunkSize })));
+      };
+      return send(state);
+    });
+}
+
+// Polls a job status URL until the pipeline is done or failed
+function pollJob(statusUrl, interval = 1000) {
+  return new Promise((resolve, reject) => {
+    const tick = () => {
+      fetch(statusUrl)
+        .then(r => r.json().then(d => ({ ok: r.ok, d })))
+        .then(({ ok, d }) => {
+          if (!ok) {
+            throw new Error(d.error || "Could not read job status");
+          }
+          if (d.state === "done") {
+            resolve(d);
+          } else if (d.state === "failed") {
+            reject(new Error(d.error || "Pipeline failed"));
+          } else {
+            const label = d.state === "queued" ? "Waiting for a free worker..." : `Running ${d.progress}...`;
+            showStatus(label, "loading");
+            updateHeaderStats(d.state === "queued" ? "Queued" : `Stage ${d.stage} of ${d.stages}`);
+            setTimeout(tick, interval);
+          }
+        })
+        .catch(reject);
+    };
+    tick();
+  });
+}
+
+// Fills the datalist of a LOT input with matching LOTs of the current job
+function setupLotSuggestions(inputId, listId, field) {
+  const input = document.getElementById(inputId);
+  const list = document.getElementById(listId);
+  let timer = null;
+
+  input.addEventListener('input', () => {
+    clearTimeout(timer);
+    const q = input.value.trim();
+    if (!currentJobId || !q) {
+      list.innerHTML = '';
+      return;
+    }
+    timer = setTimeout(() => {
+      const params = new URLSearchParams({ field, q });
+      fetch(`/jobs/${currentJobId}/lots?${params}`)
+        .then(r => r.ok ? r.json() : { lots: [] })
+        .then(d => {
+          list.innerHTML = '';
+          d.lots.forEach(lot => {
+            const option = document.createElement('option');
+            option.value = lot.lot;
+            option.label = `${lot.rows} records`;
+            list.appendChild(option);
+          });
+        })
+        .catch(err => console.error("Typeahead error:", err));
+    }, 150);
+  });
+}
+
 function searchLot() {
   if (!currentJobId) {
     showError("Please run the pipeline first.");
@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+import cache  # noqa: E402
+import synthetic  # noqa: E402
+
+
+@pytest.fixture
+def job_dir(tmp_path):
+    """A job directory with a small synthetic set of the five upload files."""
+    job = tmp_path / "job"
+    synthetic.generate(str(job), lots=60, events=600, seed=3)
+    return str(job)
+
+
+@pytest.fixture(autouse=True)
+def stage_cache(tmp_path, monkeypatch):
+    """Keeps the stage cache of a test in its own directory."""
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setattr(cache, "CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+def header_only(path):
+    """Cuts a CSV file down to its header line."""
+    with open(path) as f:
+        header = f.readline()
+    with open(path, "w") as f:
+        f.write(header)
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """The Flask app with jobs, blobs and the LOT catalog in tmp_path, no janitor and no metrics thread."""
+    sys.path.insert(0, ROOT)
+    import app
+    import catalog
+    import metrics
+    import uploads
+
+    jobs_dir = tmp_path / "jobs"
+    jobs_dir.mkdir()
+    monkeypatch.setattr(app, "JOBS", str(jobs_dir))
+    monkeypatch.setattr(app, "JANITOR_INTERVAL", 0)
+    monkeypatch.setattr(app, "METRICS_FLUSH_INTERVAL", 0)
+    monkeypatch.setattr(app, "_search_records", {})
+    monkeypatch.setattr(uploads, "BLOB_DIR", str(tmp_path / "blobs"))
+    monkeypatch.setattr(catalog, "CATALOG_PATH", str(jobs_dir / "catalog.sqlite3"))
+    monkeypatch.setattr(app, "_pipeline_executor", None)
+    monkeypatch.setattr(app, "METRICS", metrics.Registry())
+    yield app
+    if app._pipeline_executor is not None:
+        app._pipeline_executor.shutdown(wait=True, cancel_futures=True)
+
+
+def upload_job(client, job_dir, **form):
+    """Posts the upload files of job_dir to /upload; returns the response."""
+    names = sorted(n for n in os.listdir(job_dir) if n.endswith((".csv", ".xlsx")))
+    files = [(open(os.path.join(job_dir, n), "rb"), n) for n in names]
+    try:
+        return client.post("/upload", data=dict(form, files=files), content_type="multipart/form-data")
+    finally:
+        for f, _ in files:
+            f.close()
+
+
+def wait_for_job(client, job_id, timeout=120):
+    """Polls /jobs/<id>/status until the job is done or failed; returns the status."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f"/jobs/{job_id}/status").get_json()
+        if status["state"] in ("done", "failed"):
+            return status
+        time.sleep(0.2)
+    raise AssertionError(f"job {job_id} still {status['state']} after {timeout}s")
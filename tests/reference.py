@@ -0,0 +1,117 @@
+"""
+The baseline implementations the pipeline stages replaced, kept as they
+were (minus the file I/O of the old scripts) so the new code can be
+checked against them.
+"""
+import pandas as pd
+
+
+def merge_sequential_farthest(left_df, right_df, left_col, right_col, suffix):
+    """The binned Cleaner->Developer->Etcher merge of the old cde_merger.py."""
+    left_df['bin'] = left_df[left_col].dt.floor('1min')
+    right_df['bin'] = right_df[right_col].dt.floor('1min')
+
+    right_shifted = right_df.copy().assign(bin=right_df['bin'] - pd.Timedelta(minutes=1))
+    right_pool = pd.concat([right_df, right_shifted])
+
+    merged = pd.merge(left_df, right_pool, on='bin', how='left', suffixes=('', suffix))
+
+    has_match = merged[right_col].notna()
+
+    if has_match.any():
+        merged.loc[has_match, 'diff_seconds'] = (merged.loc[has_match, right_col] - merged.loc[has_match, left_col]).dt.total_seconds()
+
+        valid_timing = (merged['diff_seconds'] > 0) & (merged['diff_seconds'] <= 60)
+
+        keep_mask = valid_timing | merged[right_col].isna()
+        merged = merged[keep_mask]
+
+        if 'diff_seconds' in merged.columns:
+            merged = merged.sort_values('diff_seconds', ascending=False, na_position='last').drop_duplicates(subset=[left_col])
+
+    columns_to_drop = ['bin']
+    if 'diff_seconds' in merged.columns:
+        columns_to_drop.append('diff_seconds')
+
+    return merged.drop(columns=columns_to_drop, errors='ignore')
+
+
+def sync_tool_logs(df_cl, df_dv, df_et):
+    """Steps 1 and 2 of the old cde_merger.py on the three raw logs."""
+    df_cl = df_cl.rename(columns={'TimeStamp': 'timestamp_cleaner'})
+    df_dv = df_dv.rename(columns={'TimeStamp': 'timestamp_developer'})
+    df_et = df_et.rename(columns={'TimeStamp': 'timestamp_etcher'})
+
+    for df, col in zip([df_cl, df_dv, df_et], ['timestamp_cleaner', 'timestamp_developer', 'timestamp_etcher']):
+        df[col] = pd.to_datetime(df[col])
+        df.sort_values(col, inplace=True)
+
+    df_final = merge_sequential_farthest(df_cl, df_dv, 'timestamp_cleaner', 'timestamp_developer', '_dv')
+    return merge_sequential_farthest(df_final, df_et, 'timestamp_developer', 'timestamp_etcher', '_et')
+
+
+def expand_merge_6h(left_df, right_df, left_ts, right_ts):
+    """The bucketed 6h LOT/sync merge of the old tbl_merge.py."""
+    bucket_size = "6h"
+    left_df['merge_key'] = left_df[left_ts].dt.floor(bucket_size)
+    right_df['merge_key'] = right_df[right_ts].dt.floor(bucket_size)
+
+    right_shifted = right_df.copy()
+    right_shifted['merge_key'] = right_shifted['merge_key'] - pd.Timedelta(hours=6)
+
+    right_pool = pd.concat([right_df, right_shifted]).drop_duplicates()
+
+    merged = pd.merge(left_df, right_pool, on='merge_key', how='left', suffixes=('', '_sync'))
+
+    mask_both_exist = merged[left_ts].notna() & merged[right_ts].notna()
+    merged.loc[mask_both_exist, 'diff_seconds'] = (merged.loc[mask_both_exist, right_ts] - merged.loc[mask_both_exist, left_ts]).dt.total_seconds()
+
+    time_mask = (merged['diff_seconds'] > 0) & (merged['diff_seconds'] <= 6 * 3600)
+
+    final_mask = time_mask | merged[right_ts].isna()
+    final = merged[final_mask].copy()
+
+    final = final.drop(columns=['merge_key'], errors='ignore')
+    if 'diff_seconds' in final.columns:
+        final = final.drop(columns=['diff_seconds'])
+
+    return final
+
+
+def clean_raw_data(df):
+    """The old clean_raw_data.py on the frame pd.read_excel("raw_data.xlsx") returns."""
+    df = df.drop("Material - supplier CoA", axis=1)
+    df = df.drop(df.columns[26:105], axis=1)
+    df = df.drop(df.index[[0, 1, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13]])
+
+    row2 = df.loc[2].values.copy()
+    row3 = df.loc[3].values.copy()
+    start_col = 7
+
+    row2[start_col:] = row3[start_col:]
+    df.loc[2] = row2
+
+    df = df.drop(index=3)
+    df = df.drop(df.columns[6], axis=1)
+
+    for i in range(15, 26, 2):
+        col_current = f'Unnamed: {i}'
+        col_next = f'Unnamed: {i+1}'
+
+        base_label = df.at[2, col_current]
+        df.at[2, col_current] = f"{base_label}-min"
+        df.at[2, col_next] = f"{base_label}-max"
+
+    df.columns = df.loc[2]
+    df = df.drop(index=2)
+    df = df.reset_index(drop=True)
+
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
+    df['Heat Melt'] = pd.to_numeric(df['Heat Melt'], errors='coerce')
+    df = df.dropna(subset=['Date'])
+    df = df.dropna(subset=['Heat Melt'])
+    df = df.dropna(subset=['Heat Melt', 'LOT A'], how='all')
+    df = df.dropna(how='all')
+
+    df['Date'] = df['Date'].dt.date
+    return df.reset_index(drop=True)
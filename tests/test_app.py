@@ -0,0 +1,291 @@
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+import jobs
+import lot_index
+import metrics
+import pipeline
+import store
+from conftest import upload_job, wait_for_job
+
+
+def test_upload_after_a_pipeline_worker_died(app_module, job_dir):
+    client = app_module.app.test_client()
+    first = upload_job(client, job_dir).get_json()["job_id"]
+    assert wait_for_job(client, first)["state"] == "done"
+
+    # A worker killed from outside (e.g. by the OOM killer) breaks the pool
+    broken = app_module._pipeline_executor
+    for process in list(broken._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+    deadline = time.time() + 10
+    while broken._broken is False and time.time() < deadline:
+        time.sleep(0.05)
+
+    response = upload_job(client, job_dir)
+    assert response.status_code == 202
+    assert wait_for_job(client, response.get_json()["job_id"])["state"] == "done"
+    assert app_module._pipeline_executor is not broken
+
+
+def test_download_stays_inside_the_job_directory(app_module, job_dir, tmp_path):
+    client = app_module.app.test_client()
+    job_id = upload_job(client, job_dir).get_json()["job_id"]
+    assert wait_for_job(client, job_id)["state"] == "done"
+    # A stored frame one level above the job directories
+    store.write_frame(str(tmp_path), "final_data", store.read_frame(os.path.join(app_module.JOBS, job_id), "final_data"))
+
+    assert client.get("/download/%2E%2E/final_data.csv").status_code == 404
+    assert not os.path.exists(tmp_path / "final_data.csv")
+    assert client.get(f"/download/{job_id}/%2E%2E").status_code == 403
+
+    response = client.get(f"/download/{job_id}/final_data.xlsx")
+    assert response.status_code == 200
+    response.close()
+    assert os.path.exists(os.path.join(app_module.JOBS, job_id, "final_data.xlsx"))
+
+
+def test_search_stays_inside_the_job_directory(app_module, job_dir, tmp_path):
+    final = store.read_frame(_run(app_module, job_dir), pipeline.FINAL)
+    # A stored frame one level above the job directories
+    store.write_frame(str(tmp_path), pipeline.FINAL, final)
+    client = app_module.app.test_client()
+    lot = str(final["LOT A"].dropna().iloc[0])
+
+    assert client.post("/search", data={"job_id": "..", "lot_a": lot}).status_code == 400
+    assert client.post("/search", data={"job_id": "../job", "lot_a": lot}).status_code == 200
+
+
+def test_download_negotiates_the_precompressed_copies(app_module, job_dir):
+    path = _run(app_module, job_dir)
+    client = app_module.app.test_client()
+    with open(os.path.join(path, "final_data.csv"), "rb") as f:
+        plain = f.read()
+    url = "/download/job/final_data.csv"
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip, zstd"})
+    assert response.headers["Content-Encoding"] == "zstd" and "Accept-Encoding" in response.headers["Vary"]
+    assert pa.CompressedInputStream(pa.BufferReader(response.data), "zstd").read() == plain
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip" and gzip.decompress(response.data) == plain
+    response = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers and response.data == plain
+
+
+def test_download_answers_range_and_conditional_requests(app_module, job_dir):
+    path = _run(app_module, job_dir)
+    client = app_module.app.test_client()
+    with open(os.path.join(path, "final_data.csv"), "rb") as f:
+        plain = f.read()
+    with open(os.path.join(path, "final_data.csv.gz"), "rb") as f:
+        gzipped = f.read()
+    url = "/download/job/final_data.csv"
+
+    response = client.get(url, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206 and response.data == plain[100:200]
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(plain)}"
+
+    # Ranges and ETags are those of the coding that is sent
+    response = client.get(url, headers={"Accept-Encoding": "gzip", "Range": "bytes=0-9"})
+    assert response.status_code == 206 and response.headers["Content-Encoding"] == "gzip"
+    assert response.data == gzipped[:10] and response.headers["Content-Range"] == f"bytes 0-9/{len(gzipped)}"
+
+    etag = client.get(url, headers={"Accept-Encoding": "gzip"}).headers["ETag"]
+    assert etag != client.get(url).headers["ETag"]
+    response = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304 and not response.data
+
+
+def test_pending_jobs_count_for_the_whole_server(app_module, job_dir, monkeypatch):
+    # A job queued by another server process that is still alive
+    other = os.path.join(app_module.JOBS, "other")
+    os.makedirs(other)
+    jobs.add_pending(other)
+    monkeypatch.setattr(app_module, "MAX_PENDING_JOBS", 1)
+    response = upload_job(app_module.app.test_client(), job_dir)
+    assert response.status_code == 503
+
+
+def test_jobs_of_a_stopped_server_process_no_longer_count(app_module, tmp_path):
+    job_dir = os.path.join(app_module.JOBS, "orphan")
+    os.makedirs(job_dir)
+    jobs.mark_queued(job_dir, "orphan", [])
+    jobs.add_pending(job_dir)
+    with open(os.path.join(app_module.JOBS, jobs.PENDING_DIR, "orphan"), "w") as f:
+        f.write(str(_dead_pid()))
+    assert jobs.count_pending(app_module.JOBS) == 0
+    assert jobs.read_status(job_dir)["state"] == jobs.FAILED
+
+
+def test_run_slots_are_shared(tmp_path):
+    with jobs.run_slot(str(tmp_path), 1):
+        started = time.time()
+        child = multiprocessing.get_context("fork").Process(target=_take_slot, args=(str(tmp_path),))
+        child.start()
+        time.sleep(1.5)
+        assert child.is_alive()  # waiting for the slot
+    child.join(10)
+    assert child.exitcode == 0 and time.time() - started >= 1.5
+
+
+def test_metrics_add_up_the_server_processes(app_module):
+    client = app_module.app.test_client()
+    other = metrics.Registry()
+    other.observe({"kind": "search", "name": "/search", "status": 200, "wall_seconds": 0.02, "cpu_seconds": 0.01,
+                   "counts": {"rows_out": 3}})
+    other.save(os.path.join(app_module.JOBS, app_module.METRICS_DIR, "1.json"))
+    app_module.METRICS.observe({"kind": "search", "name": "/search", "status": 200, "wall_seconds": 0.02,
+                                "cpu_seconds": 0.01, "counts": {"rows_out": 4}})
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'lot_trace_search_rows_total{endpoint="/search"} 7' in text
+    assert "lot_trace_pending_jobs 0" in text
+
+
+def _run(app_module, job_dir, job_id="job"):
+    """Runs the pipeline on a copy of job_dir in the app's job directory; returns that directory."""
+    path = os.path.join(app_module.JOBS, job_id)
+    shutil.copytree(job_dir, path)
+    pipeline.run_pipeline(path)
+    jobs.write_status(path, job_id=job_id, state=jobs.DONE)
+    return path
+
+
+def _keys(response):
+    return {node["key"] for node in response.get_json()["nodes"]}
+
+
+def test_genealogy_walks_from_a_lot_to_its_etcher_events(app_module, job_dir):
+    final = store.read_frame(_run(app_module, job_dir), pipeline.FINAL)
+    client = app_module.app.test_client()
+    lot = final["LOT A"].dropna().iloc[0]
+    batches = final[final["Melt_ID"].isin(final.loc[final["LOT A"] == lot, "Melt_ID"]) & final["Created"].notna()]
+    melt, created = batches.iloc[0][["Melt_ID", "Created"]]
+
+    response = client.get(f"/jobs/job/genealogy?kind=lot_a&key={lot}&kinds=batch,etcher")
+    assert response.status_code == 200
+    expected = {f"{m}@{pd.Timestamp(c):%Y-%m-%dT%H:%M:%S}" for m, c in zip(batches["Melt_ID"], batches["Created"])}
+    expected |= set(batches["timestamp_etcher"].dropna().dt.strftime("%Y-%m-%dT%H:%M:%S"))
+    assert _keys(response) == expected
+
+    # A batch is found by its melt and creation time
+    response = client.get(f"/jobs/job/genealogy?kind=batch&key={melt}@{created}&direction=up&kinds=melt")
+    assert _keys(response) == {str(melt)}
+    assert client.get("/jobs/job/genealogy?kind=batch&key=B000001").status_code == 400
+    assert client.get("/jobs/job/genealogy?kind=lot_a&key=NOPE").status_code == 404
+
+
+def test_genealogy_window_finds_the_lots_etched_in_it(app_module, job_dir):
+    final = store.read_frame(_run(app_module, job_dir), pipeline.FINAL)
+    client = app_module.app.test_client()
+    etched = final["timestamp_etcher"].dropna().sort_values()
+    start, end = etched.iloc[len(etched) // 4], etched.iloc[len(etched) // 2]
+
+    response = client.get(f"/jobs/job/genealogy/window?tool=etcher&start={start}&end={end}")
+    assert response.status_code == 200
+    inside = final["timestamp_etcher"].between(start, end)
+    assert response.get_json()["events"] == final.loc[inside, "timestamp_etcher"].nunique()
+    lots = final[final["Melt_ID"].isin(final.loc[inside, "Melt_ID"])]
+    expected = set(lot_index.normalize_lots(lots["LOT A"])) | set(lot_index.normalize_lots(lots["LOT B"]))
+    assert _keys(response) == expected - {""}
+    assert client.get("/jobs/job/genealogy/window?tool=etcher&start=2024-01-01").status_code == 400
+
+
+def test_search_metrics_are_buffered_until_flushed(app_module, job_dir, monkeypatch):
+    path = _run(app_module, job_dir)
+    monkeypatch.setattr(app_module, "METRICS_FLUSH_INTERVAL", 3600)
+    monkeypatch.setattr(app_module, "start_metrics_flusher", lambda: None)
+    client = app_module.app.test_client()
+    lot = str(store.read_frame(path, pipeline.FINAL)["LOT A"].dropna().iloc[0])
+
+    assert client.post("/search", data={"job_id": "job", "lot_a": lot}).status_code == 200
+    assert client.post("/search/batch", data={"job_id": "job", "lots": lot}).status_code == 200
+    assert client.get(f"/jobs/job/lots?field=a&q={lot[:3]}").status_code == 200
+    assert not [r for r in metrics.load(path) if r["kind"] == "search"]
+
+    # Reading the job's metrics writes its buffered records first
+    searches = client.get("/jobs/job/metrics").get_json()["searches"]
+    assert [r["name"] for r in searches["recent"]] == ["/search", "/search/batch", "/jobs/<job_id>/lots"]
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'lot_trace_search_requests_total{endpoint="/jobs/<job_id>/lots",status="200"} 1' in text
+
+
+def test_batch_trace_reports_found_and_missing_lots(app_module, job_dir):
+    final = store.read_frame(_run(app_module, job_dir), pipeline.FINAL)
+    client = app_module.app.test_client()
+    lot = lot_index.normalize_lot(final["LOT A"].dropna().iloc[0])
+    expected = sum(int((lot_index.normalize_lots(final[c]) == lot).sum()) for c in lot_index.LOT_COLUMNS)
+
+    response = client.post("/search/batch", data={"job_id": "job", "lots": f"{lot}\nNOPE1"})
+    assert response.status_code == 200 and response.headers["X-Lots-Not-Found"] == "1"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[0] == {"summary": {"requested": 2, "found": 1, "not_found": ["NOPE1"]}}
+    assert len(lines) - 1 == expected and all(line["lot"] == lot for line in lines[1:])
+
+    response = client.post("/search/batch", data={"job_id": "job", "lots": f"{lot}\nNOPE1", "format": "csv"})
+    rows = pd.read_csv(io.StringIO(response.get_data(as_text=True)), dtype=str)
+    assert (rows["lot"] == lot).sum() == expected
+    assert rows.iloc[-1][["lot", "matched"]].tolist() == ["NOPE1", "not found"] and len(rows) == expected + 1
+
+
+def test_finished_job_is_in_the_lot_catalog(app_module, job_dir):
+    client = app_module.app.test_client()
+    job_id = upload_job(client, job_dir).get_json()["job_id"]
+    assert wait_for_job(client, job_id)["state"] == "done"
+    final = store.read_frame(os.path.join(app_module.JOBS, job_id), pipeline.FINAL)
+    lot = lot_index.normalize_lot(final["LOT A"].dropna().iloc[0])
+
+    response = client.get(f"/lots/{lot.lower()}")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["jobs"] == 1
+    match = next(m for m in body["matches"] if m["field"] == "LOT A")
+    assert match["job_id"] == job_id and match["lot"] == lot
+    assert match["rows"] == int((lot_index.normalize_lots(final["LOT A"]) == lot).sum())
+    assert client.get("/lots/NOPE1").status_code == 404
+
+    # A job deleted from disk is no longer listed
+    shutil.rmtree(os.path.join(app_module.JOBS, job_id))
+    assert client.get(f"/lots/{lot}").status_code == 404
+
+
+def test_typeahead_lists_lots_starting_with_the_query_first(app_module, job_dir):
+    final = store.read_frame(_run(app_module, job_dir), pipeline.FINAL)
+    client = app_module.app.test_client()
+    lots = lot_index.normalize_lots(final["LOT A"])
+    counts = lots[lots != ""].value_counts()
+
+    response = client.get("/jobs/job/lots?field=a&q=240&limit=3")
+    assert response.status_code == 200
+    found = response.get_json()["lots"]
+    assert len(found) == 3 and all(s["lot"].startswith("240") for s in found)
+    assert all(s["rows"] == counts[s["lot"]] for s in found)
+
+    # Few enough LOTs start with the query, so ones containing it follow
+    middle = counts.index[0][2:5]
+    found = [s["lot"] for s in client.get(f"/jobs/job/lots?field=a&q={middle}&limit=50").get_json()["lots"]]
+    starting = sum(lot.startswith(middle) for lot in found)
+    assert found and all(lot.startswith(middle) for lot in found[:starting])
+    assert all(middle in lot for lot in found)
+    assert len(client.get("/jobs/job/lots?field=a&q=2&limit=500").get_json()["lots"]) <= 50
+    assert client.get("/jobs/job/lots?field=c&q=2").status_code == 400
+
+
+def _take_slot(jobs_dir):
+    with jobs.run_slot(jobs_dir, 1):
+        pass
+
+
+def _dead_pid():
+    child = multiprocessing.get_context("fork").Process(target=int)
+    child.start()
+    child.join()
+    return child.pid
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+import pandas as pd
+import pandas.testing as pdt
+
+import incremental
+import metrics
+import pipeline
+import store
+
+
+def _with_missing_timestamps(path):
+    """Adds cleaner records without a timestamp, one early and one late in the file."""
+    with open(path) as f:
+        lines = f.readlines()
+    blank = "," + lines[1].split(",", 1)[1]
+    lines.insert(len(lines) // 4, blank)
+    lines.insert(len(lines) - 3, blank)
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def _cut_logs(job_dir, base_dir, share):
+    """base_dir gets the upload files of job_dir with every tool log cut to the first `share` of its time span."""
+    os.makedirs(base_dir)
+    for name in os.listdir(job_dir):
+        if name.endswith((".csv", ".xlsx")):
+            shutil.copy(os.path.join(job_dir, name), base_dir)
+    times = pd.to_datetime(pd.read_csv(os.path.join(job_dir, "CL_Cleaner.csv"))["TimeStamp"])
+    end = times.min() + (times.max() - times.min()) * share
+    for name in incremental.TOOL_LOGS:
+        with open(os.path.join(job_dir, name)) as f:
+            lines = f.readlines()
+        last = max(i for i, line in enumerate(lines[1:], 1) if not line.startswith(",") and pd.Timestamp(line[:19]) <= end)
+        with open(os.path.join(base_dir, name), "w") as f:
+            f.writelines(lines[:last + 1])
+
+
+def test_incremental_run_matches_a_full_run(job_dir, tmp_path):
+    _with_missing_timestamps(os.path.join(job_dir, "CL_Cleaner.csv"))
+    base_dir, new_dir = str(tmp_path / "base"), str(tmp_path / "new")
+    _cut_logs(job_dir, base_dir, 0.7)
+    shutil.copytree(job_dir, new_dir)
+
+    pipeline.run_pipeline(base_dir)
+    pipeline.run_pipeline(new_dir, base_dir=base_dir)
+    pipeline.run_pipeline(job_dir)
+
+    # The full run did not take the incremental run's outputs from the stage cache
+    cached = {r["name"]: r["cached"] for r in metrics.load(job_dir) if r["kind"] == "stage"}
+    assert not cached["cde_merger.py"] and not cached["tbl_merge.py"]
+    # Only the appended tool log rows were read
+    rows_in = [r["counts"]["rows_in"] for path in (new_dir, job_dir) for r in metrics.load(path)
+               if r["name"] == "cde_merger.py"]
+    assert rows_in[0] < rows_in[1] / 2
+
+    for name in ("final_sequential_sync", pipeline.FINAL):
+        pdt.assert_frame_equal(store.read_frame(new_dir, name), store.read_frame(job_dir, name))
+    state = os.path.join(new_dir, incremental.STATE_DIR)
+    full_state = os.path.join(job_dir, incremental.STATE_DIR)
+    for name in incremental.TOOL_LOGS:
+        stem = name.rsplit(".", 1)[0]
+        pdt.assert_frame_equal(store.read_frame(state, stem).reset_index(drop=True),
+                               store.read_frame(full_state, stem).reset_index(drop=True))
@@ -0,0 +1,94 @@
+import io
+import os
+import time
+
+import catalog
+import janitor
+import jobs
+import uploads
+
+HOUR = 3600
+
+
+def _age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def _job(jobs_dir, job_id, state, used, status_age=0):
+    """A job used `used` seconds ago with 4 kB of stored table and a 4 kB compressed export."""
+    job_dir = os.path.join(jobs_dir, job_id)
+    os.makedirs(job_dir)
+    jobs.write_status(job_dir, job_id=job_id, state=state, files_processed=["CL_Cleaner.csv"])
+    for name in ("final_data.parquet", "final_data.csv.gz", "CL_Cleaner.csv"):
+        with open(os.path.join(job_dir, name), "wb") as f:
+            f.write(b"x" * 4096)
+    _age(os.path.join(job_dir, jobs.STATUS_FILE), status_age)
+    _age(job_dir, used)
+    return job_dir
+
+
+def _sweep(tmp_path, monkeypatch, **limits):
+    monkeypatch.setattr(catalog, "CATALOG_PATH", str(tmp_path / "jobs" / "catalog.sqlite3"))
+    return janitor.sweep(str(tmp_path / "jobs"), blob_dir=str(tmp_path / "blobs"), **limits)
+
+
+def test_jobs_past_the_age_limit_are_removed(tmp_path, monkeypatch):
+    jobs_dir = str(tmp_path / "jobs")
+    _job(jobs_dir, "old", jobs.DONE, 3 * HOUR)
+    _job(jobs_dir, "failed", jobs.FAILED, 3 * HOUR)
+    _job(jobs_dir, "recent", jobs.DONE, HOUR)
+    # Not used for long, but still running or waiting for a slot
+    _job(jobs_dir, "running", jobs.RUNNING, 3 * HOUR)
+    _job(jobs_dir, "queued", jobs.QUEUED, 3 * HOUR)
+    # Queued before a server restart and never picked up again
+    _job(jobs_dir, "abandoned", jobs.QUEUED, 3 * HOUR, status_age=3 * HOUR)
+
+    report = _sweep(tmp_path, monkeypatch, max_age=2 * HOUR)
+    assert sorted(report["expired_jobs"]) == ["abandoned", "failed", "old"]
+    assert sorted(os.listdir(jobs_dir)) == ["catalog.sqlite3", "queued", "recent", "running"]
+
+
+def test_quota_drops_artifacts_then_jobs_least_recently_used_first(tmp_path, monkeypatch):
+    jobs_dir = str(tmp_path / "jobs")
+    for job_id, used in (("a", 3 * HOUR), ("b", 2 * HOUR), ("c", HOUR)):
+        _job(jobs_dir, job_id, jobs.DONE, used)
+    running = _job(jobs_dir, "running", jobs.RUNNING, 4 * HOUR)
+    total = janitor.disk_usage([jobs_dir])
+
+    # Dropping the export of the least recently used job is enough
+    report = _sweep(tmp_path, monkeypatch, max_bytes=total - 4096)
+    assert report["trimmed_jobs"] == ["a"] and report["evicted_jobs"] == [] and report["bytes"] <= total - 4096
+    assert not os.path.exists(os.path.join(jobs_dir, "a", "final_data.csv.gz"))
+    # Upload files are never artifacts, even as CSV
+    assert os.path.exists(os.path.join(jobs_dir, "a", "CL_Cleaner.csv"))
+    # Removing files is not a use
+    assert sorted(os.listdir(jobs_dir), key=lambda name: os.path.getmtime(os.path.join(jobs_dir, name)))[1:4] == \
+        ["a", "b", "c"]
+
+    report = _sweep(tmp_path, monkeypatch, max_bytes=0)
+    assert report["trimmed_jobs"] == ["b", "c"] and report["evicted_jobs"] == ["a", "b", "c"]
+    assert os.listdir(running) and sorted(os.listdir(jobs_dir)) == ["catalog.sqlite3", "running"]
+
+
+def test_uploading_a_stored_content_again_keeps_its_blob(tmp_path):
+    blob_dir = str(tmp_path / "blobs")
+    digest, _ = uploads.put_stream(io.BytesIO(b"TimeStamp\n"), blob_dir=blob_dir)
+    _age(uploads.blob_path(digest, blob_dir), 2 * janitor.BLOB_GRACE)
+    # The same content arrives for a new job, which links it right after
+    uploads.put_stream(io.BytesIO(b"TimeStamp\n"), blob_dir=blob_dir)
+    assert janitor.collect_blobs(blob_dir) == []
+    assert os.path.exists(uploads.blob_path(digest, blob_dir))
+
+
+def test_blob_of_a_finished_chunked_upload_is_kept_until_the_session_expires(tmp_path):
+    blob_dir = str(tmp_path / "blobs")
+    session = uploads.Session.create("CL_Etcher4.csv", 10, blob_dir)
+    session.append(0, io.BytesIO(b"TimeStamp\n"))
+    path = uploads.blob_path(session.meta["sha256"], blob_dir)
+    _age(path, 2 * janitor.BLOB_GRACE)
+    assert janitor.collect_blobs(blob_dir) == []
+
+    _age(session.meta_path, uploads.SESSION_TTL + HOUR)
+    uploads.expire_sessions(blob_dir)
+    assert janitor.collect_blobs(blob_dir) == [path]
@@ -0,0 +1,33 @@
+import pandas as pd
+import pyarrow.parquet as pq
+
+import genealogy
+import job_cache
+import pipeline
+import store
+
+
+def test_mapped_table_equals_the_stored_frame(tmp_path, monkeypatch):
+    # Row groups with different dictionaries, as write_chunks() stores them
+    monkeypatch.setattr(store, "ROW_GROUP_SIZE", 100)
+    chunks = [pd.DataFrame({"LOT A": pd.Series([f"L{i}{j % 3}" for j in range(250)], dtype="category"),
+                            "Heat Melt": range(250)}) for i in range(4)]
+    store.write_chunks(str(tmp_path), "final_data", iter(chunks))
+    assert pq.ParquetFile(store.frame_path(str(tmp_path), "final_data")).num_row_groups > 1
+    mapped = job_cache.table(str(tmp_path), "final_data")
+    pd.testing.assert_frame_equal(mapped.to_pandas(), store.read_frame(str(tmp_path), "final_data"),
+                                  check_categorical=False)
+    assert mapped.column("LOT A").num_chunks > 1
+
+
+def test_mapped_table_of_an_empty_frame(tmp_path):
+    store.write_frame(str(tmp_path), "final_data", pd.DataFrame({"LOT A": pd.Series([], dtype="category")}))
+    assert job_cache.table(str(tmp_path), "final_data").num_rows == 0
+
+
+def test_genealogy_graph_is_kept_in_the_job_cache(job_dir):
+    pipeline.run_pipeline(job_dir)
+    job_cache.CACHE.clear()
+    graph = genealogy.load_graph(job_dir)
+    assert genealogy.load_graph(job_dir) is graph
+    assert job_cache.CACHE.stats()["entries"] == 1 and job_cache.CACHE.stats()["bytes"] == graph.nbytes
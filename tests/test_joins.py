@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import joins
+import reference
+import store
+import tbl_merge
+
+T0 = pd.Timestamp("2024-01-01")
+
+
+def _events(rng, n, span, col, **columns):
+    df = pd.DataFrame({col: T0 + pd.to_timedelta(rng.integers(0, span, n), unit="s"), **columns})
+    return df.sort_values(col, kind="stable").reset_index(drop=True)
+
+
+def _farthest(left, right, left_col, right_col, window):
+    """The farthest right timestamp in (0, window] after each left one, by brute force."""
+    found = []
+    for t in left[left_col]:
+        delta = right[right_col] - t
+        inside = right[right_col][(delta > pd.Timedelta(0)) & (delta <= window)]
+        found.append(inside.max() if len(inside) else pd.NaT)
+    return pd.Series(found, dtype="datetime64[ns]", name=right_col)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_forward_window_join_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    span = int(rng.integers(60, 3600))
+    left = _events(rng, int(rng.integers(1, 300)), span, "tl", a=1, x=1)
+    right = _events(rng, int(rng.integers(0, 300)), span + 100, "tr", b=2, x=2)
+    joined = joins.forward_window_join(left, right, "tl", "tr", "60s", "_r")
+    assert list(joined.columns) == ["tl", "a", "x", "tr", "b", "x_r"]
+    pd.testing.assert_frame_equal(joined[["tl", "a", "x"]], left)
+    pd.testing.assert_series_equal(joined["tr"], _farthest(left, right, "tl", "tr", pd.Timedelta("60s")))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_forward_window_join_agrees_with_the_binned_merge(seed):
+    rng = np.random.default_rng(seed)
+    span = int(rng.integers(60, 3600))
+    left = _events(rng, int(rng.integers(1, 300)), span, "tl", a=rng.integers(0, 9, 1)[0])
+    right = _events(rng, int(rng.integers(1, 300)), span + 100, "tr", b=rng.integers(0, 9, 1)[0])
+    old = reference.merge_sequential_farthest(left.copy(), right.copy(), "tl", "tr", "_r")
+    new = joins.forward_window_join(left, right, "tl", "tr", "60s", "_r").drop_duplicates("tl").set_index("tl")["tr"]
+    # Every left timestamp the old merge kept is matched to the same right one
+    for t, r in zip(old["tl"], old["tr"]):
+        assert (pd.isna(r) and pd.isna(new[t])) or r == new[t]
+
+
+def test_left_rows_without_a_match_in_window_are_kept():
+    # The old merge found 00:00:50 in the next bin, dropped it as out of the window and lost the left row
+    left = pd.DataFrame({"tl": pd.to_datetime(["2024-01-01 00:00:10"])})
+    right = pd.DataFrame({"tr": pd.to_datetime(["2024-01-01 00:01:50"])})
+    assert reference.merge_sequential_farthest(left.copy(), right.copy(), "tl", "tr", "_r").empty
+    joined = joins.forward_window_join(left, right, "tl", "tr", "60s", "_r")
+    assert len(joined) == 1 and joined["tr"].isna().all()
+
+
+def test_left_rows_sharing_a_timestamp_are_not_collapsed():
+    # drop_duplicates(subset=[left_col]) kept one of the repeated and one of the missing timestamps
+    left = pd.DataFrame({"tl": pd.to_datetime(["2024-01-01 00:00:10", "2024-01-01 00:00:10", None, None]),
+                         "event": [1, 2, 3, 4]})
+    right = pd.DataFrame({"tr": pd.to_datetime(["2024-01-01 00:00:30"])})
+    old = reference.merge_sequential_farthest(left.copy(), right.copy(), "tl", "tr", "_r")
+    assert len(old) == 2
+    joined = joins.forward_window_join(left, right, "tl", "tr", "60s", "_r")
+    assert joined["event"].tolist() == [1, 2, 3, 4]
+    assert joined["tr"].notna().tolist() == [True, True, False, False]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_window_join_pairs_match_the_bucketed_merge(seed):
+    rng = np.random.default_rng(seed)
+    left = pd.DataFrame({"Created": T0 + pd.to_timedelta(rng.integers(0, 86400, int(rng.integers(1, 60))), unit="s")})
+    left["lot"] = np.arange(len(left))
+    right = _events(rng, int(rng.integers(1, 300)), 100000, "timestamp_etcher", v=0)
+    right["v"] = rng.integers(0, 5, len(right))
+    old = reference.expand_merge_6h(left.copy(), right.copy(), "Created", "timestamp_etcher")
+    new = joins.window_join(left, right.drop_duplicates(), "Created", "timestamp_etcher", "6h", "_sync")
+    key = ["lot", "timestamp_etcher", "v"]
+    pairs = [df.dropna(subset=["timestamp_etcher"])[key].astype({"v": "int64"}).sort_values(key)
+             .reset_index(drop=True) for df in (old, new)]
+    pd.testing.assert_frame_equal(pairs[0], pairs[1])
+    # Unlike the old merge, a LOT whose bucket only had events out of the window keeps its row
+    assert sorted(set(new["lot"])) == list(range(len(left)))
+
+
+def test_chunked_window_join_equals_one_chunk():
+    rng = np.random.default_rng(7)
+    left = _events(rng, 80, 86400, "Created", lot=0)
+    left["lot"] = np.arange(len(left))
+    right = _events(rng, 400, 100000, "timestamp_etcher", v=1)
+    chunks = list(joins.iter_window_join(left, right, "Created", "timestamp_etcher", "6h", "_sync",
+                                         max_memory_mb=0.0005))
+    assert len(chunks) > 1
+    assert len({tuple(map(str, chunk.dtypes)) for chunk in chunks}) == 1
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True),
+                                  joins.window_join(left, right, "Created", "timestamp_etcher", "6h", "_sync"))
+
+
+def test_join_on_a_stored_sync_table_equals_the_in_memory_join(tmp_path, monkeypatch):
+    rng = np.random.default_rng(11)
+    left = _events(rng, 80, 86400, "Created", lot=0)
+    left["lot"] = np.arange(len(left))
+    right = _events(rng, 400, 100000, "timestamp_etcher", v=1).sample(frac=1, random_state=1)
+    right["v"] = rng.integers(0, 5, len(right))
+    right.loc[right.index[:20], "timestamp_etcher"] = pd.NaT
+    right = pd.concat([right, right.iloc[50:70]], ignore_index=True)  # identical records count once
+    monkeypatch.setattr(store, "ROW_GROUP_SIZE", 64)
+    store.write_frame(str(tmp_path), "final_sequential_sync", right)
+
+    keys, rows = tbl_merge.stored_sync(str(tmp_path))
+    streamed = list(tbl_merge.iter_expand_merge_6h(left, keys, "Created", "timestamp_etcher", 0.0005, rows))
+    assert len(streamed) > 1
+    pd.testing.assert_frame_equal(pd.concat(streamed, ignore_index=True),
+                                  tbl_merge.expand_merge_6h(left, right, "Created", "timestamp_etcher"))
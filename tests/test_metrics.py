@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+import metrics
+
+MB = 2 ** 20
+
+
+def test_a_search_does_not_reset_the_peak_of_a_stage():
+    if not metrics._reset_peak():
+        pytest.skip("the kernel does not let the peak RSS be reset")
+    with metrics.Recorder("stage", "tbl_merge.py", reset_peak=True) as stage:
+        big = np.ones(200 * MB // 8)
+        del big
+        low = metrics._status("VmRSS")
+        # A search in another thread of the same process
+        with metrics.Recorder("search", "/search") as search:
+            pass
+    assert stage.record["peak_rss_scope"] == "since_start"
+    assert stage.record["peak_rss_bytes"] > low + 150 * MB
+    assert search.record["peak_rss_scope"] == "process"
+    assert search.record["rss_delta_bytes"] is not None
+
+
+def test_metrics_file_keeps_the_stages_and_the_latest_searches(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "MAX_FILE_BYTES", 4096)
+    monkeypatch.setattr(metrics, "KEPT_SEARCHES", 5)
+    metrics.append(str(tmp_path), {"kind": "stage", "name": "tbl_merge.py"})
+    for i in range(100):
+        metrics.append(str(tmp_path), {"kind": "search", "name": "/search", "n": i})
+    records = metrics.load(str(tmp_path))
+    assert records[0] == {"kind": "stage", "name": "tbl_merge.py"}
+    searches = [r["n"] for r in records[1:]]
+    assert searches == list(range(searches[0], 100)) and 5 <= len(searches) < 100
+    assert (tmp_path / metrics.METRICS_FILE).stat().st_size <= 4096 + 100
@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+import shutil
+import time
+
+import pytest
+
+import pipeline
+import store
+
+_run_stage = pipeline._run_stage
+
+
+def _slow_stage(run, index):
+    # Slow after the stage has recorded its start
+    outcome = _run_stage(run, index)
+    time.sleep(3)
+    return outcome
+
+
+@pytest.fixture
+def fresh_pool():
+    """A stage pool started by the test, for workers that see its patches."""
+    pipeline.stop_pool()
+    yield
+    pipeline.stop_pool()
+
+
+def _worker_pids():
+    return sorted(p.pid for p in pipeline._pool._pool)
+
+
+def test_stage_pool_is_kept_between_runs(fresh_pool, job_dir):
+    pipeline.run_pipeline(job_dir)
+    pids = _worker_pids()
+    pipeline.run_pipeline(job_dir)
+    assert _worker_pids() == pids
+
+
+def test_forked_process_starts_its_own_stage_pool(fresh_pool, job_dir, tmp_path):
+    # As an app pipeline worker forked from a process that ran a job itself
+    pipeline.run_pipeline(job_dir)
+    pids = _worker_pids()
+    child_dir = str(tmp_path / "child")
+    shutil.copytree(job_dir, child_dir)
+    child = multiprocessing.get_context("fork").Process(target=pipeline.run_pipeline, args=(child_dir,))
+    child.start()
+    child.join(60)
+    assert child.exitcode == 0 and store.exists(child_dir, pipeline.FINAL)
+    assert _worker_pids() == pids
+
+
+def test_stage_timeout_counts_from_the_stage_start(fresh_pool, job_dir, monkeypatch):
+    # One worker: cde_merger.py waits for clean_raw_data.py, longer than the timeout in total
+    monkeypatch.setattr(pipeline, "STAGE_WORKERS", 1)
+    monkeypatch.setattr(pipeline, "_run_stage", _slow_stage)
+    pipeline.run_pipeline(job_dir, stage_timeout=5)
+    assert store.exists(job_dir, pipeline.FINAL)
+
+
+def test_stage_timeout_stops_the_pool(fresh_pool, job_dir, monkeypatch):
+    monkeypatch.setattr(pipeline, "_run_stage", _slow_stage)
+    with pytest.raises(pipeline.StageTimeout):
+        pipeline.run_pipeline(job_dir, stage_timeout=1)
+    assert pipeline._pool is None
+
+
+def test_stages_use_the_cache_dir_of_the_run(fresh_pool, job_dir, stage_cache, tmp_path):
+    # The pool starts with the default cache directory
+    pipeline.get_pool()
+    cache_dir = str(tmp_path / "run-cache")
+    pipeline.run_pipeline(job_dir, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == len(pipeline.STAGES) + 1  # and the converted sheet
+    assert not os.path.exists(stage_cache)
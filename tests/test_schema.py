@@ -0,0 +1,57 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+
+def _cleaned_coa(rows):
+    """A frame shaped like cleaned_raw_data: the named columns of the workbook and unknown ones."""
+    i = np.arange(rows)
+    return pd.DataFrame({
+        "Date": [datetime.date(2024, 3, 1 + n % 28) for n in i],
+        "Heat Melt": 100_000 + i,
+        # Excel gives numbers and text in one column
+        "LOT A": [2_400_000 + n if n % 3 else f"{2_400_000 + n}A" for n in i],
+        "LOT B": [None if n % 5 == 0 else f"L{n:06d}B" for n in i],
+        "Supplier": ["ACME Metals GmbH"] * rows,
+        "Unnamed: 9": np.round(np.linspace(0.5, 12.75, rows), 3),
+        "Cu-min": np.where(i % 4 == 0, np.nan, 0.125),
+        "Cu-max": np.full(rows, 1.375),
+        "Order": np.where(i % 2 == 0, np.nan, 900_000_000.0 + i),  # whole numbers float32 cannot hold
+        "Counter": np.arange(rows, dtype=np.int64) * 5_000_000_000,
+        "Qty": np.arange(rows, dtype=np.int64),
+        "Remark": ["Freigabe erteilt" if n % 2 else None for n in i],
+        "sync_dv_cl": pd.array([None if n % 7 == 0 else n / 4 for n in i], dtype="Float32"),
+    })
+
+
+def test_types_follow_the_dtypes_the_stages_produce():
+    dtypes = schema.apply(_cleaned_coa(50)).dtypes.astype(str).to_dict()
+    assert dtypes == {
+        "Date": "datetime64[ns]",
+        "Heat Melt": "int32",
+        "LOT A": "category",
+        "LOT B": "category",
+        "Supplier": "category",
+        "Unnamed: 9": "float32",
+        "Cu-min": "float32",
+        "Cu-max": "float32",
+        "Order": "float64",
+        "Counter": "int64",
+        "Qty": "int32",
+        "Remark": "object",
+        "sync_dv_cl": "Float32",
+    }
+
+
+def test_compact_types_export_the_same_csv():
+    df = _cleaned_coa(200)
+    assert schema.apply(df).to_csv(index=False) == df.to_csv(index=False)
+
+
+def test_float64_becomes_float32_only_without_loss():
+    widened = np.array([41.35, 2.5], dtype=np.float32).astype(np.float64)  # e.g. by a join with misses
+    df = pd.DataFrame({"x": [0.1234567, 2.5], "y": [0.12345678, 2.5], "z": widened})
+    assert schema.apply(df).dtypes.astype(str).tolist() == ["float32", "float64", "float32"]
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+import store
+
+
+def _frame(rows):
+    return pd.DataFrame({
+        "LOT A": pd.Series([f"L{i % 7}" for i in range(rows)], dtype="category"),
+        "Heat Melt": range(rows),
+        "sync_dv_cl": pd.array([None if i % 5 == 0 else i / 4 for i in range(rows)], dtype="Float32"),
+        "timestamp_etcher": pd.date_range("2024-01-01", periods=rows, freq="37s"),
+    })
+
+
+def test_streamed_csv_export_equals_one_to_csv(tmp_path, monkeypatch):
+    df = _frame(1000)
+    store.write_frame(str(tmp_path), "final_data", df)
+    monkeypatch.setattr(store, "ROW_GROUP_SIZE", 128)
+    path = store.export_frame(str(tmp_path), "final_data", "csv")
+    with open(path, newline="") as f:
+        assert f.read() == store.read_frame(str(tmp_path), "final_data").to_csv(index=False)
+
+
+def test_empty_frame_exports_its_header(tmp_path):
+    store.write_frame(str(tmp_path), "final_data", _frame(0))
+    with open(store.export_frame(str(tmp_path), "final_data", "csv")) as f:
+        assert f.read() == "LOT A,Heat Melt,sync_dv_cl,timestamp_etcher\n"
+
+
+def test_chunks_that_disagree_on_dtypes_keep_their_values(tmp_path):
+    # schema.apply() types each chunk on its own: float32 / int32 where the values fit
+    chunks = [
+        pd.DataFrame({"x": np.array([0.1, 2.5], dtype=np.float32), "n": np.array([1, 2], dtype=np.int32)}),
+        pd.DataFrame({"x": [12345678.9, 0.25], "n": np.array([2 ** 40, 3], dtype=np.int64)}),
+        pd.DataFrame({"x": np.array([0.1], dtype=np.float32), "n": np.array([4], dtype=np.int32)}),
+    ]
+    store.write_chunks(str(tmp_path), "final_data", chunks)
+    df = store.read_frame(str(tmp_path), "final_data")
+    assert df.dtypes.astype(str).tolist() == ["float64", "int64"]
+    assert df.to_csv(index=False) == "x,n\n0.1,1\n2.5,2\n12345678.9,1099511627776\n0.25,3\n0.1,4\n"
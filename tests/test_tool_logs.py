@@ -0,0 +1,91 @@
+import os
+
+import pandas as pd
+import pytest
+
+import cde_merger
+import pipeline
+import reference
+import store
+import tool_logs
+from conftest import header_only
+
+LOGS = {"CL_Cleaner.csv": "timestamp_cleaner", "CL_Developer.csv": "timestamp_developer",
+        "CL_Etcher4.csv": "timestamp_etcher"}
+
+
+def _streamed_sync(job_dir, out_dir, rows=None):
+    streams = []
+    for name, col in LOGS.items():
+        tool_logs.sort_log(os.path.join(job_dir, name), col, out_dir, name[:-4], chunk_rows=rows)
+        streams.append(tool_logs.iter_sorted(out_dir, name[:-4], rows))
+    return pd.concat(list(cde_merger.iter_sync_sorted_logs(*streams)), ignore_index=True)
+
+
+def _in_memory_sync(job_dir):
+    return cde_merger.sync_tool_logs(*(pd.read_csv(os.path.join(job_dir, name)) for name in LOGS))
+
+
+def test_sorted_log_matches_stable_sort(job_dir, tmp_path):
+    rows = tool_logs.sort_log(os.path.join(job_dir, "CL_Cleaner.csv"), "timestamp_cleaner", str(tmp_path), "cl",
+                              chunk_rows=97)
+    streamed = pd.concat(list(tool_logs.iter_sorted(str(tmp_path), "cl", 50)), ignore_index=True)
+    expected = tool_logs.prepare_chunk(pd.read_csv(os.path.join(job_dir, "CL_Cleaner.csv")), "timestamp_cleaner")
+    assert rows == len(expected)
+    pd.testing.assert_frame_equal(streamed, expected.reset_index(drop=True), check_categorical=False)
+
+
+def test_runs_typed_apart_keep_the_logged_values(job_dir, tmp_path):
+    path = os.path.join(job_dir, "CL_Cleaner.csv")
+    log = pd.read_csv(path)
+    log.loc[len(log) - 10, "CL_Temp"] = 1234.56789  # only its run needs float64
+    log.to_csv(path, index=False)
+    tool_logs.sort_log(path, "timestamp_cleaner", str(tmp_path), "cl", chunk_rows=100)
+    stored = store.read_frame(str(tmp_path), "cl")
+    expected = tool_logs.prepare_chunk(pd.read_csv(path), "timestamp_cleaner")
+    assert stored.to_csv(index=False) == expected.to_csv(index=False)
+
+
+def test_streamed_sync_matches_in_memory_sync(job_dir, tmp_path):
+    streamed = _streamed_sync(job_dir, str(tmp_path), rows=101)
+    expected = _in_memory_sync(job_dir)
+    assert len(streamed) == len(expected)
+    for col in ["timestamp_cleaner", "timestamp_developer", "timestamp_etcher"] + cde_merger.SYNC_COLUMNS:
+        pd.testing.assert_series_equal(streamed[col], expected[col].reset_index(drop=True), check_dtype=False)
+
+
+def test_empty_stored_log_yields_one_typed_empty_frame(job_dir, tmp_path):
+    path = os.path.join(job_dir, "CL_Developer.csv")
+    header_only(path)
+    assert tool_logs.sort_log(path, "timestamp_developer", str(tmp_path), "dv") == 0
+    chunks = list(tool_logs.iter_sorted(str(tmp_path), "dv"))
+    assert len(chunks) == 1 and chunks[0].empty
+    assert pd.api.types.is_datetime64_dtype(chunks[0]["timestamp_developer"])
+
+
+@pytest.mark.parametrize("name", ["CL_Developer.csv", "CL_Etcher4.csv"])
+def test_header_only_log_syncs_like_in_memory(job_dir, tmp_path, name):
+    header_only(os.path.join(job_dir, name))
+    streamed = _streamed_sync(job_dir, str(tmp_path))
+    expected = _in_memory_sync(job_dir)
+    assert len(streamed) == len(expected)
+    assert streamed[LOGS[name]].isna().all()
+
+
+@pytest.mark.parametrize("name", ["CL_Developer.csv", "CL_Etcher4.csv"])
+def test_pipeline_runs_with_a_header_only_log(job_dir, name):
+    header_only(os.path.join(job_dir, name))
+    pipeline.run_pipeline(job_dir)
+    final = store.read_frame(job_dir, pipeline.FINAL)
+    assert len(final) and final["timestamp_etcher"].isna().all()
+
+
+def test_streamed_sync_agrees_with_the_old_sync(job_dir, tmp_path):
+    streamed = _streamed_sync(job_dir, str(tmp_path), rows=101)
+    old = reference.sync_tool_logs(*(pd.read_csv(os.path.join(job_dir, name)) for name in LOGS))
+    # One row per cleaner event now; the old merge lost events (see test_joins.py)
+    assert len(streamed) == len(pd.read_csv(os.path.join(job_dir, "CL_Cleaner.csv"))) >= len(old)
+    times = ["timestamp_cleaner", "timestamp_developer", "timestamp_etcher"]
+    matched = streamed[times].drop_duplicates("timestamp_cleaner").set_index("timestamp_cleaner")
+    expected = old[times].set_index("timestamp_cleaner")
+    pd.testing.assert_frame_equal(matched.loc[expected.index], expected)
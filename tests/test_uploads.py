@@ -0,0 +1,58 @@
+import hashlib
+import io
+import multiprocessing
+import time
+
+import pytest
+
+import uploads
+
+DATA = b"TimeStamp,Recipe\n2024-03-01 06:00:49,R3\n"
+
+
+class _SlowStream(io.BytesIO):
+    """A request body that arrives slowly, so another request comes in meanwhile."""
+
+    def read(self, size=-1):
+        time.sleep(0.5)
+        return super().read(size)
+
+
+def _append(upload_id, blob_dir, results):
+    try:
+        uploads.Session.open(upload_id, blob_dir).append(0, _SlowStream(DATA))
+        results.put("ok")
+    except uploads.UploadError as e:
+        results.put(str(e))
+
+
+def test_chunk_for_another_offset_is_refused(tmp_path):
+    blob_dir = str(tmp_path / "blobs")
+    session = uploads.Session.create("CL_Cleaner.csv", len(DATA), blob_dir)
+    with pytest.raises(uploads.UploadError, match="at offset 0"):
+        session.append(10, io.BytesIO(DATA[10:]))
+    session.append(0, io.BytesIO(DATA[:10]))
+    with pytest.raises(uploads.UploadError, match="at offset 10"):
+        session.append(0, io.BytesIO(DATA[:10]))
+    with pytest.raises(uploads.UploadError, match="past the announced size"):
+        session.append(10, io.BytesIO(DATA[10:] + b"x"))
+    assert session.append(10, io.BytesIO(DATA[10:]))["sha256"] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_the_same_chunk_sent_by_two_server_processes_is_appended_once(tmp_path):
+    blob_dir = str(tmp_path / "blobs")
+    session = uploads.Session.create("CL_Cleaner.csv", len(DATA), blob_dir)
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=_append, args=(session.id, blob_dir, results)) for _ in range(2)]
+    for process in processes:
+        process.start()
+        time.sleep(0.1)
+    for process in processes:
+        process.join(10)
+
+    assert sorted(results.get(timeout=1) for _ in processes) == ["Upload already complete", "ok"]
+    state = uploads.Session.open(session.id, blob_dir).state()
+    assert state["done"] and state["sha256"] == hashlib.sha256(DATA).hexdigest()
+    with open(uploads.blob_path(state["sha256"], blob_dir), "rb") as f:
+        assert f.read() == DATA
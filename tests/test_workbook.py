@@ -0,0 +1,71 @@
+import os
+import re
+import zipfile
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import clean_raw_data
+import reference
+import workbook
+
+
+def test_read_sheet_equals_read_excel_on_the_used_columns(job_dir):
+    path = os.path.join(job_dir, "raw_data.xlsx")
+    full = pd.read_excel(path)
+    keep = [c for c in range(full.shape[1]) if 1 <= c <= 26 or c >= 106]
+    pd.testing.assert_frame_equal(workbook.read_sheet(path, clean_raw_data.USECOLS), full.iloc[:, keep])
+
+
+def test_only_the_used_columns_are_converted(job_dir, monkeypatch):
+    path = os.path.join(job_dir, "raw_data.xlsx")
+    converted = []
+    convert = workbook._convert
+    monkeypatch.setattr(workbook, "_convert", lambda value: converted.append(value) or convert(value))
+    df = workbook.read_sheet(path, clean_raw_data.USECOLS)
+    # The sheet is 110 columns wide; the ones between Z and DC are skipped
+    assert len(converted) <= (len(df) + 1) * 40
+
+
+@pytest.mark.filterwarnings("ignore::FutureWarning")  # the old header repair
+def test_cleaned_workbook_equals_the_old_cleaning(job_dir):
+    path = os.path.join(job_dir, "raw_data.xlsx")
+    expected = reference.clean_raw_data(pd.read_excel(path))
+    for _ in range(2):  # parsed, then from the converted-sheet cache
+        cleaned = clean_raw_data.clean_raw_data(clean_raw_data.load_raw_data(path))
+        pd.testing.assert_frame_equal(cleaned, expected, check_dtype=False, check_names=False)
+
+
+def test_converted_sheet_round_trips_through_the_cache(job_dir):
+    path = os.path.join(job_dir, "raw_data.xlsx")
+    parsed = workbook.load_sheet(path, clean_raw_data.USECOLS, "digest")
+    assert os.path.exists(path + workbook.SHEET_SUFFIX)
+    cached = workbook.load_sheet(path, clean_raw_data.USECOLS, "digest")
+    pd.testing.assert_frame_equal(cached, parsed)
+    for col in parsed.columns:
+        assert [type(v) for v in cached[col]] == [type(v) for v in parsed[col]]
+
+
+def test_namespace_prefixed_sheet_is_read(tmp_path):
+    # Some writers prefix the spreadsheetml elements, e.g. <x:row><x:c r="B2">
+    path = str(tmp_path / "prefixed.xlsx")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["Title", "Date", "Heat Melt"])
+    ws.append([None, "a", 1])
+    ws.append([None, "b", 2.5])
+    wb.save(path)
+    _prefix_sheet(path)
+    pd.testing.assert_frame_equal(workbook.read_sheet(path, "B:C"), pd.read_excel(path).iloc[:, 1:])
+
+
+def _prefix_sheet(path):
+    with zipfile.ZipFile(path) as archive:
+        members = {info: archive.read(info) for info in archive.infolist()}
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for info, content in members.items():
+            if info.filename.startswith("xl/worksheets/"):
+                content = re.sub(rb"<(/?)(?!\?)([a-zA-Z]+)", rb"<\1x:\2", content)
+                content = content.replace(b"<x:worksheet xmlns=", b"<x:worksheet xmlns:x=")
+            archive.writestr(info, content)